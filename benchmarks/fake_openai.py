@@ -0,0 +1,70 @@
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+from gemba.http_json import JSONRequestHandler
+
+# OpenAI-compatible stand-in for the benchmarks. Every chat completion is
+# answered by `server.answer(prompt)` after a configurable latency; a fraction
+# of the requests fails with a rate limit or a server error instead.
+
+ANSWERS = {
+    "GEMBA-DA": lambda prompt: str(len(prompt) % 101),
+    "GEMBA-SQM": lambda prompt: str(len(prompt) % 101),
+    "GEMBA-stars": lambda prompt: f"{len(prompt) % 5 + 1} stars",
+    "GEMBA-classes": lambda prompt: "Most meaning preserved, minor issues",
+    "GEMBA-MQM": lambda prompt: 'Critical:\nno-error\nMajor:\naccuracy/mistranslation - "x"\nMinor:\nfluency/grammar - "y"',
+    # the error spans of the first stage are passed on as they are, the ranking is a number
+    "GEMBA-ESA": lambda prompt: str(len(prompt) % 101),
+}
+
+
+class FakeOpenAIHandler(JSONRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            delay = max(0.0, server.rng.gauss(server.latency, server.jitter))
+            failure = server.rng.random() < server.error_rate
+            status = 429 if server.rng.random() < 0.5 else 500
+        time.sleep(delay)
+
+        if failure:
+            with server.lock:
+                server.errors += 1
+            self._send_json(status, {"error": {"message": "Injected failure", "type": "benchmark"}})
+            return
+
+        prompt = request["messages"][-1]["content"]
+        self._send_json(200, {
+            "id": "chatcmpl-benchmark",
+            "object": "chat.completion",
+            "created": 0,
+            "model": request["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": server.answer(prompt)}}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 5, "total_tokens": len(prompt) // 4 + 5},
+        })
+
+
+def start_fake_openai(latency=0.0, jitter=0.0, error_rate=0.0, seed=0, host="127.0.0.1", port=0):
+    """Start the fake server in a background thread, `latency` and `jitter`
+    (mean and standard deviation) are in seconds. Set `server.answer` before use."""
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.jitter = jitter
+    server.error_rate = error_rate
+    server.rng = random.Random(seed)
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.errors = 0
+    server.answer = ANSWERS["GEMBA-DA"]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
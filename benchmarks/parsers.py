@@ -0,0 +1,64 @@
+"""Micro-benchmark of the answer parsers on a corpus of real answer shapes.
+
+benchmarks/parser_corpus.jsonl has one answer per line (structured JSON, legacy
+text, markdown-wrapped and broken answers) with the parser it is meant for and
+the expected result, which tests/test_parser_corpus.py checks.
+
+    python -m benchmarks.parsers --repeat 2000
+"""
+
+import argparse
+import json
+import logging
+import os
+import time
+
+from gemba.gemba_mqm_utils import parse_mqm_answer
+from gemba.prompt import prompts, validate_number, validate_stars
+
+CORPUS = os.path.join(os.path.dirname(__file__), "parser_corpus.jsonl")
+
+PARSERS = {
+    "number": validate_number,
+    "stars": validate_stars,
+    "classes": prompts["GEMBA-classes"]["validate_answer"],
+    "mqm": lambda answer: {
+        "score": parse_mqm_answer(answer),
+        "errors": parse_mqm_answer(answer, list_mqm_errors=True, full_desc=True),
+        "classes": parse_mqm_answer(answer, list_mqm_errors=True, full_desc=False),
+    },
+}
+
+
+def load_corpus(path=CORPUS):
+    with open(path, "r") as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+
+def run_benchmark(corpus, repeat=1000):
+    """Microseconds per answer of every parser, averaged over the corpus."""
+    results = {}
+    for name, parse in PARSERS.items():
+        answers = [entry["answer"] for entry in corpus if entry["parser"] == name]
+        started = time.perf_counter()
+        for _ in range(repeat):
+            for answer in answers:
+                parse(answer)
+        results[name] = (time.perf_counter() - started) / (repeat * len(answers)) * 1e6
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=CORPUS)
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    # the parsers log every unexpected answer
+    logging.disable(logging.WARNING)
+    for name, microseconds in run_benchmark(load_corpus(args.corpus), args.repeat).items():
+        print(f"{name:<10}{microseconds:>10.2f} us/answer")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Benchmark of the whole scoring pipeline against a local fake OpenAI server.
+
+Every method is run as in gemba_da.py: Testset -> prompt rendering ->
+GptApi.bulk_request -> parser -> Scores.save, with a fresh answer cache so that
+every segment goes through the API. Every method runs in a fresh process, so
+that its peak RSS is its own. Reports segments/sec, peak RSS and the time per
+pipeline stage, and exits with 1 when the throughput of a method regressed
+against a baseline file by more than --max_regression.
+
+    python -m benchmarks.pipeline --segments 500 --systems 8 --latency_ms 20 --concurrency 16
+    python -m benchmarks.pipeline --save_baseline benchmarks/baseline.json
+    python -m benchmarks.pipeline --baseline benchmarks/baseline.json --max_regression 0.2
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from benchmarks.fake_openai import ANSWERS, start_fake_openai
+from gemba.cache import GembaCache
+from gemba.gpt_api import GptApi
+from gemba.metrics import STAGE_SECONDS
+from gemba.prompt import language_codes, prompts
+from gemba.scores import Scores
+from gemba.testset import Testset
+from gemba.utils import score_segments
+
+METHODS = ["GEMBA-DA", "GEMBA-SQM", "GEMBA-stars", "GEMBA-classes", "GEMBA-MQM", "GEMBA-ESA"]
+STAGES = ["render", "cache_lookup", "rate_limit_wait", "api_call", "parse", "persist"]
+
+WORDS = ("the of and to in is was for on that with as by at from this have are be an not it or which "
+         "translation quality system sentence model news evaluation language document result").split()
+
+
+def make_testset(basepath, dataset, lp, segments, systems, seed=0):
+    """Write a synthetic testset in the mt-metrics-eval layout: sources,
+    one reference, `systems` system outputs and the documents."""
+    rng = random.Random(seed)
+
+    def sentence():
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 40))).capitalize() + "."
+
+    def write(path, lines):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as fh:
+            fh.writelines(line + "\n" for line in lines)
+
+    root = f"{basepath}/{dataset}"
+    sources = [sentence() for _ in range(segments)]
+    write(f"{root}/sources/{lp}.txt", sources)
+    write(f"{root}/references/{lp}.refA.txt", [sentence() for _ in sources])
+    write(f"{root}/documents/{lp}.docs", [f"news\tdoc{i // 10}" for i in range(segments)])
+    for system in range(systems):
+        write(f"{root}/system-outputs/{lp}/system{system:02d}.txt", [sentence() for _ in sources])
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def stage_times():
+    return {stage: STAGE_SECONDS.total(stage=stage) for stage in STAGES}
+
+
+def run_method(gptapi, testset, method, model, cache_dir, concurrency):
+    use_ref = method in prompts and prompts[method]["use_ref"]
+    refname = testset.main_ref if use_ref else None
+    scores = Scores(f"{method}_benchmark", testset, refname)
+    rows = list(testset.iterate_over_all(refname))
+    source_lang, target_lang = (language_codes[code] for code in testset.lp.split("-"))
+
+    answers = score_segments(
+        gptapi, GembaCache(os.path.join(cache_dir, method)),
+        [src for src, _, _, _ in rows], [hyp for _, hyp, _, _ in rows], source_lang, target_lang, method, model,
+        use_structured_output=False, reference=[ref for _, _, ref, _ in rows] if use_ref else None,
+        concurrency=concurrency,
+    )
+    for hypothesis_index, ((_, _, _, system), answer) in enumerate(zip(rows, answers)):
+        scores.assign_score(system, hypothesis_index, answer["answer"], answer["temperature"])
+    scores.save()
+    return len(rows)
+
+
+def measure_method(workdir, lp, port, method, model, concurrency):
+    """Run one method in the current (fresh) process and measure it."""
+    testset = Testset(workdir, "wmt22", lp)
+    gptapi = GptApi(base_url=f"http://127.0.0.1:{port}")
+    stages = stage_times()
+    started = time.perf_counter()
+    try:
+        scored = run_method(gptapi, testset, method, model, os.path.join(workdir, "cache"), concurrency)
+    finally:
+        gptapi.close()
+    elapsed = time.perf_counter() - started
+    return {
+        "segments": scored,
+        "seconds": elapsed,
+        "segments_per_second": scored / elapsed,
+        "peak_rss_mb": peak_rss_mb(),
+        "stage_seconds": {stage: seconds - stages[stage] for stage, seconds in stage_times().items()},
+    }
+
+
+def run_benchmark(methods=METHODS, segments=200, systems=4, lp="en-de", latency=0.0, jitter=0.0, error_rate=0.0,
+                  concurrency=8, model="benchmark-model", seed=0):
+    """Benchmark results per method: segments, seconds, segments/sec, peak RSS
+    and the seconds spent in every pipeline stage.
+
+    The peak RSS is the one of a spawned process that only runs the method, the
+    interpreter and the imports included, so the methods can be compared."""
+    server = start_fake_openai(latency=latency, jitter=jitter, error_rate=error_rate, seed=seed)
+    results = {}
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            make_testset(workdir, "wmt22", lp, segments, systems, seed)
+            for method in methods:
+                server.answer = ANSWERS[method]
+                requests = server.requests
+                with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                    result = executor.submit(measure_method, workdir, lp, server.server_port, method, model, concurrency).result()
+                result["api_requests"] = server.requests - requests
+                results[method] = result
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def regressions(results, baseline, max_regression):
+    """Methods whose throughput dropped below (1 - max_regression) of the baseline."""
+    failed = []
+    for method, result in results.items():
+        if method not in baseline:
+            continue
+        expected = baseline[method]["segments_per_second"]
+        if result["segments_per_second"] < expected * (1 - max_regression):
+            failed.append(f"{method}: {result['segments_per_second']:.1f} segments/s, baseline {expected:.1f}")
+    return failed
+
+
+def print_report(results):
+    header = f"{'method':<15}{'segments':>9}{'seg/s':>9}{'RSS MB':>8}" + "".join(f"{stage:>16}" for stage in STAGES)
+    print(header)
+    for method, result in results.items():
+        print(f"{method:<15}{result['segments']:>9}{result['segments_per_second']:>9.1f}{result['peak_rss_mb']:>8.0f}"
+              + "".join(f"{result['stage_seconds'][stage]:>15.3f}s" for stage in STAGES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--methods", default=",".join(METHODS), help="Comma-separated methods to benchmark.")
+    parser.add_argument("--segments", type=int, default=200, help="Source segments of the synthetic testset.")
+    parser.add_argument("--systems", type=int, default=4, help="Systems of the synthetic testset.")
+    parser.add_argument("--lp", default="en-de", help="Language pair.")
+    parser.add_argument("--latency_ms", type=float, default=0.0, help="Mean latency of the fake API.")
+    parser.add_argument("--jitter_ms", type=float, default=0.0, help="Standard deviation of the latency.")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Fraction of API calls that fail.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent API requests.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="Write the results as JSON to this file.")
+    parser.add_argument("--save_baseline", default=None, help="Write the results as the new baseline.")
+    parser.add_argument("--baseline", default=None, help="Fail when a method is slower than this baseline.")
+    parser.add_argument("--max_regression", type=float, default=0.2, help="Allowed throughput drop against the baseline.")
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        methods=args.methods.split(","), segments=args.segments, systems=args.systems, lp=args.lp,
+        latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000, error_rate=args.error_rate,
+        concurrency=args.concurrency, seed=args.seed,
+    )
+    print_report(results)
+    for path in (args.output, args.save_baseline):
+        if path is not None:
+            with open(path, "w") as fh:
+                json.dump(results, fh, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fh:
+            failed = regressions(results, json.load(fh), args.max_regression)
+        if failed:
+            print("Throughput regressions:\n" + "\n".join(failed), file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
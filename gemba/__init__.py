@@ -1,8 +1,9 @@
 """Top-level package for the GEMBA translation evaluation utilities."""
 
+from gemba.scorer import Scorer
 from gemba.utils import RESPONSE_FORMATS, get_gemba_scores
 
-__all__ = ["get_gemba_scores", "RESPONSE_FORMATS"]
+__all__ = ["get_gemba_scores", "Scorer", "RESPONSE_FORMATS"]
 
 # Keep version here so it can be queried programmatically and by packaging.
 __version__ = "0.1.0"
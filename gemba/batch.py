@@ -0,0 +1,117 @@
+import json
+import logging
+import sys
+import time
+
+from openai.types.chat import ChatCompletion
+
+from gemba.cache import request_key
+
+logger = logging.getLogger(__name__)
+
+# Offline scoring through the OpenAI Batch API. Uncached prompts are rendered
+# into a JSONL job file, the job is submitted and polled (or uploaded manually),
+# and the result file is ingested into the diskcache so that a normal run
+# completes from the cache.
+
+
+def _prompts_by_key(prompts, model, max_tokens=None, response_format=None):
+    # the cache key is used as the custom_id of a batch line; batch requests are
+    # always the first attempt, temperature escalation of unparseable answers
+    # happens during the normal run
+    return {request_key(model, 0, prompt, response_format, max_tokens): prompt for prompt in prompts}
+
+
+def _batch_url(gptapi):
+    # Azure deployments expect the endpoint without the version prefix
+    return "/v1/chat/completions" if gptapi.is_openai else "/chat/completions"
+
+
+def write_batch_file(gptapi, prompts, model, cache, path, max_tokens=None, response_format=None):
+    """Write every uncached prompt as a line of an OpenAI Batch-format JSONL file.
+
+    Returns the number of written requests.
+    """
+    url = _batch_url(gptapi)
+    count = 0
+    with open(path, "w") as fh:
+        for key, prompt in _prompts_by_key(prompts, model, max_tokens, response_format).items():
+            if key in cache:
+                continue
+            body = gptapi.api_parameters(prompt, model, 0, max_tokens, response_format=response_format)
+            fh.write(json.dumps({"custom_id": key, "method": "POST", "url": url, "body": body}, ensure_ascii=False) + "\n")
+            count += 1
+    return count
+
+
+def submit_batch(client, path, endpoint="/v1/chat/completions", completion_window="24h"):
+    with open(path, "rb") as fh:
+        batch_file = client.files.create(file=fh, purpose="batch")
+    batch = client.batches.create(input_file_id=batch_file.id, endpoint=endpoint, completion_window=completion_window)
+    return batch.id
+
+
+def wait_for_batch(client, batch_id, output_path, poll_interval=60):
+    """Poll a submitted batch until it is finished and download its result file."""
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in ("completed", "failed", "expired", "cancelled"):
+            break
+        print(f"Batch {batch_id} is {batch.status}, waiting {poll_interval}s", file=sys.stderr)
+        time.sleep(poll_interval)
+
+    # expired or cancelled batches still deliver the requests finished so far
+    if batch.output_file_id is None:
+        raise Exception(f"Batch {batch_id} ended with status {batch.status}.")
+
+    content = client.files.content(batch.output_file_id)
+    with open(output_path, "w") as fh:
+        fh.write(content.text)
+    return output_path
+
+
+def ingest_batch_results(gptapi, path, prompts, model, cache, max_tokens=None, response_format=None):
+    """Store the answers of a Batch API result file into the cache.
+
+    Only lines whose custom_id matches one of `prompts` are ingested. Failed or
+    truncated responses are skipped and will be requested again by a normal run.
+    Returns the number of stored answers.
+    """
+    keys = _prompts_by_key(prompts, model, max_tokens, response_format)
+    count = 0
+    with open(path, "r") as fh:
+        for line in fh:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            key = result.get("custom_id")
+            if key not in keys:
+                continue
+
+            response = result.get("response") or {}
+            if result.get("error") is not None or response.get("status_code") != 200:
+                logger.warning("Batch request %s failed: %s", result["custom_id"], result.get("error"))
+                continue
+
+            answers = gptapi.answers_from_response(ChatCompletion.model_validate(response["body"]))
+            if not answers:
+                continue
+            cache.set(key, answers)
+            count += 1
+    return count
+
+
+def run_batch(gptapi, prompts, model, cache, path, submit=False, max_tokens=None, response_format=None, poll_interval=60):
+    """Export the uncached prompts to `path` and, with `submit`, run the job and
+    ingest its results. Returns the number of exported requests."""
+    count = write_batch_file(gptapi, prompts, model, cache, path, max_tokens=max_tokens, response_format=response_format)
+    print(f"Wrote {count} batch requests to {path}", file=sys.stderr)
+    if not submit or count == 0:
+        return count
+
+    batch_id = submit_batch(gptapi.client, path, endpoint=_batch_url(gptapi))
+    output_path = path.rsplit(".jsonl", 1)[0] + ".results.jsonl"
+    wait_for_batch(gptapi.client, batch_id, output_path, poll_interval=poll_interval)
+    ingested = ingest_batch_results(gptapi, output_path, prompts, model, cache, max_tokens=max_tokens, response_format=response_format)
+    print(f"Ingested {ingested} batch results from {output_path}", file=sys.stderr)
+    return count
@@ -0,0 +1,155 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import zlib
+
+import diskcache as dc
+
+
+def request_key(model, temperature, prompt, response_format=None, max_tokens=None, logprobs=None):
+    """Stable content hash of a canonicalized request, used as the cache key.
+
+    A plain string prompt is canonicalized to the single user message it is sent
+    as, so both forms of the same request share one cache entry.
+    """
+    if isinstance(prompt, list):
+        messages = prompt
+    else:
+        messages = [{"role": "user", "content": prompt}]
+    request = {"model": model, "temperature": temperature, "messages": messages,
+               "response_format": response_format, "max_tokens": max_tokens}
+    # only part of the key when set, so that existing cache entries stay valid
+    if logprobs is not None:
+        request["logprobs"] = logprobs
+    canonical = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def _decode(value):
+    if value is None:
+        return None
+    answers = json.loads(zlib.decompress(value))
+    if len(answers) == 0:
+        return None
+    return answers
+
+
+class GembaCache:
+    """Persistent answer cache on top of diskcache.
+
+    Keys are short content hashes (see `request_key`) instead of the pickled
+    request, and the answers are stored as zlib-compressed JSON.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.cache = dc.Cache(directory, expire=None, size_limit=int(10e10), cull_limit=0, eviction_policy='none')
+
+    def get(self, key):
+        """Cached answers of a request, or None. An empty answer list is treated
+        as a miss so that failed requests are retried."""
+        return _decode(self.cache.get(key))
+
+    def get_many(self, keys):
+        """Cached answers of many requests read in a single transaction, as a dict
+        that contains only the hits."""
+        hits = {}
+        with self.cache.transact():
+            for key in keys:
+                value = self.cache.get(key)
+                if value is not None:
+                    hits[key] = value
+
+        answers = {}
+        for key, value in hits.items():
+            value = _decode(value)
+            if value is not None:
+                answers[key] = value
+        return answers
+
+    def set(self, key, answers):
+        self.cache.set(key, zlib.compress(json.dumps(answers, ensure_ascii=False).encode("utf-8")))
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.cache)
+
+    def close(self):
+        self.cache.close()
+
+
+def migrate_cache(directory, response_format=None, max_tokens=None):
+    """Rewrite a legacy cache keyed by pickled `{"model", "temperature", "prompt"}`
+    dicts into the hashed format.
+
+    Legacy keys do not record `response_format` and `max_tokens`, so the values
+    used by the runs that filled the cache have to be given. Entries at a
+    temperature above 0 are the retries of unparseable answers, which were
+    requested without `max_tokens` and are keyed so. The legacy cache is
+    kept next to the new one as `<directory>.legacy`. Returns the number of
+    migrated entries.
+    """
+    directory = directory.rstrip("/")
+    legacy_directory = f"{directory}.legacy"
+    migrating_directory = f"{directory}.migrating"
+    assert not os.path.exists(legacy_directory), f"{legacy_directory} already exists"
+
+    legacy = dc.Cache(directory)
+    migrated = GembaCache(migrating_directory)
+    count = 0
+    for key in legacy.iterkeys():
+        if not isinstance(key, dict) or not {"model", "temperature", "prompt"} <= key.keys():
+            continue
+        answers = legacy[key]
+        if answers is None:
+            continue
+        # escalated requests are sent without max_tokens, see GptApi.request
+        key_max_tokens = max_tokens if key["temperature"] == 0 else None
+        migrated.set(request_key(key["model"], key["temperature"], key["prompt"], response_format, key_max_tokens), answers)
+        count += 1
+    legacy.close()
+    migrated.close()
+
+    os.rename(directory, legacy_directory)
+    os.rename(migrating_directory, directory)
+    return count
+
+
+def _method_from_directory(directory):
+    # cache directories are named cache/{model}_{method}
+    name = os.path.basename(directory.rstrip("/"))
+    index = name.rfind("_GEMBA-")
+    if index == -1:
+        return None
+    return name[index + 1:]
+
+
+def main(argv=None):
+    from gemba.utils import get_request_settings
+
+    parser = argparse.ArgumentParser(description="Migrate legacy GEMBA caches to the hashed cache format.")
+    parser.add_argument("directories", nargs="+", help="Cache directories, e.g. cache/gpt-4_GEMBA-MQM.")
+    parser.add_argument("--no_structured_output", action="store_true",
+                        help="The cache was filled without structured output (JSON schema response_format).")
+    parser.add_argument("--max_tokens", type=int, default=None,
+                        help="max_tokens of the cached requests (default: inferred from the method).")
+    args = parser.parse_args(argv)
+
+    for directory in args.directories:
+        method = _method_from_directory(directory)
+        if method is None:
+            print(f"Cannot infer the method from {directory}, skipping.", file=sys.stderr)
+            continue
+        response_format, max_tokens = get_request_settings(method, not args.no_structured_output)
+        if args.max_tokens is not None:
+            max_tokens = args.max_tokens
+        count = migrate_cache(directory, response_format=response_format, max_tokens=max_tokens)
+        print(f"Migrated {count} entries of {directory}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import sys
+
+# Cascade scoring: a cheap draft model scores every segment and only segments
+# with an uncertain draft answer are scored again by the expensive model.
+#
+# Escalation settings (all optional, see `escalation_settings`):
+#   score_range      (low, high), draft scores within the range are escalated
+#   max_temperature  draft answers that needed a higher temperature to parse are escalated
+#   samples          number of draft samples per segment, the first one is deterministic
+#   max_disagreement draft samples that differ by more than this are escalated
+
+DEFAULT_ESCALATION = {
+    "GEMBA-MQM": {"score_range": (-24, -5), "max_disagreement": 5},
+    "GEMBA-ESA": {"score_range": (30, 75), "max_disagreement": 15},
+    "GEMBA-DA": {"score_range": (30, 75), "max_disagreement": 15},
+    "GEMBA-SQM": {"score_range": (30, 75), "max_disagreement": 15},
+    "GEMBA-stars": {"score_range": (2, 4), "max_disagreement": 1},
+    "GEMBA-classes": {"score_range": (1, 3), "max_disagreement": 1},
+}
+
+ESCALATION_REASONS = ["parse_failure", "temperature", "score_range", "disagreement"]
+
+
+def escalation_settings(method, escalation=None):
+    """Default escalation settings of a method updated with `escalation`."""
+    settings = {"score_range": None, "max_temperature": 0, "samples": 1, "max_disagreement": 0}
+    settings.update(DEFAULT_ESCALATION.get(method.replace("_ref", ""), {}))
+    settings.update(escalation or {})
+    return settings
+
+
+def sample_temperatures(samples):
+    # temperatures are in tenths; extra samples are drawn at the highest
+    # temperatures so that they are diverse and get distinct cache keys
+    assert 1 <= samples <= 11, "Between 1 and 11 draft samples are supported."
+    return [0] + [10 - i for i in range(samples - 1)]
+
+
+def escalation_reason(samples, settings):
+    """Why the parsed draft answers of one segment (one per sample) are not
+    trusted, or None."""
+    first = samples[0]
+    if first["answer"] is None:
+        return "parse_failure"
+    if first["temperature"] > settings["max_temperature"]:
+        return "temperature"
+    answers = [sample["answer"] for sample in samples if sample["answer"] is not None]
+    if len(answers) < len(samples):
+        return "disagreement"
+    if not all(isinstance(answer, (int, float)) for answer in answers):
+        # e.g. listed MQM errors, only equal answers agree
+        return None if all(answer == answers[0] for answer in answers) else "disagreement"
+
+    if settings["score_range"] is not None:
+        low, high = settings["score_range"]
+        if low <= first["answer"] <= high:
+            return "score_range"
+    if max(answers) - min(answers) > settings["max_disagreement"]:
+        return "disagreement"
+    return None
+
+
+def cascade_segments(draft_score, score, source, hypothesis, method, draft_model, model, escalation=None, reference=None, **scoring_args):
+    """Score all segments with `draft_score` and the uncertain ones again with `score`.
+
+    Both are functions with the signature of `Scorer.score_segments` extended by
+    `temperature`. Returns the parsed answer of every segment; the answer of an
+    escalated segment carries the reason in "escalation".
+    """
+    assert scoring_args.get("batch") is None, "Batch mode is not supported for cascade scoring."
+    settings = escalation_settings(method, escalation)
+
+    samples = []
+    for temperature in sample_temperatures(settings["samples"]):
+        samples.append(draft_score(source, hypothesis, method=method, reference=reference, temperature=temperature, **scoring_args))
+
+    answers = []
+    escalated = []
+    for i, segment_samples in enumerate(zip(*samples)):
+        answer = dict(segment_samples[0], escalation=escalation_reason(segment_samples, settings))
+        if answer["escalation"] is not None:
+            escalated.append(i)
+        answers.append(answer)
+
+    if escalated:
+        escalated_reference = None if reference is None else [reference[i] for i in escalated]
+        escalated_answers = score([source[i] for i in escalated], [hypothesis[i] for i in escalated], method=method,
+                                  reference=escalated_reference, **scoring_args)
+        for i, answer in zip(escalated, escalated_answers):
+            answers[i] = dict(answer, escalation=answers[i]["escalation"])
+
+    print(cascade_report(answers, draft_model, model), file=sys.stderr)
+    return answers
+
+
+def cascade_report(answers, draft_model, model):
+    total = len(answers)
+    reasons = [answer["escalation"] for answer in answers if answer["escalation"] is not None]
+    escalated = len(reasons)
+
+    def share(count):
+        return f"{count} ({100 * count / total:.1f}%)" if total else "0"
+
+    breakdown = ", ".join(f"{reason} {reasons.count(reason)}" for reason in ESCALATION_REASONS if reason in reasons)
+    report = f"Cascade: {share(total - escalated)} segments scored by {draft_model}, {share(escalated)} escalated to {model}"
+    if breakdown:
+        report += f" ({breakdown})"
+    return report
@@ -1,8 +1,16 @@
+import contextlib
+import itertools
+import json
 import os
 import sys
 
 from absl import app, flags
 
+from gemba.metrics import SCORES_WRITTEN, MetricsDumper, stage_timer
+from gemba.replay import Recorder, serve_replay
+from gemba.retry import RetryPolicy
+from gemba.scorer import Scorer
+from gemba.usage import UsageTracker, load_prices
 from gemba.utils import get_gemba_scores
 
 FLAGS = flags.FLAGS
@@ -16,8 +24,160 @@ flags.DEFINE_boolean('list_mqm_errors', False, 'List MQM errors.')
 flags.DEFINE_string('api_version', None, 'API version for Azure OpenAI (overrides default).')
 flags.DEFINE_boolean('no_structured_output', False, 'Disable structured output (JSON schema response_format).')
 flags.DEFINE_string('base_url', None, 'Custom API base URL (e.g. http://localhost:11434 for Ollama).')
+flags.DEFINE_integer('concurrency', 1, 'Number of concurrent API requests (1 = sequential).')
+flags.DEFINE_integer('rpm', None, 'Requests-per-minute budget of the deployment.')
+flags.DEFINE_integer('tpm', None, 'Tokens-per-minute budget of the deployment.')
+flags.DEFINE_enum('batch', None, ['export', 'submit'], 'Batch API mode: export the uncached requests, or also submit them and wait for the results.')
+flags.DEFINE_string('batch_file', 'batch_requests.jsonl', 'Path of the exported Batch API request file.')
+flags.DEFINE_string('batch_results', None, 'Batch API result file to ingest into the cache before scoring.')
+flags.DEFINE_integer('pack_size', 1, 'Number of segments scored per API request (GEMBA-MQM, GEMBA-DA, GEMBA-SQM).')
+flags.DEFINE_string('output', None, 'Stream one JSON line per segment to this file instead of printing the scores at the end. An existing file is resumed.')
+flags.DEFINE_integer('chunk_size', 100, 'Number of segments read and scored at a time when streaming to --output.')
+flags.DEFINE_string('draft_model', None, 'Cheaper model that scores every segment first; only uncertain segments are escalated to --model.')
+flags.DEFINE_string('draft_base_url', None, 'API base URL of the draft model (defaults to --base_url).')
+flags.DEFINE_list('escalate_range', None, 'Draft scores within this "low,high" range are escalated (default depends on the method).')
+flags.DEFINE_integer('draft_samples', 1, 'Number of draft samples per segment; disagreeing samples are escalated.')
+flags.DEFINE_float('max_disagreement', None, 'Largest difference between draft samples that is not escalated.')
+flags.DEFINE_boolean('logprobs', False, 'Score GEMBA-DA, GEMBA-SQM and GEMBA-stars by the expected value of the score token log-probabilities.')
+flags.DEFINE_integer('max_calls_per_segment', 6, 'Maximum number of API calls spent on a segment whose answers do not parse or are truncated.')
+flags.DEFINE_integer('max_tokens_per_segment', None, 'Maximum number of (estimated) tokens spent on a single segment.')
+flags.DEFINE_string('usage_file', None, 'Write the token usage, latency percentiles and estimated cost of the run to this JSON file.')
+flags.DEFINE_string('price_table', None, 'JSON price table (USD per 1M tokens per model) for the cost estimate.')
+flags.DEFINE_string('metrics_file', None, 'Periodically dump the pipeline stage timings and counters in the Prometheus text format to this file.')
+flags.DEFINE_integer('metrics_interval', 15, 'Seconds between two dumps of --metrics_file.')
+flags.DEFINE_string('record_file', None, 'Append every API call (request, response, latency) to this JSONL file for `gemba replay`.')
+flags.DEFINE_string('replay_log', None, 'Recorded API calls served by `gemba replay`.')
+flags.DEFINE_float('replay_speed', 1.0, 'Speed-up of the recorded latencies in `gemba replay`, 0 answers right away.')
+flags.DEFINE_string('host', '127.0.0.1', 'Address the scoring service (`gemba serve`) listens on.')
+flags.DEFINE_integer('port', 8000, 'Port of the scoring service.')
+flags.DEFINE_integer('max_batch_size', 64, 'Maximum number of queued segments the scoring service scores together.')
+flags.DEFINE_integer('max_wait_ms', 50, 'How long the scoring service waits to fill a batch.')
+flags.DEFINE_integer('max_pending', 10000, 'Number of queued segments above which the scoring service rejects requests.')
+
+
+def _completed_indices(path):
+    """Segment indices already written to a streaming output file.
+
+    A partially written last line (e.g. after a crash) is cut off so that new
+    results are appended after the last complete line.
+    """
+    done = set()
+    if not os.path.isfile(path):
+        return done
+
+    with open(path, "rb+") as fh:
+        complete = 0
+        for line in fh:
+            if not line.endswith(b"\n"):
+                break
+            complete += len(line)
+            try:
+                done.add(json.loads(line)["index"])
+            except (ValueError, KeyError, TypeError):
+                continue
+        fh.truncate(complete)
+    return done
+
+
+def _escalation():
+    escalation = {"samples": FLAGS.draft_samples}
+    if FLAGS.escalate_range is not None:
+        low, high = FLAGS.escalate_range
+        escalation["score_range"] = (float(low), float(high))
+    if FLAGS.max_disagreement is not None:
+        escalation["max_disagreement"] = FLAGS.max_disagreement
+    return escalation
+
+
+def _retry_policy():
+    return RetryPolicy(max_calls=FLAGS.max_calls_per_segment, max_tokens=FLAGS.max_tokens_per_segment)
+
+
+def _usage():
+    return UsageTracker(load_prices(FLAGS.price_table) if FLAGS.price_table else None)
+
+
+def stream_scores(source_path, hypothesis_path, output_path, chunk_size, source_lang, target_lang, method, model,
+                  api_version=None, base_url=None, rpm=None, tpm=None, use_structured_output=True, concurrency=1,
+                  draft_model=None, draft_base_url=None, retry_policy=None, usage=None, recorder=None, **scoring_args):
+    """Read the source and hypothesis files lazily and append one JSON line per
+    scored segment to `output_path`, skipping segments already written there."""
+    done = _completed_indices(output_path)
+    if done:
+        print(f"Resuming {output_path}, {len(done)} segments already scored", file=sys.stderr)
+
+    scorer = Scorer(model, api_version=api_version, base_url=base_url, rpm=rpm, tpm=tpm, use_structured_output=use_structured_output,
+                    concurrency=concurrency, draft_model=draft_model, draft_base_url=draft_base_url, retry_policy=retry_policy,
+                    usage=usage, recorder=recorder)
+
+    def score_chunk(chunk, out):
+        answers = scorer.score_segments(
+            [src for _, src, _ in chunk], [hyp for _, _, hyp in chunk], source_lang, target_lang, method, **scoring_args,
+        )
+        with stage_timer("persist"):
+            write_records(chunk, answers, out)
+        SCORES_WRITTEN.inc(len(chunk))
+
+    def write_records(chunk, answers, out):
+        for (index, _, _), answer in zip(chunk, answers):
+            record = {
+                "index": index,
+                "score": answer["answer"],
+                "temperature": answer["temperature"],
+                "finish_reason": answer["finish_reason"],
+            }
+            for field in ("escalations", "confidence"):
+                if field in answer:
+                    record[field] = answer[field]
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        out.flush()
+
+    with scorer, open(source_path, 'r') as fs, open(hypothesis_path, 'r') as fh, open(output_path, 'a') as out:
+        chunk = []
+        for index, (src, hyp) in enumerate(itertools.zip_longest(fs, fh)):
+            assert src is not None and hyp is not None, "Source and hypothesis files must have the same number of lines."
+            if index in done:
+                continue
+            chunk.append((index, src.strip(), hyp.strip()))
+            if len(chunk) >= chunk_size:
+                score_chunk(chunk, out)
+                chunk = []
+        if chunk:
+            score_chunk(chunk, out)
+
 
 def main(argv):
+    if FLAGS.metrics_file is None:
+        return _main(argv)
+    with MetricsDumper(FLAGS.metrics_file, FLAGS.metrics_interval):
+        return _main(argv)
+
+
+def _main(argv):
+    if argv[1:] == ["serve"]:
+        from gemba.server import ScoringService, serve
+
+        service = ScoringService(
+            FLAGS.model,
+            api_version=FLAGS.api_version,
+            base_url=FLAGS.base_url,
+            rpm=FLAGS.rpm,
+            tpm=FLAGS.tpm,
+            use_structured_output=not FLAGS.no_structured_output,
+            concurrency=FLAGS.concurrency,
+            max_batch_size=FLAGS.max_batch_size,
+            max_wait=FLAGS.max_wait_ms / 1000,
+            max_pending=FLAGS.max_pending,
+            retry_policy=_retry_policy(),
+        )
+        serve(service, FLAGS.host, FLAGS.port)
+        return
+    if argv[1:] == ["replay"]:
+        assert FLAGS.replay_log is not None, "The recorded API calls must be provided with --replay_log."
+        serve_replay(FLAGS.replay_log, FLAGS.host, FLAGS.port, FLAGS.replay_speed)
+        return
+    assert len(argv) == 1, f"Unknown command {' '.join(argv[1:])}"
+
     assert FLAGS.source is not None, "Source file must be provided."
     assert FLAGS.hypothesis is not None, "Hypothesis file must be provided."
 
@@ -31,6 +191,42 @@ def main(argv):
     assert FLAGS.source_lang is not None, "Source language name must be provided."
     assert FLAGS.target_lang is not None, "Target language name must be provided."
 
+    usage = _usage()
+    with contextlib.ExitStack() as stack:
+        recorder = None
+        if FLAGS.record_file is not None:
+            recorder = stack.enter_context(Recorder(FLAGS.record_file))
+        _score_files(usage, recorder)
+
+
+def _score_files(usage, recorder):
+
+    if FLAGS.output is not None:
+        assert FLAGS.batch is None, "Batch mode cannot be combined with --output."
+        stream_scores(
+            FLAGS.source, FLAGS.hypothesis, FLAGS.output, FLAGS.chunk_size,
+            FLAGS.source_lang, FLAGS.target_lang, FLAGS.method, FLAGS.model,
+            api_version=FLAGS.api_version,
+            base_url=FLAGS.base_url,
+            rpm=FLAGS.rpm,
+            tpm=FLAGS.tpm,
+            list_mqm_errors=FLAGS.list_mqm_errors,
+            use_structured_output=not FLAGS.no_structured_output,
+            concurrency=FLAGS.concurrency,
+            batch_results=FLAGS.batch_results,
+            pack_size=FLAGS.pack_size,
+            draft_model=FLAGS.draft_model,
+            draft_base_url=FLAGS.draft_base_url,
+            escalation=_escalation(),
+            use_logprobs=FLAGS.logprobs,
+            retry_policy=_retry_policy(),
+            usage=usage,
+            recorder=recorder,
+        )
+        if FLAGS.usage_file is not None:
+            usage.write(FLAGS.usage_file)
+        return
+
     with open(FLAGS.source, 'r') as f:
         source = f.readlines()
     source = [x.strip() for x in source]
@@ -46,7 +242,27 @@ def main(argv):
         api_version=FLAGS.api_version,
         use_structured_output=not FLAGS.no_structured_output,
         base_url=FLAGS.base_url,
+        concurrency=FLAGS.concurrency,
+        rpm=FLAGS.rpm,
+        tpm=FLAGS.tpm,
+        batch=FLAGS.batch,
+        batch_file=FLAGS.batch_file,
+        batch_results=FLAGS.batch_results,
+        pack_size=FLAGS.pack_size,
+        draft_model=FLAGS.draft_model,
+        draft_base_url=FLAGS.draft_base_url,
+        escalation=_escalation(),
+        use_logprobs=FLAGS.logprobs,
+        retry_policy=_retry_policy(),
+        usage=usage,
+        recorder=recorder,
     )
+    if FLAGS.usage_file is not None:
+        usage.write(FLAGS.usage_file)
+
+    if answers is None:
+        # requests were only exported for a manual batch upload
+        return
 
     for answer in answers:
         print(answer)
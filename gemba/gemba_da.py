@@ -1,62 +1,67 @@
-import diskcache as dc
-from gemba.prompt import prompts, language_codes
-from gemba.gpt_api import GptApi
-from gemba.testset import Testset
-from gemba.scores import Scores
+import argparse
+import contextlib
+import os
+import sys
 
+from gemba.batch import ingest_batch_results, run_batch
+from gemba.metrics import MetricsDumper
+from gemba.scenarios import ScenarioRunner, load_scenarios, parse_scenarios
+from gemba.usage import UsageTracker, load_prices
 
-def main():
-    scenarios = [
-        ["text-davinci-003", "GEMBA-DA", [["wmt22", "en-de"], ["wmt22", "zh-en"], ["wmt22", "en-ru"]], ],
-        ["text-davinci-003", "GEMBA-DA_ref", [["wmt22", "en-de"], ["wmt22", "zh-en"], ["wmt22", "en-ru"]], ],
-    ]
 
-    gptapi = GptApi()
-    for scenario in scenarios:
-        use_model = scenario[0]
-        annotation = scenario[1]
-        cache = dc.Cache(f'cache/{use_model}_{annotation}', expire=None, size_limit=int(10e10), cull_limit=0, eviction_policy='none')
+# the scenarios of the GEMBA-DA paper, run when no scenario file is given (see gemba.scenarios)
+SCENARIOS = {
+    "endpoints": {"default": {}},
+    "scenarios": [
+        {"model": "text-davinci-003", "method": "GEMBA-DA", "testsets": [["wmt22", "en-de"], ["wmt22", "zh-en"], ["wmt22", "en-ru"]]},
+        {"model": "text-davinci-003", "method": "GEMBA-DA_ref", "testsets": [["wmt22", "en-de"], ["wmt22", "zh-en"], ["wmt22", "en-ru"]]},
+    ],
+}
 
-        scoring_name = f"{annotation}_{use_model}"
 
-        if use_model not in credentials["deployments"].keys():
-            print(f"Model {use_model} not supported by credentials")
-            continue
+def main(scenario_file=None, batch=None, batch_dir="batches", batch_results=None, prices=None, systems=None, workers=None):
+    endpoints, jobs = load_scenarios(scenario_file) if scenario_file is not None else parse_scenarios(SCENARIOS)
+    runner = ScenarioRunner(endpoints, jobs, usage=UsageTracker(prices), systems=systems, workers=workers)
 
-        for dataset, lp in scenario[2]:
-            testset = Testset("mt-metrics-eval-v2", dataset, lp)
-            if prompts[annotation]["use_ref"]:
-                refname = testset.main_ref
-            else:
-                refname = None
+    if batch is not None or batch_results is not None:
+        # the Batch API fills the cache job by job, the scoring below then finds the answers there
+        for job in jobs:
+            gptapi = runner.gptapi(job.endpoint)
+            cache = job.cache()
+            job.open()
+            pending_prompts = [prompt for _, _, prompt in job.pending(systems)]
+            if batch_results is not None:
+                ingest_batch_results(gptapi, batch_results, pending_prompts, job.model, cache)
+            if batch is not None:
+                os.makedirs(batch_dir, exist_ok=True)
+                batch_file = f"{batch_dir}/{job.name}_{job.dataset}_{job.lp}.jsonl"
+                run_batch(gptapi, pending_prompts, job.model, cache, batch_file, submit=batch == "submit")
+        if batch == "export":
+            return []
 
-            scores = Scores(scoring_name, testset, refname)
-
-            # starts with -1 as it is incremented before the first request
-            hypothesis_index = -1
-            total = testset.segments_count()
-            for src, hyp, ref, system in testset.iterate_over_all(refname):
-                hypothesis_index += 1
-
-                if scores.get_score(system, hypothesis_index) != 'None':
-                    continue
-
-                print(f"Processing hypothesis {hypothesis_index}/{total} for {scoring_name} on {dataset}/{lp}")
-
-                data = {
-                    "source_seg": src,
-                    "target_seg": hyp,
-                    "reference_seg": ref,
-                    "source_lang": language_codes[lp.split("-")[0]],
-                    "target_lang": language_codes[lp.split("-")[1]],
-                }
-                prompt = prompts[annotation]["prompt"].format(**data)
-                parsed_answers = gptapi.request(prompt, use_model, prompts[annotation]["validate_answer"], cache=cache)
-
-                scores.assign_score(system, hypothesis_index, parsed_answers[0]['answer'], parsed_answers[0]['temperature'])
-
-            scores.save()
+    failed = runner.run()
+    for job in failed:
+        print(f"Scoring {job} failed", file=sys.stderr)
+    return failed
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default=None, help="JSON scenario file with the endpoints and the models, methods and language pairs to score.")
+    parser.add_argument("--batch", choices=["export", "submit"], default=None,
+                        help="Batch API mode: export the unscored requests, or also submit them and wait for the results.")
+    parser.add_argument("--batch_dir", default="batches", help="Directory for the Batch API request files.")
+    parser.add_argument("--batch_results", default=None, help="Batch API result file to ingest into the cache before scoring.")
+    parser.add_argument("--prices", default=None, help="JSON price table (USD per 1M tokens) for the cost estimates.")
+    parser.add_argument("--workers", type=int, default=None, help="Worker threads shared by all jobs, by default the total concurrency of the endpoints.")
+    parser.add_argument("--systems", default=None, help="Comma-separated systems to score, all systems by default.")
+    parser.add_argument("--metrics_file", default=None, help="Periodically dump the pipeline stage timings in the Prometheus text format to this file.")
+    args = parser.parse_args()
+    with contextlib.ExitStack() as stack:
+        if args.metrics_file is not None:
+            stack.enter_context(MetricsDumper(args.metrics_file))
+        failed = main(scenario_file=args.scenarios, batch=args.batch, batch_dir=args.batch_dir, batch_results=args.batch_results,
+                      prices=load_prices(args.prices) if args.prices else None, workers=args.workers,
+                      systems=args.systems.split(",") if args.systems else None)
+    if failed:
+        sys.exit(1)
@@ -3,21 +3,24 @@ import logging
 import re
 from collections import defaultdict
 
+from gemba.metrics import stage_timer
+
 logger = logging.getLogger(__name__)
 
 
 def apply_template(template, data):
-    if isinstance(template, str):
-        return template.format(**data)
-    elif isinstance(template, list):
-        prompt = []
-        for conversation_turn in template:
-            p = conversation_turn.copy()
-            p['content'] = p['content'].format(**data)
-            prompt.append(p)
-        return prompt
-    else:
-        raise ValueError(f"Unknown template type {type(template)}")
+    with stage_timer("render"):
+        if isinstance(template, str):
+            return template.format(**data)
+        elif isinstance(template, list):
+            prompt = []
+            for conversation_turn in template:
+                p = conversation_turn.copy()
+                p['content'] = p['content'].format(**data)
+                prompt.append(p)
+            return prompt
+        else:
+            raise ValueError(f"Unknown template type {type(template)}")
 
 def parse_broken_json(x):
     improved_translation = ""
@@ -48,38 +51,79 @@ def parse_broken_json(x):
     return {"improved translation": improved_translation, "errors": errors}
 
 
+# error classes in the order they are checked, with their subclasses; the
+# last subclass found in the error description wins
+ERROR_CLASSES = [
+    ("accuracy", ["addition", "mistranslation", "omission", "untranslated text"]),
+    ("fluency", ["character encoding", "grammar", "inconsistency", "punctuation", "register", "spelling"]),
+    ("locale convention", ["currency", "date", "name", "telephone", "time"]),
+    ("style", []),
+    ("terminology", ["inappropriate", "inconsistent"]),
+    ("non-translation", []),
+    ("other", []),
+]
+
+
 def parse_error_class(error):
     # parse error from error description, errors are ['accuracy', 'fluency', 'locale convention', 'style', 'terminology', 'non-translation', 'other']
     #  locale convention (currency, date, name, telephone, or time format), style (awkward), terminology (inappropriate for context, inconsistent use),
-    class_name = "unknown"
-    if "accuracy" in error:
-        class_name = "accuracy"
-        for subclass in ["addition", "mistranslation", "omission", "untranslated text"]:
-            if subclass in error:
-                class_name = f"accuracy-{subclass}"
-    elif "fluency" in error:
-        class_name = "fluency"
-        for subclass in ["character encoding", "grammar", "inconsistency", "punctuation", "register", "spelling"]:
-            if subclass in error:
-                class_name = f"fluency-{subclass}"
-    elif "locale convention" in error:
-        class_name = "locale convention"
-        for subclass in ["currency", "date", "name", "telephone", "time"]:
-            if subclass in error:
-                class_name = f"locale convention-{subclass}"
-    elif "style" in error:
-        class_name = "style"
-    elif "terminology" in error:
-        class_name = "terminology"
-        for subclass in ["inappropriate", "inconsistent"]:
-            if subclass in error:
-                class_name = f"terminology-{subclass}"
-    elif "non-translation" in error:
-        class_name = "non-translation"
-    elif "other" in error:
-        class_name = "other"
-
-    return class_name
+    for class_name, subclasses in ERROR_CLASSES:
+        if class_name in error:
+            for subclass in reversed(subclasses):
+                if subclass in error:
+                    return f"{class_name}-{subclass}"
+            return class_name
+    return "unknown"
+
+
+_ERROR_LEVEL_HEADERS = {"critical:": "critical", "major:": "major", "minor:": "minor"}
+_ERROR_CLASS_PREFIXES = ('accuracy', 'fluency', 'locale convention', 'style', 'terminology', 'non-translation', 'other')
+
+
+def _add_error_line(errors, error_level, line):
+    # adds a line of a text answer to `errors` and returns the error level of the following lines
+    line = line.strip()
+    if "no-error" in line or "no error" in line or "" == line:
+        return error_level
+    if line in _ERROR_LEVEL_HEADERS:
+        return _ERROR_LEVEL_HEADERS[line]
+
+    if "critical" in line or "major" in line or "minor" in line:
+        if not line.startswith(_ERROR_CLASS_PREFIXES):
+            logger.debug("Unexpected error level reference in line: %s", line)
+
+    if error_level is None:
+        logger.warning("No error level for: %s", line)
+        return error_level
+
+    if "non-translation" in line:
+        errors["critical"].append(line)
+    else:
+        errors[error_level].append(line)
+    return error_level
+
+
+def _structured_errors(structured_errors):
+    # errors of a structured JSON answer, the same as parsing the answer written
+    # out as text ("category - description" lines under the error levels)
+    errors = {'critical': [], 'major': [], 'minor': []}
+    for level in ("critical", "major", "minor"):
+        error_level = level
+        items = structured_errors.get(level, [])
+        if not items:
+            continue
+        for item in items:
+            if isinstance(item, dict):
+                item = f"{item.get('category', 'other')} - {item.get('description', '')}"
+            else:
+                item = str(item)
+            item = item.lower()
+            if "\n" in item:
+                for line in item.split("\n"):
+                    error_level = _add_error_line(errors, error_level, line)
+            else:
+                error_level = _add_error_line(errors, error_level, item)
+    return errors
 
 
 def parse_mqm_answer(x, list_mqm_errors=False, full_desc=True):
@@ -88,66 +132,29 @@ def parse_mqm_answer(x, list_mqm_errors=False, full_desc=True):
 
     x = str(x)
 
-    # Handle structured JSON output from response_format
-    try:
-        parsed = json.loads(x)
+    errors = None
+    # Handle structured JSON output from response_format, scored without the text parser
+    if x.lstrip().startswith("{"):
+        try:
+            parsed = json.loads(x)
+        except (json.JSONDecodeError, ValueError, TypeError):
+            parsed = None
         if isinstance(parsed, dict) and "errors" in parsed:
-            # Convert structured errors to text format for the existing parser below
-            lines = []
-            for level in ("critical", "major", "minor"):
-                items = parsed["errors"].get(level, [])
-                lines.append(f"{level}:")
-                if not items:
-                    lines.append("no-error")
-                else:
-                    for item in items:
-                        if isinstance(item, dict):
-                            lines.append(f"{item.get('category', 'other')} - {item.get('description', '')}")
-                        else:
-                            lines.append(str(item))
-            x = "\n".join(lines)
-            # Fall through to text parser below
-    except (json.JSONDecodeError, ValueError, TypeError):
-        pass
+            errors = _structured_errors(parsed["errors"])
 
-    if x.startswith('{"improved translation"'):
+    if errors is not None:
+        pass
+    elif x.startswith('{"improved translation"'):
         try:
             x = json.loads(x)
         except:
             x = parse_broken_json(x)
         errors = x["errors"]
-
-
     else:
-        x = x.lower()
         errors = {'critical': [], 'major': [], 'minor': []}
         error_level = None
-        for line in x.split('\n'):
-            line = line.strip()
-            if "no-error" in line or "no error" in line or "" == line:
-                continue
-            if "critical:" == line:
-                error_level = "critical"
-                continue
-            elif "major:" == line:
-                error_level = "major"
-                continue
-            elif "minor:" == line:
-                error_level = "minor"
-                continue
-
-            if "critical" in line or "major" in line or "minor" in line:
-                if not any([line.startswith(x) for x in ['accuracy', 'fluency', 'locale convention', 'style', 'terminology', 'non-translation', 'other']]):
-                    logger.debug("Unexpected error level reference in line: %s", line)
-
-            if error_level is None:
-                logger.warning("No error level for: %s", line)
-                continue
-
-            if "non-translation" in line:
-                errors["critical"].append(line)
-            else:
-                errors[error_level].append(line)
+        for line in x.lower().split('\n'):
+            error_level = _add_error_line(errors, error_level, line)
 
     error_classes = defaultdict(list)
     final_score = 0
@@ -1,61 +1,234 @@
+import asyncio
+import contextlib
+import functools
+import json
 import logging
 import os
 import re
 import sys
+import threading
 import time
 
 import openai
+import pandas as pd
 import tqdm
-from openai import BadRequestError, NotFoundError, PermissionDeniedError
+from openai import BadRequestError, NotFoundError, PermissionDeniedError, RateLimitError
+
+from gemba.cache import request_key
+from gemba.logprobs import score_distribution
+from gemba.metrics import API_CALLS, CACHE_LOOKUPS, PARSED_ANSWERS, stage_timer
+from gemba.rate_limiter import RateLimiter, estimate_tokens
+from gemba.repair import repair_candidates
+from gemba.retry import RetryPolicy, TruncationStats
+from gemba.usage import UsageTracker
 
 logger = logging.getLogger(__name__)
 
 
 # class for calling OpenAI API and handling cache
 class GptApi:
-    def __init__(self, verbose=False, api_version=None, base_url=None):
+    def __init__(self, verbose=False, api_version=None, base_url=None, rpm=None, tpm=None, retry_policy=None, usage=None, recorder=None,
+                 max_inflight=None):
         self.verbose = verbose
         self.is_openai = False
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.truncation_stats = TruncationStats()
+        # usage, latency and cost of the API calls, see gemba.usage
+        self.usage = usage or UsageTracker()
+        # records the API traffic for offline replay, see gemba.replay
+        self.recorder = recorder
+
+        # client-side budgets per deployment (model), None leaves the quota unbudgeted
+        self.rpm = rpm
+        self.tpm = tpm
+        self.rate_limiters = {}
+        self._rate_limiters_lock = threading.Lock()
 
         if base_url is not None:
             # Custom endpoint (e.g. Ollama, vLLM, etc.)
-            self.client = openai.OpenAI(base_url=base_url.rstrip("/") + "/v1", api_key="none")
+            client_cls, async_client_cls = openai.OpenAI, openai.AsyncOpenAI
+            client_kwargs = {"base_url": base_url.rstrip("/") + "/v1", "api_key": "none"}
         elif "OLLAMA_HOST" in os.environ:
             # Ollama API access
             ollama_host = os.environ["OLLAMA_HOST"].rstrip("/")
-            self.client = openai.OpenAI(base_url=ollama_host + "/v1", api_key="ollama")
+            client_cls, async_client_cls = openai.OpenAI, openai.AsyncOpenAI
+            client_kwargs = {"base_url": ollama_host + "/v1", "api_key": "ollama"}
         elif "OPENAI_AZURE_ENDPOINT" in os.environ:
             assert "OPENAI_AZURE_KEY" in os.environ, "OPENAI_AZURE_KEY not found in environment"
 
             # Azure API access
-            self.client = openai.AzureOpenAI(
-                api_key=os.environ["OPENAI_AZURE_KEY"],
-                azure_endpoint=os.environ["OPENAI_AZURE_ENDPOINT"],
-                api_version=api_version or "2023-07-01-preview",
-            )
+            client_cls, async_client_cls = openai.AzureOpenAI, openai.AsyncAzureOpenAI
+            client_kwargs = {
+                "api_key": os.environ["OPENAI_AZURE_KEY"],
+                "azure_endpoint": os.environ["OPENAI_AZURE_ENDPOINT"],
+                "api_version": api_version or "2023-07-01-preview",
+            }
         elif "OPENAI_API_KEY" in os.environ:
             # OpenAI API access
-            self.client = openai.OpenAI(
-                api_key=os.environ["OPENAI_API_KEY"]
-            )
+            client_cls, async_client_cls = openai.OpenAI, openai.AsyncOpenAI
+            client_kwargs = {"api_key": os.environ["OPENAI_API_KEY"]}
             self.is_openai = True
         else:
             raise Exception("Set OPENAI_API_KEY, OPENAI_AZURE_KEY, or OLLAMA_HOST")
 
+        self.client = client_cls(**client_kwargs)
+        # the async client is bound to an event loop, so all concurrent runs go through one
+        # long-lived loop thread that owns a single async client and its connection pool
+        self.async_client_factory = functools.partial(async_client_cls, **client_kwargs)
+        self._async_client = None
+        self._loop = None
+        self._loop_thread = None
+        self._loop_lock = threading.Lock()
+        # bound on the API calls in flight of all concurrent runs together, on top of
+        # the concurrency of every run; None leaves only the per-run bound
+        self.max_inflight = max_inflight
+        self._inflight = None
+        # requests in flight by key, shared by the runs so that they coalesce across runs
+        self._inflight_requests = {}
+
         # Suppress noisy HTTP loggers (don't touch the root logger)
         for _name in ("httpx", "openai", "urllib3"):
             logging.getLogger(_name).setLevel(logging.WARNING)
 
+    def _run_async(self, coroutine):
+        """Run a coroutine on the event loop thread of this GptApi and wait for it.
+        Safe to call from several threads, their runs share the loop and the client."""
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._loop_thread = threading.Thread(target=self._loop.run_forever, name="gemba-gptapi-loop", daemon=True)
+                self._loop_thread.start()
+            assert threading.current_thread() is not self._loop_thread, "_run_async called from its own event loop"
+            future = asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+        try:
+            return future.result()
+        except BaseException:
+            # e.g. KeyboardInterrupt, the run must not go on in the background
+            future.cancel()
+            raise
+
+    def _get_async_client(self):
+        # only called on the loop thread
+        if self._async_client is None:
+            self._async_client = self.async_client_factory()
+        return self._async_client
+
+    def _get_inflight(self):
+        # only called on the loop thread
+        if self._inflight is None:
+            self._inflight = asyncio.Semaphore(self.max_inflight) if self.max_inflight else contextlib.nullcontext()
+        return self._inflight
+
+    def close(self):
+        """Close the async client, stop the event loop thread and close the client."""
+        with self._loop_lock:
+            loop, thread = self._loop, self._loop_thread
+            self._loop = self._loop_thread = None
+        if loop is not None:
+            if self._async_client is not None:
+                asyncio.run_coroutine_threadsafe(self._async_client.close(), loop).result()
+                self._async_client = None
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.close()
+        self.client.close()
+
+    def get_rate_limiter(self, model):
+        with self._rate_limiters_lock:
+            if model not in self.rate_limiters:
+                self.rate_limiters[model] = RateLimiter(self.rpm, self.tpm)
+            return self.rate_limiters[model]
+
+    def report_rate_limits(self):
+        for model, limiter in self.rate_limiters.items():
+            if limiter.throttled or limiter.rate_limited:
+                print(f"Rate limits for {model}: {limiter.summary()}", file=sys.stderr)
+        if self.truncation_stats.truncations:
+            print(f"Truncation: {self.truncation_stats.summary()}", file=sys.stderr)
+
     # answer_id is used for determining if it was the top answer or how deep in the list it was
-    def request(self, prompt, model, parse_response, temperature=0, answer_id=-1, cache=None, max_tokens=None, response_format=None):
-        request = {"model": model, "temperature": temperature, "prompt": prompt}
+    def request(self, prompt, model, parse_response, temperature=0, answer_id=-1, cache=None, max_tokens=None, response_format=None, logprobs=None):
+        budget = self.retry_policy.budget()
+        escalations = 0
+        while True:
+            key = request_key(model, temperature, prompt, response_format, max_tokens, logprobs)
 
-        if request in cache and cache[request] is not None and len(cache[request]) > 0:
-            answers = cache[request]
-        else:
-            answers = self.request_api(prompt, model, temperature, max_tokens, response_format=response_format)
-            cache[request] = answers
+            answers = self._cache_lookup(cache, key)
+            if answers is None:
+                if not self._may_request(budget, prompt, temperature, max_tokens):
+                    return self._parse_answers([], prompt, model, parse_response, temperature, answer_id, escalations)[0]
+                answers = self.request_api(prompt, model, temperature, max_tokens, response_format=response_format, logprobs=logprobs, budget=budget)
+                cache.set(key, answers)
+
+            parsed_answers, answer_id = self._parse_answers(answers, prompt, model, parse_response, temperature, answer_id, escalations)
+            if len(parsed_answers) > 0:
+                return parsed_answers
 
+            # there was no valid answer, increase temperature and try again; escalated
+            # requests are sent without max_tokens so that existing cache entries match
+            temperature += 1
+            max_tokens = None
+            escalations += 1
+
+    async def request_async(self, prompt, model, parse_response, run, temperature=0, answer_id=-1, cache=None, max_tokens=None, response_format=None, logprobs=None):
+        """Async counterpart of `request`, `run` is the AsyncRun of the current event loop."""
+        budget = self.retry_policy.budget()
+        escalations = 0
+        while True:
+            key = request_key(model, temperature, prompt, response_format, max_tokens, logprobs)
+
+            answers = self._cache_lookup(cache, key)
+            if answers is None:
+                if not self._may_request(budget, prompt, temperature, max_tokens):
+                    return self._parse_answers([], prompt, model, parse_response, temperature, answer_id, escalations)[0]
+                answers = await self._request_api_coalesced(run, key, prompt, model, temperature, cache, max_tokens, response_format, logprobs, budget)
+
+            parsed_answers, answer_id = self._parse_answers(answers, prompt, model, parse_response, temperature, answer_id, escalations)
+            if len(parsed_answers) > 0:
+                return parsed_answers
+
+            # there was no valid answer, increase temperature and try again
+            temperature += 1
+            max_tokens = None
+            escalations += 1
+
+    def _cache_lookup(self, cache, key):
+        with stage_timer("cache_lookup"):
+            answers = cache.get(key)
+        CACHE_LOOKUPS.inc(result="miss" if answers is None else "hit")
+        return answers
+
+    def _may_request(self, budget, prompt, temperature, max_tokens):
+        if temperature > self.retry_policy.max_temperature:
+            return False
+        if not budget.allows(prompt, max_tokens):
+            logger.warning("Retry budget exhausted after %d calls (~%d tokens)", budget.calls, budget.tokens)
+            return False
+        return True
+
+    async def _request_api_coalesced(self, run, key, prompt, model, temperature, cache, max_tokens, response_format, logprobs=None, budget=None):
+        # identical requests issued while the first one is still in flight wait for its answer
+        if key in run.inflight:
+            run.coalesced += 1
+            return await asyncio.shield(run.inflight[key])
+
+        future = asyncio.get_running_loop().create_future()
+        run.inflight[key] = future
+        try:
+            async with run.semaphore, self._get_inflight():
+                answers = await self.request_api_async(prompt, model, run.client, temperature, max_tokens, response_format=response_format, logprobs=logprobs, budget=budget)
+            cache.set(key, answers)
+            future.set_result(answers)
+            return answers
+        except BaseException as e:
+            future.set_exception(e)
+            # mark the exception as retrieved when nobody else is waiting for it
+            future.exception()
+            raise
+        finally:
+            del run.inflight[key]
+
+    def _parse_answers(self, answers, prompt, model, parse_response, temperature, answer_id, escalations=0):
         # there is no valid answer
         if len(answers) == 0:
             return [{
@@ -65,85 +238,224 @@ class GptApi:
                     "prompt": prompt,
                     "finish_reason": None,
                     "model": model,
-                    }]
+                    "escalations": escalations,
+                    "repaired": False,
+                    }], answer_id
 
         parsed_answers = []
         for full_answer in answers:
             finish_reason = full_answer["finish_reason"]
+            with stage_timer("parse"):
+                answer, confidence, repaired = _parse_with_repair(parse_response, full_answer)
+            PARSED_ANSWERS.inc(result="invalid" if answer is None else "repaired" if repaired else "ok")
+            with_logprobs = "score_logprobs" in full_answer
             full_answer = full_answer["answer"]
             answer_id += 1
-            answer = parse_response(full_answer)
             if self.verbose:
                 logger.debug("Answer (t=%d): %s (%s)", temperature, answer, full_answer)
             if answer is None:
                 continue
-            parsed_answers.append(
-                {
-                    "temperature": temperature,
-                    "answer_id": answer_id,
-                    "answer": answer,
-                    "prompt": prompt,
-                    "finish_reason": finish_reason,
-                    "model": model,
-                }
-            )
+            parsed_answer = {
+                "temperature": temperature,
+                "answer_id": answer_id,
+                "answer": answer,
+                "prompt": prompt,
+                "finish_reason": finish_reason,
+                "model": model,
+                "escalations": escalations,
+                "repaired": repaired,
+            }
+            if with_logprobs:
+                parsed_answer["confidence"] = confidence
+            parsed_answers.append(parsed_answer)
+
+        return parsed_answers, answer_id
 
-        # there was no valid answer, increase temperature and try again
-        if len(parsed_answers) == 0:
-            return self.request(prompt, model, parse_response, temperature=temperature + 1, answer_id=answer_id, cache=cache, response_format=response_format)
+    def request_api(self, prompt, model, temperature=0, max_tokens=None, response_format=None, logprobs=None, budget=None):
+        limiter = self.get_rate_limiter(model)
+        # a truncated answer is continued by sending the partial answer back
+        request_prompt, partial = prompt, ""
+        while True:
+            tokens = estimate_tokens(request_prompt, max_tokens)
+            retries = 0
+            while True:
+                with stage_timer("rate_limit_wait"):
+                    limiter.acquire(tokens)
+                started = time.monotonic()
+                try:
+                    with stage_timer("api_call"):
+                        response = self.call_api(request_prompt, model, temperature, max_tokens, response_format=response_format, logprobs=logprobs)
+                    API_CALLS.inc(model=model, outcome="ok")
+                    limiter.record_success()
+                    self.usage.record(model, response, time.monotonic() - started, retries)
+                    break
+                except RateLimitError as e:
+                    logger.warning("Rate limited, backing off: %s", e)
+                    limiter.record_rate_limit(getattr(e.response, "headers", None))
+                    API_CALLS.inc(model=model, outcome="rate_limited")
+                    retries += 1
+                except (BadRequestError, NotFoundError, PermissionDeniedError) as e:
+                    API_CALLS.inc(model=model, outcome="error")
+                    if getattr(e, "code", None) == "content_filter":
+                        return []
+                    raise
+                except Exception as e:
+                    API_CALLS.inc(model=model, outcome="error")
+                    if _is_invalid_model_output(e):
+                        return []
+                    logger.warning("API error, retrying: %s", e)
+                    retries += 1
+                    time.sleep(1)
+            if budget is not None:
+                budget.spend(request_prompt, max_tokens)
 
-        return parsed_answers
+            answers = self.answers_from_response(response)
+            if answers is not None:
+                return _with_score_logprobs(_continued(answers, partial, response), logprobs)
 
-    def request_api(self, prompt, model, temperature=0, max_tokens=None, response_format=None):
-        if temperature > 10:
-            return []
+            # one of the responses didn't finish, continue it or request more tokens
+            request_prompt, partial, max_tokens = self._after_truncation(response, prompt, request_prompt, partial, max_tokens, response_format)
+            if request_prompt is None:
+                return []
+            if budget is not None and not budget.allows(request_prompt, max_tokens):
+                return []
 
+    async def request_api_async(self, prompt, model, client, temperature=0, max_tokens=None, response_format=None, logprobs=None, budget=None):
+        limiter = self.get_rate_limiter(model)
+        request_prompt, partial = prompt, ""
         while True:
-            try:
-                response = self.call_api(prompt, model, temperature, max_tokens, response_format=response_format)
-                break
-            except (BadRequestError, NotFoundError, PermissionDeniedError) as e:
-                if getattr(e, "code", None) == "content_filter":
-                    return []
-                raise
-            except Exception as e:
-                error_body = getattr(e, "error", None)
-                if isinstance(error_body, dict) and error_body.get("code") == "invalid_model_output":
-                    return []
-                logger.warning("API error, retrying: %s", e)
-                time.sleep(1)
+            tokens = estimate_tokens(request_prompt, max_tokens)
+            retries = 0
+            while True:
+                with stage_timer("rate_limit_wait"):
+                    await limiter.acquire_async(tokens)
+                started = time.monotonic()
+                try:
+                    with stage_timer("api_call"):
+                        response = await self.call_api_async(request_prompt, model, client, temperature, max_tokens, response_format=response_format, logprobs=logprobs)
+                    API_CALLS.inc(model=model, outcome="ok")
+                    limiter.record_success()
+                    self.usage.record(model, response, time.monotonic() - started, retries)
+                    break
+                except RateLimitError as e:
+                    logger.warning("Rate limited, backing off: %s", e)
+                    limiter.record_rate_limit(getattr(e.response, "headers", None))
+                    API_CALLS.inc(model=model, outcome="rate_limited")
+                    retries += 1
+                except (BadRequestError, NotFoundError, PermissionDeniedError) as e:
+                    API_CALLS.inc(model=model, outcome="error")
+                    if getattr(e, "code", None) == "content_filter":
+                        return []
+                    raise
+                except Exception as e:
+                    API_CALLS.inc(model=model, outcome="error")
+                    if _is_invalid_model_output(e):
+                        return []
+                    logger.warning("API error, retrying: %s", e)
+                    retries += 1
+                    await asyncio.sleep(1)
+            if budget is not None:
+                budget.spend(request_prompt, max_tokens)
+
+            answers = self.answers_from_response(response)
+            if answers is not None:
+                return _with_score_logprobs(_continued(answers, partial, response), logprobs)
+
+            # one of the responses didn't finish, continue it or request more tokens
+            request_prompt, partial, max_tokens = self._after_truncation(response, prompt, request_prompt, partial, max_tokens, response_format)
+            if request_prompt is None:
+                return []
+            if budget is not None and not budget.allows(request_prompt, max_tokens):
+                return []
 
+    def _after_truncation(self, response, prompt, request_prompt, partial, max_tokens, response_format):
+        """Next request after a truncated response, as (request_prompt, partial,
+        max_tokens), or (None, None, None) to give up.
+
+        A free-text answer is continued: the partial answer is sent back as an
+        assistant message and only the remainder is generated. Structured output
+        cannot be continued, as the continuation would have to match the schema
+        on its own, so it is generated again with max_tokens doubled.
+        """
+        truncated = _truncated_content(response)
+        if response_format is None and truncated is not None:
+            partial += truncated
+            request_prompt = _continuation_messages(prompt, partial)
+            self.truncation_stats.record_continuation(estimate_tokens(request_prompt))
+            return request_prompt, partial, max_tokens
+        if max_tokens is not None and max_tokens < self.retry_policy.max_completion_tokens:
+            self.truncation_stats.record_regeneration(max_tokens)
+            return request_prompt, partial, min(max_tokens * 2, self.retry_policy.max_completion_tokens)
+        self.truncation_stats.record_failure()
+        return None, None, None
+
+    def answers_from_response(self, response):
+        # returns None when one of the choices was cut off at the token limit, and
+        # no answers when one stopped for another reason, e.g. the content filter
         answers = []
         for choice in response.choices:
             if choice.message.content is None:
                 return []
             if hasattr(choice, "message"):
-                answer = choice.message.content.strip()
+                answer = _clean_answer(choice.message.content)
             else:
-                answer = choice.text.strip()
-
-            # Strip <think>...</think> blocks from reasoning models
-            answer = re.sub(r"<think>[\s\S]*?</think>\s*", "", answer).strip()
+                answer = _clean_answer(choice.text)
 
-            # one of the responses didn't finish, we need to request more tokens
             if choice.finish_reason != "stop":
                 logger.warning("Finish reason: %s", choice.finish_reason)
-                if max_tokens is None:
-                    return []
-                return self.request_api(prompt, model, temperature=temperature, max_tokens=max_tokens + 200, response_format=response_format)
+                if choice.finish_reason == "length":
+                    return None
+                return []
 
-            answers.append({
+            answer = {
                 "answer": answer,
                 "finish_reason": choice.finish_reason,
-            })
+            }
+            if getattr(choice, "logprobs", None) is not None:
+                answer["score_logprobs"] = score_distribution(choice.logprobs.content)
+            answers.append(answer)
 
         if len(answers) > 1:
             # remove duplicate answers
-            answers = [dict(t) for t in {tuple(d.items()) for d in answers}]
+            answers = list({json.dumps(d, sort_keys=True): d for d in answers}.values())
 
         return answers
 
-    def call_api(self, prompt, model, temperature, max_tokens, response_format=None):
+    def call_api(self, prompt, model, temperature, max_tokens, response_format=None, logprobs=None):
+        parameters = self.api_parameters(prompt, model, temperature, max_tokens, response_format, logprobs)
+        if self.recorder is not None:
+            return self.recorder.call(parameters, lambda: self._create(parameters))
+        return self._create(parameters)
+
+    def _create(self, parameters):
+        model = parameters["model"]
+        if not self._uses_rate_limit_headers():
+            return self.client.chat.completions.create(**parameters)
+
+        raw_response = self.client.chat.completions.with_raw_response.create(**parameters)
+        self.get_rate_limiter(model).update_from_headers(raw_response.headers)
+        return raw_response.parse()
+
+    async def call_api_async(self, prompt, model, client, temperature, max_tokens, response_format=None, logprobs=None):
+        parameters = self.api_parameters(prompt, model, temperature, max_tokens, response_format, logprobs)
+        if self.recorder is not None:
+            return await self.recorder.call_async(parameters, lambda: self._create_async(parameters, client))
+        return await self._create_async(parameters, client)
+
+    async def _create_async(self, parameters, client):
+        model = parameters["model"]
+        if not self._uses_rate_limit_headers():
+            return await client.chat.completions.create(**parameters)
+
+        raw_response = await client.chat.completions.with_raw_response.create(**parameters)
+        self.get_rate_limiter(model).update_from_headers(raw_response.headers)
+        return raw_response.parse()
+
+    def _uses_rate_limit_headers(self):
+        # reading the headers needs the raw response, only worth it when budgeting
+        return self.rpm is not None or self.tpm is not None
+
+    def api_parameters(self, prompt, model, temperature, max_tokens, response_format=None, logprobs=None):
         parameters = {
             "temperature": temperature/10,
             "top_p": 1,
@@ -158,6 +470,10 @@ class GptApi:
         if response_format is not None and self.is_openai:
             parameters["response_format"] = response_format
 
+        if logprobs is not None:
+            parameters["logprobs"] = True
+            parameters["top_logprobs"] = logprobs
+
         if max_tokens is not None:
             if self.is_openai and any(model.startswith(p) for p in ("gpt-4.1", "gpt-4o", "gpt-5")):
                 parameters["max_completion_tokens"] = max_tokens
@@ -176,12 +492,234 @@ class GptApi:
                 "content": prompt,
             }]
 
-        return self.client.chat.completions.create(**parameters)
+        return parameters
 
-    def bulk_request(self, df, model, parse_mqm_answer, cache, max_tokens=None, response_format=None):
+    def bulk_request(self, df, model, parse_mqm_answer, cache, max_tokens=None, response_format=None, concurrency=1):
         answers = []
-        for i, row in tqdm.tqdm(df.iterrows(), total=len(df), file=sys.stderr):
-            prompt = row["prompt"]
-            parsed_answers = self.request(prompt, model, parse_mqm_answer, cache=cache, max_tokens=max_tokens, response_format=response_format)
+        for parsed_answers in self.bulk_request_grouped(df, model, parse_mqm_answer, cache, max_tokens=max_tokens, response_format=response_format, concurrency=concurrency):
             answers += parsed_answers
         return answers
+
+    def bulk_request_grouped(self, df, model, parse_mqm_answer, cache, max_tokens=None, response_format=None, concurrency=1, temperature=0, logprobs=None, report=True):
+        """Like `bulk_request`, but returns the list of parsed answers of every row.
+
+        `temperature` is the first temperature tried, e.g. to draw extra samples.
+        With `logprobs` (the number of top alternatives per token) the parser is
+        called with the answer and its score distribution, see `gemba.logprobs`.
+        `report=False` leaves out the progress bar and the rate limit summary,
+        for callers that request in many small chunks.
+        """
+        # identical prompts (e.g. the same hypothesis from several systems) are
+        # requested once and their answers are fanned out to every row
+        unique_prompts = []
+        unique_keys = []
+        unique_index = {}
+        row_to_unique = []
+        for prompt in df["prompt"]:
+            key = request_key(model, temperature, prompt, response_format, max_tokens, logprobs)
+            if key not in unique_index:
+                unique_index[key] = len(unique_prompts)
+                unique_prompts.append(prompt)
+                unique_keys.append(key)
+            row_to_unique.append(unique_index[key])
+
+        # resolve all prompts against the cache in one bulk read, hits are answered
+        # right away and only the misses go to the API
+        results = [None] * len(unique_prompts)
+        with stage_timer("cache_lookup"):
+            cached = cache.get_many(unique_keys)
+        CACHE_LOOKUPS.inc(len(cached), result="hit")
+        CACHE_LOOKUPS.inc(len(unique_keys) - len(cached), result="miss")
+        misses = []
+        for i, (prompt, key) in enumerate(zip(unique_prompts, unique_keys)):
+            if key in cached:
+                parsed_answers, _ = self._parse_answers(cached[key], prompt, model, parse_mqm_answer, temperature, -1)
+                if len(parsed_answers) > 0:
+                    results[i] = parsed_answers
+                    continue
+            # unparseable cached answers need the temperature escalation of `request`
+            misses.append(i)
+
+        estimated_tokens = sum(estimate_tokens(unique_prompts[i], max_tokens) for i in misses)
+        logger.info("Request plan: %d rows, %d unique prompts, %d cached, %d to request (~%d tokens)",
+                    len(row_to_unique), len(unique_prompts), len(unique_prompts) - len(misses), len(misses), estimated_tokens)
+
+        coalesced = 0
+        miss_prompts = [unique_prompts[i] for i in misses]
+        if len(misses) == 0:
+            miss_results = []
+        elif concurrency > 1:
+            miss_results, coalesced = self._run_async(self._bulk_request_async(miss_prompts, model, parse_mqm_answer, cache, max_tokens, response_format, concurrency, temperature, logprobs, report))
+        else:
+            miss_results = []
+            for prompt in tqdm.tqdm(miss_prompts, file=sys.stderr, disable=not report):
+                miss_results.append(self.request(prompt, model, parse_mqm_answer, temperature=temperature, cache=cache, max_tokens=max_tokens, response_format=response_format, logprobs=logprobs))
+        for i, parsed_answers in zip(misses, miss_results):
+            results[i] = parsed_answers
+
+        saved = len(row_to_unique) - len(unique_prompts) + coalesced
+        if saved > 0:
+            logger.info("Coalesced identical prompts: %d rows, %d requests saved", len(row_to_unique), saved)
+        if report:
+            self.report_rate_limits()
+
+        return [[dict(answer) for answer in results[i]] for i in row_to_unique]
+
+    async def _bulk_request_async(self, prompts, model, parse_mqm_answer, cache, max_tokens, response_format, concurrency, temperature=0, logprobs=None, report=True):
+        results = [None] * len(prompts)
+        pending = iter(range(len(prompts)))
+        run = AsyncRun(self._get_async_client(), concurrency, self._inflight_requests)
+        progress = tqdm.tqdm(total=len(prompts), file=sys.stderr, disable=not report)
+
+        # a fixed pool of workers keeps memory flat regardless of the input size,
+        # results are stored by position so the output order matches the input
+        async def worker():
+            for i in pending:
+                results[i] = await self.request_async(prompts[i], model, parse_mqm_answer, run, temperature=temperature, cache=cache, max_tokens=max_tokens, response_format=response_format, logprobs=logprobs)
+                progress.update(1)
+
+        try:
+            await _run_workers(worker, min(concurrency, len(prompts)))
+        finally:
+            progress.close()
+
+        return results, run.coalesced
+
+
+    def bulk_request_pipeline(self, rows, model, stages, cache, concurrency=1):
+        """Run dependent requests for every row, e.g. the two stages of GEMBA-ESA.
+
+        `stages` is a list of dicts with "render" (a function of the row and the
+        parsed answer of the previous stage, None for the first stage, returning
+        the prompt), "parse" and optionally "max_tokens" and "response_format".
+        Returns the parsed answers of the last stage for every row, in order.
+
+        With concurrency > 1 every row runs as its own pipeline: the next stage
+        of a row is requested as soon as its previous stage is answered, and all
+        stages share one budget of in-flight API calls.
+        """
+        if concurrency > 1:
+            return self._run_async(self._bulk_request_pipeline_async(rows, model, stages, cache, concurrency))
+
+        previous = [None] * len(rows)
+        for stage in stages:
+            df = pd.DataFrame({"prompt": [stage["render"](row, answer) for row, answer in zip(rows, previous)]})
+            answers = self.bulk_request_grouped(df, model, stage["parse"], cache, max_tokens=stage.get("max_tokens"), response_format=stage.get("response_format"))
+            previous = [parsed_answers[0] for parsed_answers in answers]
+        return answers
+
+    async def _bulk_request_pipeline_async(self, rows, model, stages, cache, concurrency):
+        # results are keyed by segment id, the position of the row in `rows`
+        results = {}
+        pending = iter(range(len(rows)))
+        run = AsyncRun(self._get_async_client(), concurrency, self._inflight_requests)
+        progress = tqdm.tqdm(total=len(rows), file=sys.stderr)
+
+        async def worker():
+            for segment_id in pending:
+                answer = None
+                for stage in stages:
+                    prompt = stage["render"](rows[segment_id], answer)
+                    parsed_answers = await self.request_async(prompt, model, stage["parse"], run, cache=cache, max_tokens=stage.get("max_tokens"), response_format=stage.get("response_format"))
+                    answer = parsed_answers[0]
+                results[segment_id] = parsed_answers
+                progress.update(1)
+
+        # more workers than API call slots, so that the later stages of some
+        # segments overlap with the first stage of others
+        try:
+            await _run_workers(worker, min(concurrency * len(stages), len(rows)))
+        finally:
+            progress.close()
+
+        if run.coalesced > 0:
+            logger.info("Coalesced identical prompts: %d requests saved", run.coalesced)
+        self.report_rate_limits()
+        return [results[segment_id] for segment_id in range(len(rows))]
+
+
+class AsyncRun:
+    """State shared by the requests of one concurrent run on an event loop: the
+    async client, the budget of in-flight API calls and the calls in flight."""
+
+    def __init__(self, client, concurrency, inflight=None):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.inflight = {} if inflight is None else inflight
+        self.coalesced = 0
+
+
+async def _run_workers(worker, count):
+    # the loop is shared with other runs, so when a worker fails the others are
+    # cancelled instead of going on requesting in the background
+    tasks = [asyncio.ensure_future(worker()) for _ in range(count)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _parse_with_repair(parse_response, full_answer):
+    # returns the parsed answer, its confidence (logprobs only) and whether the
+    # answer text had to be repaired locally to parse
+    def parse(text):
+        # answers requested with logprobs are parsed together with their score distribution
+        if "score_logprobs" in full_answer:
+            return parse_response(text, full_answer["score_logprobs"])
+        return parse_response(text), None
+
+    answer, confidence = parse(full_answer["answer"])
+    if answer is not None:
+        return answer, confidence, False
+    for candidate in repair_candidates(full_answer["answer"]):
+        answer, confidence = parse(candidate)
+        if answer is not None:
+            return answer, confidence, True
+    return None, None, False
+
+
+CONTINUE_PROMPT = "Continue exactly where your previous message stopped, without repeating any of it."
+
+
+def _clean_answer(text):
+    # Strip <think>...</think> blocks from reasoning models
+    return re.sub(r"<think>[\s\S]*?</think>\s*", "", text.strip()).strip()
+
+
+def _truncated_content(response):
+    # raw text of a single truncated choice, which can be continued
+    if len(response.choices) != 1:
+        return None
+    return getattr(response.choices[0].message, "content", None)
+
+
+def _continuation_messages(prompt, partial):
+    messages = prompt if isinstance(prompt, list) else [{"role": "user", "content": prompt}]
+    return messages + [{"role": "assistant", "content": partial}, {"role": "user", "content": CONTINUE_PROMPT}]
+
+
+def _continued(answers, partial, response):
+    # joins the continued answer with the partial answers before it
+    if not partial or not answers:
+        return answers
+    answer = dict(answers[0], answer=_clean_answer(partial + response.choices[0].message.content))
+    # the score distribution belongs to the last part only
+    if "score_logprobs" in answer:
+        answer["score_logprobs"] = None
+    return [answer]
+
+
+def _with_score_logprobs(answers, logprobs):
+    # answers requested with logprobs always carry a (possibly empty) score
+    # distribution, also when the endpoint ignored the logprobs parameter
+    if logprobs is not None:
+        for answer in answers:
+            answer.setdefault("score_logprobs", None)
+    return answers
+
+
+def _is_invalid_model_output(e):
+    error_body = getattr(e, "error", None)
+    return isinstance(error_body, dict) and error_body.get("code") == "invalid_model_output"
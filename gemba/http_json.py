@@ -0,0 +1,24 @@
+import json
+from http.server import BaseHTTPRequestHandler
+
+
+class JSONRequestHandler(BaseHTTPRequestHandler):
+    """Base of the local HTTP handlers (scoring service, replay server and the
+    fake OpenAI endpoint of the benchmarks) that answer with JSON bodies."""
+
+    # HTTP/1.1 for keep-alive connections
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, Nagle's algorithm would delay the body
+    disable_nagle_algorithm = True
+    # headers sent with every JSON response
+    json_headers = {}
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in {**self.json_headers, **(headers or {})}.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
@@ -0,0 +1,78 @@
+import math
+
+# Expected scores from token log-probabilities. Instead of taking the sampled
+# score, the distribution over the score token (top_logprobs) is read from the
+# same response and the probability-weighted mean of the valid scores is used.
+# This gives finer-grained scores and a confidence in one call; answers without
+# a usable distribution fall back to the regular parser of the method. So do
+# answers whose most likely score token is not the parsed score, e.g. when the
+# tokenizer splits "85" into "8" and "5" and the distribution is over "8".
+
+TOP_LOGPROBS = 20
+
+# methods with a numeric score, and the range of valid scores
+SCORE_RANGES = {
+    "GEMBA-DA": (0, 100),
+    "GEMBA-DA_ref": (0, 100),
+    "GEMBA-SQM": (0, 100),
+    "GEMBA-SQM_ref": (0, 100),
+    "GEMBA-stars": (1, 5),
+    "GEMBA-stars_ref": (1, 5),
+}
+
+
+def score_distribution(content):
+    """Top alternatives {token: logprob} of the first numeric token of a response,
+    given the `logprobs.content` of a choice, or None without a numeric token."""
+    for position in content or []:
+        if position.token.strip().isdigit():
+            distribution = {alternative.token: alternative.logprob for alternative in position.top_logprobs or []}
+            # top_logprobs can be omitted, the sampled token is always known
+            distribution.setdefault(position.token, position.logprob)
+            return distribution
+    return None
+
+
+def _score_probabilities(distribution, low, high):
+    # {score: probability} of the tokens that are a score within [low, high]
+    probabilities = {}
+    for token, logprob in distribution.items():
+        token = token.strip()
+        if not token.isdigit() or not low <= int(token) <= high:
+            continue
+        probabilities[int(token)] = probabilities.get(int(token), 0.0) + math.exp(logprob)
+    return probabilities
+
+
+def most_likely_score(distribution, low, high):
+    """The valid score with the highest probability in a {token: logprob}
+    distribution, or None when no token is a score within [low, high]."""
+    probabilities = _score_probabilities(distribution, low, high)
+    if not probabilities:
+        return None
+    return max(probabilities, key=probabilities.get)
+
+
+def expected_score(distribution, low, high):
+    """Probability-weighted mean of the valid scores in a {token: logprob}
+    distribution and the probability of the most likely score, or None when no
+    token is a score within [low, high]."""
+    probabilities = _score_probabilities(distribution, low, high)
+    total = sum(probabilities.values())
+    if total == 0:
+        return None
+    score = sum(value * probability for value, probability in probabilities.items()) / total
+    return score, max(probabilities.values()) / total
+
+
+def logprob_parser(parse_answer, low, high):
+    """Parser for answers requested with logprobs. It is called with the answer
+    text and its score distribution and returns the answer and its confidence;
+    the score parsed from the text by `parse_answer` is used when the most likely
+    score of the distribution disagrees with it or there is none."""
+    def parse(answer, distribution):
+        parsed = parse_answer(answer)
+        if distribution is not None and parsed is not None and most_likely_score(distribution, low, high) == parsed:
+            return expected_score(distribution, low, high)
+        return parsed, None
+    return parse
@@ -0,0 +1,172 @@
+import contextlib
+import os
+import threading
+import time
+
+# Counters and histograms of a running job in the Prometheus text format. The
+# pipeline stages (template rendering, cache lookup, rate-limit wait, API call,
+# parsing and score persistence) are timed with `stage_timer`, so that a drop
+# in throughput can be traced to the stage responsible. The metrics are served
+# by `gemba serve` on /metrics/prometheus or dumped to a file by MetricsDumper.
+
+# seconds, from template rendering (sub-millisecond) to slow API calls
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_text(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(dict(key))} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # labels -> (count per bucket, sum, count)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def count(self, **labels):
+        with self._lock:
+            values = self._values.get(tuple(sorted(labels.items())))
+            return values[2] if values else 0
+
+    def total(self, **labels):
+        with self._lock:
+            values = self._values.get(tuple(sorted(labels.items())))
+            return values[1] if values else 0.0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                labels = dict(key)
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_label_text({**labels, 'le': bound})} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_label_text({**labels, 'le': '+Inf'})} {count}")
+                lines.append(f"{self.name}_sum{_label_text(labels)} {total}")
+                lines.append(f"{self.name}_count{_label_text(labels)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, *args)
+            return self._metrics[name]
+
+    def counter(self, name, help):
+        return self._get(Counter, name, help)
+
+    def histogram(self, name, help, buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, buckets)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+    def write(self, path):
+        # written to a temporary file first, so that a scraper never reads a partial file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as fh:
+            fh.write(self.render())
+        os.replace(tmp_path, path)
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram("gemba_stage_seconds", "Time spent in a pipeline stage.")
+STAGE_ERRORS = REGISTRY.counter("gemba_stage_errors_total", "Pipeline stages that raised an exception.")
+CACHE_LOOKUPS = REGISTRY.counter("gemba_cache_lookups_total", "Answer cache lookups by result (hit or miss).")
+API_CALLS = REGISTRY.counter("gemba_api_calls_total", "API calls by model and outcome.")
+PARSED_ANSWERS = REGISTRY.counter("gemba_parsed_answers_total", "Parsed answers by result (ok, repaired or invalid).")
+SCORES_WRITTEN = REGISTRY.counter("gemba_scores_written_total", "Segment scores written to the outputs.")
+
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    """Time the block as one run of a pipeline stage."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+class MetricsDumper:
+    """Writes the metrics to a file every `interval` seconds and once more on
+    close, for batch jobs that are not scraped."""
+
+    def __init__(self, path, interval=15, registry=REGISTRY):
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.registry.write(self.path)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="gemba-metrics", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.registry.write(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,118 @@
+import json
+import sys
+
+import pandas as pd
+
+from gemba.cache import request_key
+from gemba.gemba_mqm_utils import apply_template
+
+# Multi-segment packing: K segments are scored by one request that shares the
+# instructions and the few-shot turns of the template. The packed answer is split by segment index
+# and every segment is stored in the cache under its own single-segment key, so
+# the regular run is answered from the cache and only segments missing from a
+# packed answer are requested individually.
+
+PACK_INSTRUCTIONS = {
+    "score": 'Evaluate every segment above independently. Answer with a JSON object '
+             '{{"segments": [{{"segment": <segment number>, "score": <score>}}, ...]}} '
+             'with one entry for each of the {count} segments.',
+    "errors": 'Evaluate every segment above independently. Answer with a JSON object '
+              '{{"segments": [{{"segment": <segment number>, "errors": {{"critical": [...], "major": [...], "minor": [...]}}}}, ...]}} '
+              'where every error has a "category" and a "description", with one entry for each of the {count} segments.',
+}
+
+
+# placeholders of the segment, the other ones (the languages) are the same for a pack
+SEGMENT_FIELDS = ("{source_seg}", "{target_seg}", "{reference_seg}")
+
+
+def _split_turn(turn, rows):
+    # (instructions, segment part) of the last user turn: the paragraphs without a
+    # segment placeholder are rendered once, unless they differ between the rows
+    shared, segment = [], []
+    for paragraph in turn.split("\n\n"):
+        (segment if any(field in paragraph for field in SEGMENT_FIELDS) else shared).append(paragraph)
+    shared = "\n\n".join(shared)
+    if len({shared.format(**row) for row in rows}) > 1:
+        return "", turn
+    return shared.format(**rows[0]), "\n\n".join(segment)
+
+
+def pack_prompt(template, rows, field):
+    """Render `rows` into a single prompt. Only the segment part of the last user
+    turn is repeated per segment; its instructions and, for conversation
+    templates, the few-shot turns are shared."""
+    last_turn = template if isinstance(template, str) else template[-1]["content"]
+    instructions, segment = _split_turn(last_turn, rows)
+    segments = "\n\n".join(f"Segment {i}:\n{segment.format(**row)}" for i, row in enumerate(rows))
+    content = f"{segments}\n\n{PACK_INSTRUCTIONS[field].format(count=len(rows))}"
+    if instructions:
+        content = f"{instructions}\n\n{content}"
+
+    if isinstance(template, str):
+        return content
+    prompt = apply_template(template[:-1], rows[0])
+    prompt.append({**template[-1], "content": content})
+    return prompt
+
+
+def unpack_answer(answer, field):
+    """Split a packed answer into single-segment answers keyed by segment index.
+
+    The single-segment answers have the same shape as the answers to the
+    non-packed structured output, e.g. `{"score": 90}`. Malformed entries are
+    dropped.
+    """
+    try:
+        parsed = json.loads(answer)
+    except (json.JSONDecodeError, ValueError, TypeError):
+        return {}
+    if not isinstance(parsed, dict) or not isinstance(parsed.get("segments"), list):
+        return {}
+
+    answers = {}
+    for item in parsed["segments"]:
+        if isinstance(item, dict) and isinstance(item.get("segment"), int) and field in item:
+            answers[item["segment"]] = json.dumps({field: item[field]}, ensure_ascii=False)
+    return answers
+
+
+def prefill_packed(gptapi, df, template, model, cache, parse_answer, field, pack_size,
+                   max_tokens=None, response_format=None, packed_response_format=None, concurrency=1):
+    """Score the uncached rows of `df` in packs of `pack_size` segments and cache
+    every valid segment answer under the key of its single-segment prompt.
+
+    `max_tokens` and `response_format` are the settings of the single-segment
+    requests, `packed_response_format` is the array variant sent with the packs.
+    Returns the number of segments answered by the packed requests.
+    """
+    pending = {}
+    for _, row in df.iterrows():
+        key = request_key(model, 0, row["prompt"], response_format, max_tokens)
+        if key in pending or key in cache:
+            continue
+        pending[key] = (key, row)
+
+    pending = list(pending.values())
+    if not pending:
+        return 0
+
+    packs = [pending[i:i + pack_size] for i in range(0, len(pending), pack_size)]
+    packs_df = pd.DataFrame({"prompt": [pack_prompt(template, [row for _, row in pack], field) for pack in packs]})
+    packed_max_tokens = max_tokens * pack_size if max_tokens is not None else None
+    packed_answers = gptapi.bulk_request(packs_df, model, lambda x: x, cache=cache, max_tokens=packed_max_tokens,
+                                         response_format=packed_response_format, concurrency=concurrency)
+
+    answered = 0
+    for pack, packed_answer in zip(packs, packed_answers):
+        answers = unpack_answer(packed_answer["answer"], field)
+        for i, (key, _) in enumerate(pack):
+            answer = answers.get(i)
+            if answer is None or parse_answer(answer) is None:
+                continue
+            cache.set(key, [{"answer": answer, "finish_reason": "stop"}])
+            answered += 1
+
+    print(f"Packed {len(pending)} segments into {len(packs)} requests, "
+          f"{len(pending) - answered} segments left for individual requests", file=sys.stderr)
+    return answered
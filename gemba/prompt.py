@@ -1,3 +1,4 @@
+import functools
 import json
 import logging
 import re
@@ -15,53 +16,70 @@ def parse_and_check_numerical_answer(answer, min=None, max=None):
     return None
 
 
+_NUMBER = re.compile(r"\d+")
+_QUOTED_NUMBER = re.compile(r"^\[['\"][0-9]*['\"]\]$")
+_EMPHASIS_MARKS = re.compile(r"\*+")
+_BOLD = re.compile(r"\*\*(.+?)\*\*")
+
+
+@functools.lru_cache(maxsize=None)
+def _fraction_patterns(max):
+    # "85/100" as the whole answer, and anywhere in the answer
+    return re.compile(rf"^[0-9]*/{max}$"), re.compile(rf"(\d+)/{max}(?:\D|$)")
+
+
 def parse_numerical_answer(answer, min=None, max=None):
-    # Try structured JSON output first (from response_format)
-    try:
-        parsed = json.loads(answer)
-        if isinstance(parsed, dict) and "score" in parsed:
-            return int(parsed["score"])
-    except (json.JSONDecodeError, ValueError, TypeError):
-        pass
+    # fast path for the most common answer, a bare number
+    if answer.isdecimal():
+        return int(answer)
+
+    # Try structured JSON output first (from response_format), only an object can have a score
+    if answer.lstrip().startswith("{"):
+        try:
+            parsed = json.loads(answer)
+            if isinstance(parsed, dict) and "score" in parsed:
+                return int(parsed["score"])
+        except (json.JSONDecodeError, ValueError, TypeError):
+            pass
 
     # --- Original parsing logic ---
     # get all numbers in a string
-    numbers = re.findall(r'\d+', answer)
+    numbers = _NUMBER.findall(answer)
     if len(numbers) == 1:
         return int(numbers[0])
 
     # check if the answer is in form ['100'] and extract the number
-    r1 = re.match(r"^\[['\"][0-9]*['\"]\]$", answer)
+    r1 = _QUOTED_NUMBER.match(answer)
     if r1 is not None:
         return int(answer[2:-2])
 
     if max is not None:
+        exact_fraction, fraction = _fraction_patterns(max)
         # check if the answer is in a form of 0/100
-        r2 = re.match(rf"^[0-9]*/{max}$", answer)
+        r2 = exact_fraction.match(answer)
         if r2 is not None:
             return int(answer.split("/")[0])
 
     # --- Extended fallbacks for newer models that return verbose responses ---
 
     # Strip markdown bold formatting and retry
-    cleaned = re.sub(r"\*+", "", answer).strip()
+    cleaned = _EMPHASIS_MARKS.sub("", answer).strip() if "*" in answer else answer.strip()
     if cleaned != answer:
-        numbers = re.findall(r'\d+', cleaned)
+        numbers = _NUMBER.findall(cleaned)
         if len(numbers) == 1:
             return int(numbers[0])
         if max is not None:
-            r2 = re.match(rf"^[0-9]*/{max}$", cleaned)
+            r2 = exact_fraction.match(cleaned)
             if r2 is not None:
                 return int(cleaned.split("/")[0])
 
     # Look for N/MAX pattern anywhere in the string (original only matches ^N/MAX$)
     if max is not None:
-        fraction_match = re.search(rf"(\d+)/{max}(?:\D|$)", cleaned)
+        fraction_match = fraction.search(cleaned)
         if fraction_match is not None:
             return int(fraction_match.group(1))
 
     # If exactly 2 numbers and the second equals max, take the first as the score
-    numbers = re.findall(r"\d+", cleaned)
     if len(numbers) == 2 and max is not None:
         vals = [int(n) for n in numbers]
         if vals[1] == max:
@@ -79,8 +97,9 @@ def validate_number(x, min=0, max=100):
 
 def parse_classes(answer, classes):
     final_class = None
+    answer = answer.lower()
     for i in range(len(classes)):
-        if classes[i].lower() in answer.lower():
+        if classes[i].lower() in answer:
             if final_class is None:
                 final_class = i
             else:
@@ -92,7 +111,7 @@ def parse_classes(answer, classes):
 
 def validate_stars(x):
     # Strip markdown bold formatting before processing (newer models wrap in **)
-    x = re.sub(r"\*\*(.+?)\*\*", r"\1", x)
+    x = _BOLD.sub(r"\1", x)
     x = x.lower()
     # try to find all possible answers as sometimes it seems to be explaining itself
     possible_answers = set()
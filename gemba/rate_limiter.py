@@ -0,0 +1,150 @@
+import asyncio
+import json
+import threading
+import time
+
+
+def estimate_tokens(prompt, max_tokens=None):
+    """Rough token estimate of a request as counted against a TPM quota.
+
+    Quotas count the prompt plus the requested completion budget; four characters
+    per token is the usual rule of thumb for English text.
+    """
+    if isinstance(prompt, list):
+        prompt = json.dumps(prompt, ensure_ascii=False)
+    return len(prompt) // 4 + 1 + (max_tokens or 0)
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_after(headers):
+    retry_after = _parse_float(headers.get("retry-after-ms"))
+    if retry_after is not None:
+        return retry_after / 1000
+    return _parse_float(headers.get("retry-after"))
+
+
+class RateLimiter:
+    """Client-side token buckets for the requests-per-minute (RPM) and
+    tokens-per-minute (TPM) quota of a single deployment.
+
+    Each request reserves capacity before it is sent and waits when the bucket is
+    empty. The budgeted buckets are lowered to the `x-ratelimit-remaining-*`
+    response headers, which GptApi only reads when a budget is set, and a
+    `retry-after` header (also of a 429 error) pauses all requests to the
+    deployment. The limiter is safe to share between threads and asyncio tasks.
+    """
+
+    def __init__(self, rpm=None, tpm=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm) if rpm else 0.0
+        self._tokens = float(tpm) if tpm else 0.0
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._consecutive_rate_limits = 0
+        self._lock = threading.Lock()
+
+        # statistics reported at the end of a run
+        self.requests = 0
+        self.throttled = 0
+        self.rate_limited = 0
+        self.wait_time = 0.0
+
+    def _refill(self, now):
+        elapsed = now - self._updated
+        self._updated = now
+        if self.rpm:
+            self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60)
+
+    def _wait(self, now, tokens):
+        # how long a request of `tokens` has to wait for the buckets, called with the lock held
+        wait = max(0.0, self._blocked_until - now)
+        if self.rpm and self._requests < 1:
+            wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+        if self.tpm and self._tokens < min(tokens, self.tpm):
+            wait = max(wait, (min(tokens, self.tpm) - self._tokens) * 60 / self.tpm)
+        return wait
+
+    def delay(self, tokens=0):
+        """How long a request would have to wait now, without reserving anything;
+        lets a scheduler work on other deployments while this one is throttled."""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            return self._wait(now, tokens)
+
+    def _reserve(self, tokens):
+        # returns how long the caller has to wait before sending the request; the
+        # capacity is reserved immediately so concurrent callers queue up behind it
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            wait = self._wait(now, tokens)
+            if self.rpm:
+                self._requests -= 1
+            if self.tpm:
+                self._tokens -= min(tokens, self.tpm)
+
+            self.requests += 1
+            if wait > 0:
+                self.throttled += 1
+                self.wait_time += wait
+            return wait
+
+    def acquire(self, tokens=0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=0):
+        wait = self._reserve(tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def update_from_headers(self, headers):
+        """Adapt the buckets to the quota state reported by the server."""
+        if headers is None:
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+
+            # the server is authoritative when it has less capacity left than we think
+            remaining = _parse_float(headers.get("x-ratelimit-remaining-requests"))
+            if remaining is not None and self.rpm:
+                self._requests = min(self._requests, remaining)
+            remaining = _parse_float(headers.get("x-ratelimit-remaining-tokens"))
+            if remaining is not None and self.tpm:
+                self._tokens = min(self._tokens, remaining)
+
+            retry_after = _retry_after(headers)
+            if retry_after is not None:
+                self._blocked_until = max(self._blocked_until, now + retry_after)
+
+    def record_success(self, headers=None):
+        self._consecutive_rate_limits = 0
+        self.update_from_headers(headers)
+
+    def record_rate_limit(self, headers=None):
+        """Register a 429 response; pauses the deployment for `retry-after` or an
+        exponential backoff when the server does not say how long to wait."""
+        with self._lock:
+            self.rate_limited += 1
+            self._consecutive_rate_limits += 1
+            if headers is None or _retry_after(headers) is None:
+                backoff = min(2 ** (self._consecutive_rate_limits - 1), 60)
+                self._blocked_until = max(self._blocked_until, time.monotonic() + backoff)
+        self.update_from_headers(headers)
+
+    def summary(self):
+        return (f"{self.requests} requests, {self.throttled} throttled client-side "
+                f"({self.wait_time:.1f}s waiting), {self.rate_limited} rate limit errors (429)")
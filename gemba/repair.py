@@ -0,0 +1,89 @@
+import json
+import re
+
+# Local repair of answers that do not parse, tried before another API call is
+# spent on the segment.
+
+_CODE_FENCE = re.compile(r"```[a-zA-Z]*\s*(.*?)\s*```", re.DOTALL)
+_EMPHASIS = re.compile(r"(\*\*|__)(.+?)\1")
+_CLOSERS = {"{": "}", "[": "]"}
+
+
+def close_unterminated_json(text):
+    """Close the open objects and arrays of JSON that ends without them, e.g.
+    `{"score": 85` or a list of errors without the closing brackets.
+
+    Only text that stops right after a complete value is closed, so nothing is
+    guessed; answers cut off by max_tokens are requested again instead, as the
+    missing part could change the score. Returns None when the text is not
+    unterminated JSON.
+    """
+    text = text.strip()
+    if not text.startswith(("{", "[")):
+        return None
+
+    stack = []
+    in_string = escaped = False
+    for char in text:
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in _CLOSERS:
+            stack.append(char)
+        elif char in "}]":
+            if not stack or _CLOSERS[stack.pop()] != char:
+                return None
+
+    if in_string or not stack or not re.search(r'[}\]"\w]$', text):
+        return None
+    closed = text + "".join(_CLOSERS[c] for c in reversed(stack))
+    try:
+        json.loads(closed)
+    except json.JSONDecodeError:
+        return None
+    return closed
+
+
+def _first_json(text):
+    # first complete JSON object embedded in prose
+    decoder = json.JSONDecoder()
+    for match in re.finditer(r"[{\[]", text):
+        try:
+            _, end = decoder.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            continue
+        return text[match.start():end]
+    return None
+
+
+def repair_candidates(answer):
+    """Repaired variants of an answer that did not parse, in the order they are
+    tried: the content of a markdown code block, the text without markdown
+    emphasis, a JSON object embedded in the text and closed unterminated JSON."""
+    if not isinstance(answer, str):
+        return []
+
+    candidates = []
+    fenced = _CODE_FENCE.search(answer)
+    if fenced:
+        candidates.append(fenced.group(1))
+    candidates.append(_EMPHASIS.sub(r"\2", answer))
+    for text in (fenced.group(1) if fenced else answer, answer):
+        embedded = _first_json(text)
+        if embedded is not None:
+            candidates.append(embedded)
+        closed = close_unterminated_json(text)
+        if closed is not None:
+            candidates.append(closed)
+
+    unique = []
+    for candidate in candidates:
+        if candidate != answer and candidate not in unique:
+            unique.append(candidate)
+    return unique
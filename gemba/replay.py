@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+from gemba.http_json import JSONRequestHandler
+
+logger = logging.getLogger(__name__)
+
+# Record and replay of the API traffic. A Recorder passed to GptApi logs every
+# chat completion call with its parameters, response (or error) and observed
+# latency as one JSON line. The replay server serves such a log as an
+# OpenAI-compatible endpoint, at the recorded latencies or sped up, so that the
+# full scoring pipeline can be benchmarked offline and reproducibly:
+#
+#     gemba --record_file traffic.jsonl ...            # live run, recorded
+#     gemba replay --replay_log traffic.jsonl --port 8001
+#     gemba --base_url http://127.0.0.1:8001 ...       # replayed run
+
+# parameters that identify a request; the client-specific ones (n, penalties,
+# response_format) differ between the OpenAI client and a custom base_url
+REPLAY_KEY_PARAMETERS = ("model", "messages", "temperature", "top_p", "logprobs", "top_logprobs",
+                         "max_tokens", "max_completion_tokens")
+
+
+def replay_key(parameters):
+    """Key of a chat completion request, shared by the recording and the replay."""
+    canonical = {name: parameters[name] for name in REPLAY_KEY_PARAMETERS if parameters.get(name) is not None}
+    if "max_completion_tokens" in canonical:
+        canonical["max_tokens"] = canonical.pop("max_completion_tokens")
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class Recorder:
+    """Appends the API calls of a GptApi to a JSONL log. Safe to share between
+    threads and event loops."""
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = 0
+        self._fh = open(path, "a")
+        self._lock = threading.Lock()
+
+    def record(self, parameters, latency, response=None, error=None):
+        entry = {"key": replay_key(parameters), "request": parameters, "latency": latency}
+        if error is None:
+            entry["status"] = 200
+            entry["response"] = response.model_dump(mode="json")
+        else:
+            entry["status"] = getattr(error, "status_code", None) or 500
+            entry["error"] = {"message": str(error), "type": type(error).__name__, "code": getattr(error, "code", None)}
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        with self._lock:
+            self._fh.write(line)
+            self._fh.flush()
+            self.calls += 1
+
+    def call(self, parameters, create):
+        started = time.monotonic()
+        try:
+            response = create()
+        except Exception as e:
+            self.record(parameters, time.monotonic() - started, error=e)
+            raise
+        self.record(parameters, time.monotonic() - started, response=response)
+        return response
+
+    async def call_async(self, parameters, create):
+        started = time.monotonic()
+        try:
+            response = await create()
+        except Exception as e:
+            self.record(parameters, time.monotonic() - started, error=e)
+            raise
+        self.record(parameters, time.monotonic() - started, response=response)
+        return response
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ReplayLog:
+    """Recorded calls by request key. Repeated requests are answered with the
+    recorded calls in order (e.g. a rate limit error and then the answer), the
+    last one is repeated once they run out."""
+
+    def __init__(self, path):
+        self.entries = {}
+        self._served = {}
+        self._lock = threading.Lock()
+        with open(path, "r") as fh:
+            for line in fh:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries.setdefault(entry["key"], []).append(entry)
+
+    def __len__(self):
+        return sum(len(entries) for entries in self.entries.values())
+
+    def next(self, parameters):
+        """The recorded call to answer a request with, None when it was not recorded."""
+        key = replay_key(parameters)
+        with self._lock:
+            entries = self.entries.get(key)
+            if entries is None:
+                return None
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+            return entries[min(served, len(entries) - 1)]
+
+
+class ReplayHandler(JSONRequestHandler):
+    # errors reach GptApi as they were recorded, without the client retrying them first
+    json_headers = {"x-should-retry": "false"}
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        parameters = json.loads(self.rfile.read(length))
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}", "type": "not_found"}})
+            return
+
+        entry = self.server.log.next(parameters)
+        if entry is None:
+            self.server.misses += 1
+            self._send_json(404, {"error": {"message": "No recorded response for this request.", "type": "not_found"}})
+            return
+
+        if self.server.speed > 0:
+            time.sleep(entry["latency"] / self.server.speed)
+        if entry["status"] == 200:
+            self._send_json(200, entry["response"])
+        else:
+            self._send_json(entry["status"], {"error": entry["error"]})
+
+
+def make_replay_server(log_path, host="127.0.0.1", port=8001, speed=1.0):
+    """OpenAI-compatible server answering with the calls recorded in `log_path`.
+
+    The recorded latency is divided by `speed`, e.g. 10 replays ten times
+    faster; 0 answers right away.
+    """
+    server = ThreadingHTTPServer((host, port), ReplayHandler)
+    server.daemon_threads = True
+    server.log = ReplayLog(log_path)
+    server.speed = speed
+    server.misses = 0
+    return server
+
+
+def serve_replay(log_path, host="127.0.0.1", port=8001, speed=1.0):
+    """Run the replay server until interrupted."""
+    server = make_replay_server(log_path, host, port, speed)
+    print(f"Replaying {len(server.log)} recorded calls on http://{host}:{server.server_port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.misses:
+            print(f"{server.misses} requests were not recorded", file=sys.stderr)
@@ -0,0 +1,80 @@
+import threading
+
+from gemba.rate_limiter import estimate_tokens
+
+
+class RetryPolicy:
+    """Limits on the API calls spent on a single segment.
+
+    A segment whose answers do not parse is requested again at increasing
+    temperatures up to `max_temperature` (in tenths), and a truncated answer is
+    continued, or requested again with max_tokens doubled up to
+    `max_completion_tokens`. Every such call counts against `max_calls`, and the
+    estimated tokens of the calls against `max_tokens` (None for no token
+    limit). Cached answers are free.
+    """
+
+    def __init__(self, max_calls=6, max_tokens=None, max_temperature=10, max_completion_tokens=4096):
+        self.max_calls = max_calls
+        self.max_tokens = max_tokens
+        self.max_temperature = max_temperature
+        self.max_completion_tokens = max_completion_tokens
+
+    def budget(self):
+        return RetryBudget(self)
+
+
+class RetryBudget:
+    """API calls and estimated tokens spent on one segment so far."""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.calls = 0
+        self.tokens = 0
+
+    def allows(self, prompt, max_tokens=None):
+        """Whether another call with this prompt fits into the budget; the first
+        call of a segment is always allowed."""
+        if self.calls == 0:
+            return True
+        if self.calls >= self.policy.max_calls:
+            return False
+        if self.policy.max_tokens is not None and self.tokens + estimate_tokens(prompt, max_tokens) > self.policy.max_tokens:
+            return False
+        return True
+
+    def spend(self, prompt, max_tokens=None):
+        self.calls += 1
+        self.tokens += estimate_tokens(prompt, max_tokens)
+
+
+class TruncationStats:
+    """Cost of responses cut off by max_tokens, reported at the end of a run."""
+
+    def __init__(self):
+        self.truncations = 0
+        self.continuations = 0
+        self.resent_tokens = 0
+        self.regenerations = 0
+        self.discarded_tokens = 0
+        self._lock = threading.Lock()
+
+    def record_continuation(self, prompt_tokens):
+        with self._lock:
+            self.truncations += 1
+            self.continuations += 1
+            self.resent_tokens += prompt_tokens
+
+    def record_regeneration(self, completion_tokens):
+        with self._lock:
+            self.truncations += 1
+            self.regenerations += 1
+            self.discarded_tokens += completion_tokens
+
+    def record_failure(self):
+        with self._lock:
+            self.truncations += 1
+
+    def summary(self):
+        return (f"{self.truncations} truncated responses, {self.continuations} continued (~{self.resent_tokens} prompt tokens resent), "
+                f"{self.regenerations} regenerated with a larger max_tokens (~{self.discarded_tokens} completion tokens discarded)")
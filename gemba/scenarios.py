@@ -0,0 +1,296 @@
+import json
+import logging
+import sys
+import threading
+
+import pandas as pd
+
+from gemba.cache import GembaCache
+from gemba.gpt_api import GptApi
+from gemba.prompt import language_codes, prompts
+from gemba.scores import Scores
+from gemba.testset import Testset
+from gemba.usage import UsageTracker, usage_labels
+
+logger = logging.getLogger(__name__)
+
+# Declarative scoring runs over models, methods and language pairs. A scenario
+# file lists the endpoints with their budgets and the scenarios to run on them:
+#
+#     {
+#         "testset_path": "mt-metrics-eval-v2",
+#         "endpoints": {
+#             "openai": {"concurrency": 16, "rpm": 500, "tpm": 200000},
+#             "local": {"base_url": "http://127.0.0.1:8000", "concurrency": 4}
+#         },
+#         "scenarios": [
+#             {"model": "gpt-4o", "method": "GEMBA-DA", "endpoint": "openai",
+#              "testsets": [["wmt22", "en-de"], ["wmt22", "zh-en"]]}
+#         ]
+#     }
+#
+# Every (model, method, language pair) is a job. All jobs are scored by one
+# pool of workers, in small chunks of segments: the jobs of an endpoint share
+# its concurrency, the RPM/TPM budget applies to every deployment (model) on it,
+# and a throttled deployment yields its workers to the other jobs. The scores of
+# a job are saved as soon as it is finished.
+
+# endpoint settings, a missing base_url uses the OpenAI/Azure environment variables
+ENDPOINT_SETTINGS = ("base_url", "api_version", "concurrency", "rpm", "tpm")
+
+
+def parse_scenarios(config):
+    """Endpoints (name -> settings) and jobs of a scenario configuration."""
+    endpoints = {}
+    for name, settings in config.get("endpoints", {"default": {}}).items():
+        unknown = set(settings) - set(ENDPOINT_SETTINGS)
+        if unknown:
+            raise ValueError(f"Unknown settings of endpoint {name}: {', '.join(sorted(unknown))}")
+        endpoints[name] = {"base_url": None, "api_version": None, "concurrency": 1, "rpm": None, "tpm": None, **settings}
+
+    testset_path = config.get("testset_path", "mt-metrics-eval-v2")
+    jobs = []
+    for scenario in config["scenarios"]:
+        method = scenario["method"]
+        if method not in prompts:
+            raise ValueError(f"Method {method} not supported, use one of {', '.join(prompts)}")
+        endpoint = scenario.get("endpoint", "default")
+        if endpoint not in endpoints:
+            raise ValueError(f"Scenario {scenario['model']}/{method} uses the unknown endpoint {endpoint}")
+        for dataset, lp in scenario["testsets"]:
+            jobs.append(Job(scenario["model"], method, dataset, lp, endpoint, testset_path))
+    return endpoints, jobs
+
+
+def load_scenarios(path):
+    with open(path, "r") as fh:
+        return parse_scenarios(json.load(fh))
+
+
+class Job:
+    """Scoring of one language pair with one model and method."""
+
+    def __init__(self, model, method, dataset, lp, endpoint="default", testset_path="mt-metrics-eval-v2"):
+        self.model = model
+        self.method = method
+        self.dataset = dataset
+        self.lp = lp
+        self.endpoint = endpoint
+        self.testset_path = testset_path
+
+        self.name = f"{method}_{model}"
+        self.testset = None
+        self.scores = None
+
+        # scheduling state of the ScenarioRunner
+        self.items = None
+        self.answer_cache = None
+        self.lock = threading.Lock()
+        # prompt -> (system, hypothesis_index) of the segments waiting for its answer
+        self.inflight = {}
+        self.coalesced = 0
+        self.outstanding = 0
+        self.scored = 0
+        self.exhausted = False
+        self.finished = False
+        self.error = None
+
+    def __repr__(self):
+        return f"{self.name} on {self.dataset}/{self.lp}"
+
+    def open(self):
+        self.testset = Testset(self.testset_path, self.dataset, self.lp)
+        refname = self.testset.main_ref if prompts[self.method]["use_ref"] else None
+        self.scores = Scores(self.name, self.testset, refname)
+
+    def cache(self, cache_dir="cache"):
+        return GembaCache(f"{cache_dir}/{self.model}_{self.method}")
+
+    def pending(self, systems=None):
+        """(system, hypothesis_index, prompt) of the segments that are not scored yet."""
+        source_lang, target_lang = (language_codes[code] for code in self.lp.split("-"))
+        rows = self.testset.iterate_over_all(self.scores.refname, systems)
+        for hypothesis_index, (src, hyp, ref, system) in enumerate(rows):
+            if self.scores.get_score(system, hypothesis_index) is not None:
+                continue
+            data = {
+                "source_seg": src,
+                "target_seg": hyp,
+                "reference_seg": ref,
+                "source_lang": source_lang,
+                "target_lang": target_lang,
+            }
+            yield system, hypothesis_index, prompts[self.method]["prompt"].format(**data)
+
+
+class ScenarioRunner:
+    """Runs all jobs on one shared pool of worker threads.
+
+    A worker takes the next chunk of pending segments of the first job that
+    can go on: its endpoint has a free slot of its `concurrency` and the rate
+    limiter of its deployment (the model on the endpoint) is not throttled. So
+    the jobs of a throttled deployment yield to the others instead of blocking
+    a worker. A chunk is requested with `GptApi.bulk_request_grouped`, which
+    reads its cached answers at once; a prompt that is already in flight for
+    another chunk of the job is not requested again. A job is opened when its
+    first chunk is taken and its scores are saved as soon as its last segment
+    is scored.
+    """
+
+    def __init__(self, endpoints, jobs, usage=None, recorder=None, systems=None, cache_dir="cache", workers=None, chunk_size=16):
+        self.endpoints = endpoints
+        self.jobs = jobs
+        self.usage = usage or UsageTracker()
+        self.recorder = recorder
+        self.systems = systems
+        self.cache_dir = cache_dir
+        # enough workers to use the concurrency of all endpoints at once
+        self.workers = workers or sum(settings["concurrency"] for settings in endpoints.values())
+        self.chunk_size = chunk_size
+
+        self.gptapis = {}
+        self.failed = []
+        self._lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._active = {endpoint: 0 for endpoint in endpoints}
+
+    def gptapi(self, endpoint):
+        """The GptApi of an endpoint, created on first use; its rate limiters are per deployment."""
+        with self._lock:
+            if endpoint not in self.gptapis:
+                settings = self.endpoints[endpoint]
+                self.gptapis[endpoint] = GptApi(api_version=settings["api_version"], base_url=settings["base_url"],
+                                                rpm=settings["rpm"], tpm=settings["tpm"], usage=self.usage, recorder=self.recorder)
+            return self.gptapis[endpoint]
+
+    def run(self):
+        """Run all jobs, returns the jobs that failed."""
+        threads = [threading.Thread(target=self._work, name=f"gemba-scenario-{i}", daemon=True) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for job in self.failed:
+            # the scores assigned so far stay in the journal for the next run
+            if job.scores is not None:
+                job.scores.close()
+        for job in self.jobs:
+            if job.answer_cache is not None:
+                job.answer_cache.close()
+        for gptapi in self.gptapis.values():
+            gptapi.report_rate_limits()
+            gptapi.close()
+        return self.failed
+
+    def _work(self):
+        while True:
+            with self._condition:
+                while True:
+                    if all(job.finished or job.error is not None for job in self.jobs):
+                        return
+                    job = self._next_job()
+                    if isinstance(job, Job):
+                        break
+                    # woken up when a slot is freed, or when a throttled deployment may go on
+                    self._condition.wait(timeout=job)
+
+            # opening the job and reading its segments only hold the lock of the job
+            error = None
+            try:
+                chunk = self._take(job)
+                if len(chunk) > 0:
+                    self._score(job, chunk)
+            except Exception as e:
+                error = e
+            self._release(job, error)
+
+    def _next_job(self):
+        # called with the condition held; returns the job a slot of its endpoint
+        # is taken for, or the seconds to wait until a throttled job may go on
+        wait = 1.0
+        for job in self.jobs:
+            if job.finished or job.error is not None or job.exhausted:
+                continue
+            if self._active[job.endpoint] >= self.endpoints[job.endpoint]["concurrency"]:
+                continue
+            try:
+                delay = self.gptapi(job.endpoint).get_rate_limiter(job.model).delay()
+            except Exception as e:
+                self._fail(job, e)
+                continue
+            if delay > 0:
+                wait = min(wait, delay)
+                continue
+
+            self._active[job.endpoint] += 1
+            job.outstanding += 1
+            return job
+        return wait
+
+    def _take(self, job):
+        # the prompts of the next chunk of pending segments, empty once there is none left
+        with job.lock:
+            if job.items is None:
+                job.open()
+                job.answer_cache = job.cache(self.cache_dir)
+                job.items = job.pending(self.systems)
+                print(f"Scoring {job.name} on {job.dataset}/{job.lp} ({job.endpoint})", file=sys.stderr)
+
+            chunk = []
+            while len(chunk) < self.chunk_size:
+                item = next(job.items, None)
+                if item is None:
+                    job.exhausted = True
+                    break
+                system, hypothesis_index, prompt = item
+                if prompt in job.inflight:
+                    # the same hypothesis of another system, scored with the answer in flight
+                    job.inflight[prompt].append((system, hypothesis_index))
+                    job.coalesced += 1
+                    continue
+                job.inflight[prompt] = [(system, hypothesis_index)]
+                chunk.append(prompt)
+            return chunk
+
+    def _fail(self, job, error):
+        # called with the condition held, the other jobs go on
+        logger.error("Job %s failed: %s", job, error, exc_info=error)
+        job.error = error
+        self.failed.append(job)
+
+    def _score(self, job, chunk):
+        df = pd.DataFrame({"prompt": chunk})
+        with usage_labels(method=job.method, lang_pair=job.lp):
+            answers = self.gptapi(job.endpoint).bulk_request_grouped(df, job.model, prompts[job.method]["validate_answer"],
+                                                                     cache=job.answer_cache, report=False)
+        with job.lock:
+            for prompt, parsed_answers in zip(chunk, answers):
+                for system, hypothesis_index in job.inflight.pop(prompt):
+                    job.scores.assign_score(system, hypothesis_index, parsed_answers[0]["answer"], parsed_answers[0]["temperature"])
+                    job.scored += 1
+
+    def _release(self, job, error=None):
+        # gives back the slot of a taken chunk, the last one of a job saves it
+        with self._condition:
+            self._active[job.endpoint] -= 1
+            job.outstanding -= 1
+            if error is not None and job.error is None:
+                self._fail(job, error)
+            finish = job.exhausted and job.outstanding == 0 and job.error is None and not job.finished
+            if finish:
+                job.finished = True
+            self._condition.notify_all()
+        if finish:
+            self._finish(job)
+
+    def _finish(self, job):
+        try:
+            with job.lock:
+                job.scores.save()
+            self.usage.write(job.scores.get_usage_path(), model=job.model, method=job.method, lang_pair=job.lp)
+        except Exception as e:
+            with self._condition:
+                self._fail(job, e)
+        print(f"Scored {job.scored}/{job.testset.segments_count()} hypotheses for {job.name} "
+              f"on {job.dataset}/{job.lp} ({job.endpoint}), {job.coalesced} identical prompts coalesced", file=sys.stderr)
@@ -0,0 +1,99 @@
+import os
+import threading
+
+from gemba.cache import GembaCache
+from gemba.cascade import cascade_segments
+from gemba.gpt_api import GptApi
+from gemba.usage import usage_labels
+from gemba.utils import score_segments
+
+
+class Scorer:
+    """Long-lived GEMBA scorer for repeated small scoring calls.
+
+    The API client with its HTTP connection pool and the answer cache of every
+    method are created once and reused by all `score` calls. A Scorer can be
+    shared between threads; `max_inflight` bounds the API calls in flight of
+    all their concurrent calls together.
+
+        with Scorer("gpt-4") as scorer:
+            scores = scorer.score(source, hypothesis, "English", "Czech", "GEMBA-MQM")
+    """
+
+    def __init__(self, model, api_version=None, base_url=None, rpm=None, tpm=None,
+                 cache_dir="cache", use_structured_output=True, concurrency=1, draft_model=None, draft_base_url=None,
+                 retry_policy=None, usage=None, recorder=None, max_inflight=None):
+        self.model = model
+        self.cache_dir = cache_dir
+        self.use_structured_output = use_structured_output
+        self.concurrency = concurrency
+        self.gptapi = GptApi(api_version=api_version, base_url=base_url, rpm=rpm, tpm=tpm, retry_policy=retry_policy, usage=usage,
+                            recorder=recorder, max_inflight=max_inflight)
+        self.usage = self.gptapi.usage
+        self._caches = {}
+        self._lock = threading.Lock()
+
+        # cascade mode, segments are scored by the draft model first (see gemba.cascade)
+        self.draft = None
+        if draft_model is not None:
+            self.draft = Scorer(draft_model, api_version=api_version, base_url=draft_base_url or base_url, cache_dir=cache_dir,
+                                use_structured_output=use_structured_output, concurrency=concurrency, retry_policy=retry_policy,
+                                usage=self.usage, recorder=recorder, max_inflight=max_inflight)
+
+    def cache(self, method):
+        """Answer cache of a method, opened on first use."""
+        with self._lock:
+            if method not in self._caches:
+                self._caches[method] = GembaCache(os.path.join(self.cache_dir, f"{self.model}_{method}"))
+            return self._caches[method]
+
+    def score_segments(self, source, hypothesis, source_lang, target_lang, method,
+                       list_mqm_errors=False, reference=None, concurrency=None,
+                       batch=None, batch_file="batch_requests.jsonl", batch_results=None, pack_size=1, escalation=None,
+                       use_logprobs=False):
+        """Full parsed answer (answer, temperature, finish_reason, ...) of every segment.
+
+        In cascade mode the answers also carry the "escalation" reason, None for
+        segments answered by the draft model; `escalation` overrides the
+        thresholds of `gemba.cascade.escalation_settings`.
+        """
+        scoring_args = dict(
+            source_lang=source_lang, target_lang=target_lang, list_mqm_errors=list_mqm_errors,
+            concurrency=self.concurrency if concurrency is None else concurrency,
+            batch=batch, batch_file=batch_file, batch_results=batch_results, pack_size=pack_size, use_logprobs=use_logprobs,
+        )
+        if self.draft is None:
+            return self._score_segments(source, hypothesis, method=method, reference=reference, **scoring_args)
+        return cascade_segments(self.draft._score_segments, self._score_segments, source, hypothesis, method,
+                                self.draft.model, self.model, escalation=escalation, reference=reference, **scoring_args)
+
+    def _score_segments(self, source, hypothesis, source_lang, target_lang, method, temperature=0, **scoring_args):
+        with usage_labels(method=method, lang_pair=f"{source_lang}-{target_lang}"):
+            return score_segments(
+                self.gptapi, self.cache(method), source, hypothesis, source_lang, target_lang, method, self.model,
+                use_structured_output=self.use_structured_output, temperature=temperature, **scoring_args,
+            )
+
+    def score(self, source, hypothesis, source_lang, target_lang, method, **kwargs):
+        """Score hypotheses with a GEMBA method and return one answer per segment,
+        or None when the requests were only exported for the Batch API. Takes the
+        same keyword arguments as `score_segments`."""
+        answers = self.score_segments(source, hypothesis, source_lang, target_lang, method, **kwargs)
+        if answers is None:
+            return None
+        return [answer["answer"] for answer in answers]
+
+    def close(self):
+        with self._lock:
+            for cache in self._caches.values():
+                cache.close()
+            self._caches = {}
+        self.gptapi.close()
+        if self.draft is not None:
+            self.draft.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,10 +1,65 @@
 from pathlib import Path
+import math
 import os
-import pandas as pd
+import time
+
+import numpy as np
+
+from gemba.metrics import SCORES_WRITTEN, stage_timer
+
+
+def _read_rows(path):
+    # (system, value) rows of a two-column TSV file
+    rows = []
+    if os.path.isfile(path):
+        with open(path, "r") as fh:
+            for line in fh:
+                line = line.rstrip("\n")
+                if line:
+                    system, value = line.split("\t")
+                    rows.append((system, value))
+    return rows
+
+
+def _parse_value(value):
+    if value in ("None", "nan", "NaN", ""):
+        return math.nan
+    return float(value)
+
+
+def _format_value(value):
+    # missing values are written as None, scores as floats like the pandas files before
+    return "None" if math.isnan(value) else repr(float(value))
+
+
+def _format_mean(value):
+    return "None" if math.isnan(value) else repr(float(value))
+
+
+def _means(scores, groups, group_count):
+    # mean of the non-missing scores of every group, NaN for groups without any
+    present = ~np.isnan(scores)
+    sums = np.bincount(groups[present], weights=scores[present], minlength=group_count)
+    counts = np.bincount(groups[present], minlength=group_count)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
 
 
 class Scores:
-    def __init__(self, name, testset, refname, output_path=None):
+    """Segment scores and their temperatures of one metric on a testset.
+
+    The segments of every system are a contiguous block of preallocated arrays,
+    located by a per-system offset table, so that reading and assigning a score
+    is O(1). Missing scores and temperatures are NaN in memory and None in the
+    TSV files.
+
+    Every assigned score is appended to a journal, which `load` replays, and the
+    segment scores are checkpointed atomically every `checkpoint_every` scores or
+    `checkpoint_interval` seconds, so that a crashed run loses no assigned score.
+    The system and domain scores are only computed by `save` at the end.
+    """
+
+    def __init__(self, name, testset, refname, output_path=None, checkpoint_every=1000, checkpoint_interval=60):
         self.name = name
         self.testset = testset
         self.refname = refname
@@ -13,9 +68,18 @@ class Scores:
 
         self.output_path = output_path
 
-        self.seg_scores = None
-        self.metadata = None
+        self.systems = []
+        self.offsets = {}
+        self.segment_count = 0
+        self.scores = None
+        self.temperatures = None
         self.prefix = None
+
+        self.checkpoint_every = checkpoint_every
+        self.checkpoint_interval = checkpoint_interval
+        self._journal = None
+        self._uncheckpointed = 0
+        self._last_checkpoint = time.monotonic()
         self.load()
 
     def load(self):
@@ -27,32 +91,55 @@ class Scores:
         else:
             self.prefix = f"{output_folder}/{self.name}-src"
 
-        seg_scores_file = self.get_seg_path()
-        if os.path.isfile(f"{seg_scores_file}"):
-            self.seg_scores = pd.read_csv(seg_scores_file, sep="\t", names=["system", "score"], index_col=False)
-        else:
-            self.seg_scores = pd.DataFrame(columns=["system", "score"])
+        self.segment_count = len(self.testset.sources)
+        if not self._load_sidecar():
+            self._load_tsv()
+        self._replay_journal()
 
-        if os.path.isfile(f"{self.get_meta_path()}"):
-            self.metadata = pd.read_csv(self.get_meta_path(), sep="\t", names=["system", "temperature"], index_col=False)
-        else:
-            self.metadata = pd.DataFrame(columns=["system", "temperature"])
+    def _allocate(self, systems):
+        # systems keep the order of the existing files, new systems of the testset are appended
+        self.systems = list(dict.fromkeys(list(systems) + list(self.testset.systems.keys())))
+        self.offsets = {system: i * self.segment_count for i, system in enumerate(self.systems)}
+        self.scores = np.full(len(self.systems) * self.segment_count, np.nan)
+        self.temperatures = np.full(len(self.systems) * self.segment_count, np.nan)
+
+    def _load_tsv(self):
+        seg_rows = _read_rows(self.get_seg_path())
+        meta_rows = _read_rows(self.get_meta_path())
+        self._allocate([system for system, _ in seg_rows] + [system for system, _ in meta_rows])
+        self._fill(self.scores, seg_rows)
+        self._fill(self.temperatures, meta_rows)
 
-        # generate placeholders for scores
-        segment_count = len(self.testset.sources)
-        for system in self.testset.systems.keys():
-            if system not in self.seg_scores["system"].values:
-                # generate placeholders for scores
-                placeholder = pd.DataFrame([{"system": system, 'score': 'None'}] * segment_count)
-                self.seg_scores = pd.concat([self.seg_scores, placeholder], ignore_index=True)
+    def _load_sidecar(self):
+        # the binary sidecar is only used when it was written after the TSV files,
+        # which stay the interchange format and may have been edited since
+        path = self.get_sidecar_path()
+        if not os.path.isfile(path):
+            return False
+        sidecar_mtime = os.stat(path).st_mtime_ns
+        for tsv_path in (self.get_seg_path(), self.get_meta_path()):
+            if os.path.isfile(tsv_path) and os.stat(tsv_path).st_mtime_ns > sidecar_mtime:
+                return False
 
-            if system not in self.metadata["system"].values:
-                placeholder = pd.DataFrame([{"system": system, 'temperature': 'None'}] * segment_count)
-                self.metadata = pd.concat([self.metadata, placeholder], ignore_index=True)
+        with np.load(path, allow_pickle=False) as sidecar:
+            if int(sidecar["segment_count"]) != self.segment_count:
+                return False
+            systems = sidecar["systems"].tolist()
+            self._allocate(systems)
+            self.scores[:len(systems) * self.segment_count] = sidecar["scores"]
+            self.temperatures[:len(systems) * self.segment_count] = sidecar["temperatures"]
+        return True
 
-            # check that all systems are present and have correct number of scores
-            assert len(self.seg_scores[self.seg_scores.system == system]) == segment_count
-            assert len(self.metadata[self.metadata.system == system]) == segment_count
+    def _fill(self, values, rows):
+        counts = {}
+        for system, value in rows:
+            position = counts.get(system, 0)
+            counts[system] = position + 1
+            # check that all systems have correct number of scores
+            assert position < self.segment_count, f"{system} has more than {self.segment_count} scores"
+            values[self.offsets[system] + position] = _parse_value(value)
+        for system, count in counts.items():
+            assert count == self.segment_count, f"{system} has {count} scores, expected {self.segment_count}"
 
     def get_seg_path(self):
         return f"{self.prefix}.seg.score"
@@ -66,38 +153,116 @@ class Scores:
     def get_meta_path(self):
         return f"{self.prefix}.seg.meta"
 
+    def get_sidecar_path(self):
+        return f"{self.prefix}.seg.npz"
+
+    def get_journal_path(self):
+        return f"{self.prefix}.seg.journal"
+
+    def get_usage_path(self):
+        return f"{self.prefix}.usage.json"
+
     def _remap_index(self, system, hypothesis_index):
-        # the order of systems may be different
-        # get id of the first hypothesis of the system
-        index = (self.seg_scores["system"] == system).argmax()
-        h = hypothesis_index % len(self.testset.sources)
-        return index + h
+        # hypothesis indices run over the segments of all systems
+        return self.offsets[system] + hypothesis_index % self.segment_count
 
     def get_score(self, system, hypothesis_index):
-        index = self._remap_index(system, hypothesis_index)
-        return self.seg_scores.iloc[index]['score']
+        """Score of a hypothesis, None when it is not scored yet."""
+        score = self.scores[self._remap_index(system, hypothesis_index)]
+        return None if math.isnan(score) else float(score)
 
     def assign_score(self, system, hypothesis_index, answer, temperature=None):
         index = self._remap_index(system, hypothesis_index)
-        self.seg_scores.iloc[index]['score'] = answer
-        self.metadata.iloc[index]['temperature'] = temperature
+        self.scores[index] = math.nan if answer is None else answer
+        self.temperatures[index] = math.nan if temperature is None else temperature
+        SCORES_WRITTEN.inc()
+
+        if self._journal is None:
+            self._journal = open(self.get_journal_path(), "a")
+        self._journal.write(f"{system}\t{hypothesis_index % self.segment_count}\t"
+                            f"{_format_value(self.scores[index])}\t{_format_value(self.temperatures[index])}\n")
+        # flushed to the OS right away, so the score survives a crash of the process
+        self._journal.flush()
+
+        self._uncheckpointed += 1
+        if (self._uncheckpointed >= self.checkpoint_every
+                or time.monotonic() - self._last_checkpoint >= self.checkpoint_interval):
+            self.checkpoint()
+
+    def _replay_journal(self):
+        path = self.get_journal_path()
+        if not os.path.isfile(path):
+            return
+        with open(path, "r") as fh:
+            for line in fh:
+                fields = line.rstrip("\n").split("\t")
+                # the last line is incomplete when the run crashed while writing it
+                if not line.endswith("\n") or len(fields) != 4 or fields[0] not in self.offsets:
+                    continue
+                index = self.offsets[fields[0]] + int(fields[1])
+                self.scores[index] = _parse_value(fields[2])
+                self.temperatures[index] = _parse_value(fields[3])
+
+    def checkpoint(self):
+        """Atomically write the segment scores and their metadata and start a new
+        journal; the system and domain scores are left to `save`."""
+        with stage_timer("persist"):
+            self._write_segments()
+            self.close()
+            # the journaled scores are in the checkpoint now, replaying them again would be harmless
+            if os.path.isfile(self.get_journal_path()):
+                os.remove(self.get_journal_path())
+        self._uncheckpointed = 0
+        self._last_checkpoint = time.monotonic()
 
     def save(self):
-        # segment level scores
-        self.seg_scores.to_csv(self.get_seg_path(), sep="\t", index=False, header=False, na_rep="None")
-
-        # system scores
-        self.seg_scores.score = self.seg_scores.score.replace("None", None).astype(float)
-        sys_scores_df = self.seg_scores.groupby(['system'], as_index=False, dropna=True).mean()
-        sys_scores_df.to_csv(self.get_sys_path(), sep="\t", index=False, header=False, na_rep="None")
-
-        # domain scores
-        df = self.seg_scores.copy()
-        documents = self.testset.documents
-        total_systems = len(self.testset.systems)
-        df["domains"] = pd.DataFrame([x.split("\t")[0] for x in documents] * total_systems)[0]
-        df = df.groupby(["domains", 'system'], as_index=False, dropna=True).mean()
-        df.to_csv(self.get_domain_path(), sep="\t", index=False, header=False, na_rep="None")
-
-        # metadata
-        self.metadata.to_csv(self.get_meta_path(), sep="\t", index=False, header=False, na_rep="None")
+        self.checkpoint()
+        with stage_timer("persist"):
+            self._save_aggregates()
+
+    def close(self):
+        # the journal keeps the scores assigned since the last checkpoint for the next load
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def _write(self, path, rows):
+        # written to a temporary file and renamed, so that a crash never leaves a partial file
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as fh:
+            fh.writelines("\t".join(row) + "\n" for row in rows)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, path)
+
+    def _write_segments(self):
+        row_systems = np.repeat(np.arange(len(self.systems)), self.segment_count).tolist()
+        self._write(self.get_seg_path(), ((self.systems[s], _format_value(v)) for s, v in zip(row_systems, self.scores.tolist())))
+        self._write(self.get_meta_path(), ((self.systems[s], _format_value(v)) for s, v in zip(row_systems, self.temperatures.tolist())))
+
+        # binary copy for a fast load, written last so that it is newer than the TSV files
+        tmp_path = f"{self.get_sidecar_path()}.tmp"
+        with open(tmp_path, "wb") as fh:
+            np.savez(fh, systems=np.array(self.systems, dtype=str), segment_count=self.segment_count,
+                     scores=self.scores, temperatures=self.temperatures)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, self.get_sidecar_path())
+
+    def _save_aggregates(self):
+        row_systems = np.repeat(np.arange(len(self.systems)), self.segment_count)
+
+        # system scores, sorted by system name
+        means = _means(self.scores, row_systems, len(self.systems))
+        order = sorted(range(len(self.systems)), key=lambda s: self.systems[s])
+        self._write(self.get_sys_path(), ((self.systems[s], _format_mean(means[s])) for s in order))
+
+        # domain scores, sorted by domain and system name
+        domains = [x.split("\t")[0] for x in self.testset.documents]
+        domain_names = sorted(set(domains))
+        domain_index = {name: i for i, name in enumerate(domain_names)}
+        domain_ids = np.array([domain_index[d] for d in domains], dtype=np.int64)
+        groups = np.tile(domain_ids, len(self.systems)) * len(self.systems) + row_systems
+        means = _means(self.scores, groups, len(domain_names) * len(self.systems))
+        self._write(self.get_domain_path(), ((domain_names[d], self.systems[s], _format_mean(means[d * len(self.systems) + s]))
+                                             for d in range(len(domain_names)) for s in order))
@@ -0,0 +1,289 @@
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import ThreadingHTTPServer
+
+from gemba.http_json import JSONRequestHandler
+from gemba.metrics import REGISTRY
+from gemba.prompt import prompts
+from gemba.scorer import Scorer
+
+logger = logging.getLogger(__name__)
+
+# Long-running scoring service. Segments of all incoming requests are queued,
+# collected into micro-batches and scored through one Scorer per model, so that
+# concurrent small requests share the concurrent API path and the disk caches.
+# Results are streamed back as one JSON line per segment.
+
+METHODS = ["GEMBA-MQM", "GEMBA-ESA", *prompts.keys()]
+
+
+class Overloaded(Exception):
+    """The service has more segments queued than `max_pending`."""
+
+
+class ScoringService:
+    """Queue and micro-batcher in front of one Scorer per model.
+
+    A batch is dispatched once `max_batch_size` segments are queued or the
+    oldest queued segment has waited `max_wait` seconds. Segments of one batch
+    that share the model, method and languages are scored by a single call.
+    Batches are scored by up to `concurrency` workers, so that a slow batch
+    does not hold up the next ones, and the API calls of all batches of a model
+    together stay within `concurrency`.
+    """
+
+    def __init__(self, model, api_version=None, base_url=None, rpm=None, tpm=None, cache_dir="cache",
+                 use_structured_output=True, concurrency=1, max_batch_size=64, max_wait=0.05,
+                 max_pending=10000, max_request_segments=1000, retry_policy=None):
+        self.model = model
+        self.scorer_args = dict(api_version=api_version, base_url=base_url, rpm=rpm, tpm=tpm, cache_dir=cache_dir,
+                                use_structured_output=use_structured_output, concurrency=concurrency, retry_policy=retry_policy,
+                                max_inflight=concurrency)
+        self.concurrency = concurrency
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.max_request_segments = max_request_segments
+
+        self._scorers = {}
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._workers = None
+        self.started = time.monotonic()
+
+        # statistics served on /metrics
+        self.pending = 0
+        self.requests = 0
+        self.rejected_requests = 0
+        self.scored_segments = 0
+        self.failed_segments = 0
+        self.batches = 0
+
+    def scorer(self, model):
+        with self._lock:
+            if model not in self._scorers:
+                self._scorers[model] = Scorer(model, **self.scorer_args)
+            return self._scorers[model]
+
+    def start(self):
+        self._workers = ThreadPoolExecutor(max_workers=max(1, self.concurrency), thread_name_prefix="gemba-batch")
+        self._thread = threading.Thread(target=self._dispatch, name="gemba-dispatch", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._workers is not None:
+            # the batches already dispatched are finished
+            self._workers.shutdown(wait=True)
+            self._workers = None
+        with self._lock:
+            for scorer in self._scorers.values():
+                scorer.close()
+            self._scorers = {}
+
+    def submit(self, job):
+        """Queue the segments of a scoring request and return one Future per segment.
+
+        Raises ValueError for a malformed request and Overloaded when the queue
+        is full.
+        """
+        model = job.get("model") or self.model
+        method = job.get("method", "GEMBA-MQM")
+        segments = job.get("segments")
+        if method not in METHODS:
+            raise ValueError(f"Method {method} not supported.")
+        if not job.get("source_lang") or not job.get("target_lang"):
+            raise ValueError("source_lang and target_lang must be provided.")
+        if not isinstance(segments, list) or not segments:
+            raise ValueError("segments must be a non-empty list.")
+        if len(segments) > self.max_request_segments:
+            raise ValueError(f"At most {self.max_request_segments} segments are accepted per request.")
+        for segment in segments:
+            if not isinstance(segment, dict) or not isinstance(segment.get("source"), str) or not isinstance(segment.get("hypothesis"), str):
+                raise ValueError("Every segment needs a source and a hypothesis string.")
+            if method.endswith("_ref") and not isinstance(segment.get("reference"), str):
+                raise ValueError(f"Method {method} needs a reference for every segment.")
+
+        with self._lock:
+            self.requests += 1
+            if self.pending + len(segments) > self.max_pending:
+                self.rejected_requests += 1
+                raise Overloaded(f"{self.pending} segments are queued.")
+            self.pending += len(segments)
+
+        group = (model, method, job["source_lang"], job["target_lang"], bool(job.get("list_mqm_errors", False)))
+        futures = []
+        for segment in segments:
+            future = Future()
+            self._queue.put((group, segment, future))
+            futures.append(future)
+        return futures
+
+    def _dispatch(self):
+        stop = False
+        while not stop:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._workers.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch):
+        groups = {}
+        for group, segment, future in batch:
+            groups.setdefault(group, []).append((segment, future))
+
+        for (model, method, source_lang, target_lang, list_mqm_errors), items in groups.items():
+            segments = [segment for segment, _ in items]
+            reference = [segment["reference"] for segment in segments] if method.endswith("_ref") else None
+            try:
+                answers = self.scorer(model).score_segments(
+                    [segment["source"] for segment in segments], [segment["hypothesis"] for segment in segments],
+                    source_lang, target_lang, method, list_mqm_errors=list_mqm_errors, reference=reference,
+                )
+            except Exception as e:
+                logger.exception("Scoring a batch of %d segments failed", len(items))
+                for _, future in items:
+                    future.set_exception(e)
+                failed, scored = len(items), 0
+            else:
+                for (_, future), answer in zip(items, answers):
+                    future.set_result(answer)
+                failed, scored = 0, len(items)
+
+            with self._lock:
+                self.pending -= len(items)
+                self.failed_segments += failed
+                self.scored_segments += scored
+        with self._lock:
+            self.batches += 1
+
+    def metrics(self):
+        with self._lock:
+            return {
+                "pending_segments": self.pending,
+                "requests": self.requests,
+                "rejected_requests": self.rejected_requests,
+                "scored_segments": self.scored_segments,
+                "failed_segments": self.failed_segments,
+                "batches": self.batches,
+                "mean_batch_size": (self.scored_segments + self.failed_segments) / self.batches if self.batches else 0,
+                "uptime": time.monotonic() - self.started,
+            }
+
+
+class ScoringHandler(JSONRequestHandler):
+    max_body_size = 16 * 1024 * 1024
+
+    def log_message(self, format, *args):
+        logger.info("%s - %s", self.address_string(), format % args)
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok"})
+        elif self.path == "/metrics":
+            self._send_json(200, self.server.service.metrics())
+        elif self.path == "/metrics/prometheus":
+            body = REGISTRY.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length < 0:
+                raise ValueError
+        except ValueError:
+            self.close_connection = True
+            self._send_json(400, {"error": "Invalid Content-Length header."})
+            return
+        if length > self.max_body_size:
+            self.close_connection = True
+            self._send_json(413, {"error": "Request body too large."})
+            return
+        try:
+            job = json.loads(self.rfile.read(length))
+            if not isinstance(job, dict):
+                raise ValueError("The request body must be a JSON object.")
+            futures = self.server.service.submit(job)
+        except Overloaded as e:
+            self._send_json(503, {"error": str(e)}, headers={"Retry-After": "1"})
+            return
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for index, future in enumerate(futures):
+                try:
+                    answer = future.result()
+                    record = {"index": index, "score": answer["answer"], "temperature": answer["temperature"],
+                              "finish_reason": answer["finish_reason"], "escalations": answer["escalations"]}
+                except Exception as e:
+                    record = {"index": index, "error": str(e)}
+                self._write_chunk((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+            self._write_chunk(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away, its segments are still scored into the cache
+            self.close_connection = True
+
+
+def make_server(service, host="127.0.0.1", port=8000):
+    server = ThreadingHTTPServer((host, port), ScoringHandler)
+    server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(service, host="127.0.0.1", port=8000):
+    """Run the scoring service until interrupted."""
+    server = make_server(service, host, port)
+    service.start()
+    print(f"Serving GEMBA on http://{host}:{server.server_port}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -1,5 +1,82 @@
 import glob
+import mmap
 import os
+import sys
+
+import numpy as np
+
+
+def _index_path(path):
+    # hidden file next to the data, so that it is not listed as a system output
+    folder, name = os.path.split(path)
+    return os.path.join(folder, f".{name}.offsets.npy")
+
+
+def _line_offsets(data):
+    # start of every line plus the end of the file, a last line without a newline included
+    newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n"))
+    offsets = np.concatenate(([0], newlines + 1)).astype(np.int64)
+    if offsets[-1] != len(data):
+        offsets = np.append(offsets, len(data))
+    return offsets
+
+
+def _load_offsets(path, data):
+    """Line offsets of a segment file, cached on disk until the file changes."""
+    index_path = _index_path(path)
+    try:
+        if os.stat(index_path).st_mtime_ns >= os.stat(path).st_mtime_ns:
+            offsets = np.load(index_path, allow_pickle=False)
+            if len(offsets) > 0 and offsets[0] == 0 and offsets[-1] == len(data):
+                return offsets
+    except (OSError, ValueError):
+        pass
+
+    offsets = _line_offsets(data)
+    try:
+        tmp_path = f"{index_path}.tmp"
+        with open(tmp_path, "wb") as fh:
+            np.save(fh, offsets)
+        os.replace(tmp_path, index_path)
+    except OSError:
+        # read-only data, the index is rebuilt on every load
+        pass
+    return offsets
+
+
+class SegmentFile:
+    """Lines of a segment file, memory-mapped and decoded only when accessed.
+
+    Segments are stripped of trailing whitespace as before and interned, so
+    that identical segments of several systems share one string.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as fh:
+            # an empty file cannot be memory-mapped
+            if os.fstat(fh.fileno()).st_size > 0:
+                self._data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._data = b""
+        self._offsets = _load_offsets(path, self._data)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"segment {index} out of range of {self.path}")
+        segment = self._data[self._offsets[index]:self._offsets[index + 1]]
+        return sys.intern(segment.decode("utf-8").rstrip())
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
 
 
 class Testset:
@@ -30,29 +107,38 @@ class Testset:
             self.references[refname] = self.load_segment_files(reffile)
 
         systems = f"{dataset}/system-outputs/{self.lp}"
-        # keep systems in order
-        all_systems = sorted(os.listdir(systems))
+        # keep systems in order, the hidden files are the line indices
+        all_systems = sorted(name for name in os.listdir(systems) if not name.startswith("."))
         for system in all_systems:
             systemname = system.replace(".txt", "")
             self.systems[systemname] = self.load_segment_files(f"{systems}/{system}")
 
         self.documents = self.load_segment_files(f"{dataset}/documents/{self.lp}.docs")
 
-    def iterate_over_all(self, reference=None):
-        for system in self.systems.keys():
-            if reference is None:
-                for src, hyp in zip(self.sources, self.systems[system]):
-                    yield src, hyp, None, system
-            else:
-                for src, hyp, ref in zip(self.sources, self.systems[system], self.references[reference]):
-                    yield src, hyp, ref, system
+    def iterate_over_all(self, reference=None, systems=None, start=0):
+        """Yield (source, hypothesis, reference, system) for the segments of all
+        systems, or only of `systems`, skipping the first `start` of them."""
+        if systems is None:
+            selected = list(self.systems.keys())
+        else:
+            unknown = set(systems) - set(self.systems.keys())
+            if unknown:
+                raise ValueError(f"Unknown systems for {self.dataset}/{self.lp}: {', '.join(sorted(unknown))}")
+            selected = [system for system in self.systems.keys() if system in systems]
+
+        for system in selected:
+            hypotheses = self.systems[system]
+            references = None if reference is None else self.references[reference]
+            count = min(len(self.sources), len(hypotheses), len(references) if references is not None else len(hypotheses))
+            if start >= count:
+                start -= count
+                continue
+            for index in range(start, count):
+                yield self.sources[index], hypotheses[index], None if references is None else references[index], system
+            start = 0
 
     def load_segment_files(self, path):
-        segments = []
-        with open(path, "r") as fh:
-            for line in fh:
-                segments.append(line.rstrip())
-        return segments
+        return SegmentFile(path)
 
     def segments_count(self):
         return len(self.sources)*len(self.systems)
@@ -0,0 +1,143 @@
+import contextlib
+import contextvars
+import json
+import math
+import threading
+import time
+
+# Usage, latency and cost accounting of the API calls. Every call is recorded
+# with the labels (method, language pair) of the scoring run it belongs to;
+# the labels are set with `usage_labels` and travel with the context into
+# asyncio tasks.
+
+# USD per million tokens, override with a JSON file of the same shape (see `load_prices`)
+DEFAULT_PRICES = {
+    "gpt-4": {"input": 30.0, "output": 60.0},
+    "gpt-4-turbo": {"input": 10.0, "output": 30.0},
+    "gpt-4o": {"input": 2.5, "cached_input": 1.25, "output": 10.0},
+    "gpt-4o-mini": {"input": 0.15, "cached_input": 0.075, "output": 0.6},
+    "gpt-4.1": {"input": 2.0, "cached_input": 0.5, "output": 8.0},
+    "gpt-4.1-mini": {"input": 0.4, "cached_input": 0.1, "output": 1.6},
+    "gpt-3.5-turbo": {"input": 0.5, "output": 1.5},
+}
+
+_labels = contextvars.ContextVar("gemba_usage_labels", default={})
+
+
+@contextlib.contextmanager
+def usage_labels(**labels):
+    """Label the API calls made inside the block, e.g. with method and lang_pair."""
+    token = _labels.set({**_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+
+def load_prices(path):
+    with open(path, "r") as fh:
+        return json.load(fh)
+
+
+def _count(usage, name):
+    # token counts are missing from some OpenAI-compatible servers
+    value = getattr(usage, name, None)
+    return value if isinstance(value, int) else 0
+
+
+def _percentile(values, percent):
+    # nearest-rank percentile of sorted values
+    if not values:
+        return None
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+class UsageTracker:
+    """Collects the usage of every API call and aggregates it per model, method
+    and language pair. Safe to share between threads."""
+
+    def __init__(self, prices=None):
+        self.prices = DEFAULT_PRICES if prices is None else prices
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def record(self, model, response, latency, retries=0):
+        """Record a finished API call, `response` is the ChatCompletion."""
+        ended = time.monotonic()
+        usage = getattr(response, "usage", None)
+        prompt_tokens = _count(usage, "prompt_tokens")
+        completion_tokens = _count(usage, "completion_tokens")
+        cached_tokens = _count(getattr(usage, "prompt_tokens_details", None), "cached_tokens")
+        finish_reasons = [str(choice.finish_reason) for choice in response.choices]
+
+        labels = _labels.get()
+        key = (model, labels.get("method"), labels.get("lang_pair"))
+        with self._lock:
+            group = self._groups.setdefault(key, {
+                "calls": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+                "finish_reasons": {}, "latencies": [], "first_started": ended - latency, "last_ended": ended,
+            })
+            group["calls"] += 1
+            group["retries"] += retries
+            group["prompt_tokens"] += prompt_tokens
+            group["completion_tokens"] += completion_tokens
+            group["cached_tokens"] += cached_tokens
+            group["latencies"].append(latency)
+            # wall time of the calls, which overlap when they run concurrently
+            group["first_started"] = min(group["first_started"], ended - latency)
+            group["last_ended"] = max(group["last_ended"], ended)
+            for finish_reason in finish_reasons:
+                group["finish_reasons"][finish_reason] = group["finish_reasons"].get(finish_reason, 0) + 1
+
+    def cost(self, model, prompt_tokens, completion_tokens, cached_tokens):
+        """Estimated cost in USD, or None for a model missing from the price table."""
+        prices = self.prices.get(model)
+        if prices is None:
+            return None
+        cached_price = prices.get("cached_input", prices["input"])
+        return ((prompt_tokens - cached_tokens) * prices["input"] + cached_tokens * cached_price
+                + completion_tokens * prices["output"]) / 1e6
+
+    def summary(self, model=None, method=None, lang_pair=None):
+        """Aggregated usage per model/method/language pair, optionally filtered."""
+        with self._lock:
+            groups = {key: dict(group, latencies=sorted(group["latencies"]), finish_reasons=dict(group["finish_reasons"]))
+                      for key, group in self._groups.items()}
+
+        rows = []
+        for (group_model, group_method, group_lang_pair), group in sorted(groups.items(), key=lambda item: tuple(map(str, item[0]))):
+            if model is not None and model != group_model:
+                continue
+            if method is not None and method != group_method:
+                continue
+            if lang_pair is not None and lang_pair != group_lang_pair:
+                continue
+            latencies = group.pop("latencies")
+            wall_time = group.pop("last_ended") - group.pop("first_started")
+            rows.append({
+                "model": group_model,
+                "method": group_method,
+                "lang_pair": group_lang_pair,
+                **group,
+                "latency_p50": _percentile(latencies, 50),
+                "latency_p95": _percentile(latencies, 95),
+                "latency_p99": _percentile(latencies, 99),
+                "completion_tokens_per_second": group["completion_tokens"] / wall_time if wall_time > 0 else None,
+                "cost": self.cost(group_model, group["prompt_tokens"], group["completion_tokens"], group["cached_tokens"]),
+            })
+        return rows
+
+    def write(self, path, **filters):
+        """Write the summary as JSON, returns the written summary."""
+        rows = self.summary(**filters)
+        costs = [row["cost"] for row in rows]
+        summary = {
+            "groups": rows,
+            "calls": sum(row["calls"] for row in rows),
+            "prompt_tokens": sum(row["prompt_tokens"] for row in rows),
+            "completion_tokens": sum(row["completion_tokens"] for row in rows),
+            "cost": sum(costs) if costs and None not in costs else None,
+        }
+        with open(path, "w") as fh:
+            json.dump(summary, fh, indent=2)
+        return summary
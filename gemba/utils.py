@@ -1,6 +1,7 @@
 import pandas as pd
-import diskcache as dc
-from gemba.gpt_api import GptApi
+from gemba.batch import ingest_batch_results, run_batch
+from gemba.logprobs import SCORE_RANGES, TOP_LOGPROBS, logprob_parser
+from gemba.packing import prefill_packed
 from gemba.gemba_mqm_utils import TEMPLATE_GEMBA_MQM, apply_template, parse_mqm_answer
 from gemba.gemba_esa import TEMPLATE_GEMBA_ESA_ERROR_SPANS, TEMPLATE_GEMBA_ESA_RANKING
 from gemba.prompt import prompts, validate_number
@@ -15,6 +16,41 @@ _ERROR_ITEM_SCHEMA = {
     "additionalProperties": False,
 }
 
+_MQM_ERRORS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "critical": {"type": "array", "items": _ERROR_ITEM_SCHEMA},
+        "major": {"type": "array", "items": _ERROR_ITEM_SCHEMA},
+        "minor": {"type": "array", "items": _ERROR_ITEM_SCHEMA},
+    },
+    "required": ["critical", "major", "minor"],
+    "additionalProperties": False,
+}
+
+
+def _packed_schema(name, properties):
+    """Array variant of a response schema for packed prompts, answers are keyed by segment index."""
+    item = {
+        "type": "object",
+        "properties": {"segment": {"type": "integer"}, **properties},
+        "required": ["segment", *properties.keys()],
+        "additionalProperties": False,
+    }
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": name,
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {"segments": {"type": "array", "items": item}},
+                "required": ["segments"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
 RESPONSE_FORMATS = {
     "score": {
         "type": "json_schema",
@@ -36,23 +72,14 @@ RESPONSE_FORMATS = {
             "strict": True,
             "schema": {
                 "type": "object",
-                "properties": {
-                    "errors": {
-                        "type": "object",
-                        "properties": {
-                            "critical": {"type": "array", "items": _ERROR_ITEM_SCHEMA},
-                            "major": {"type": "array", "items": _ERROR_ITEM_SCHEMA},
-                            "minor": {"type": "array", "items": _ERROR_ITEM_SCHEMA},
-                        },
-                        "required": ["critical", "major", "minor"],
-                        "additionalProperties": False,
-                    },
-                },
+                "properties": {"errors": _MQM_ERRORS_SCHEMA},
                 "required": ["errors"],
                 "additionalProperties": False,
             },
         },
     },
+    "score_array": _packed_schema("score_array_response", {"score": {"type": "integer"}}),
+    "mqm_array": _packed_schema("mqm_array_response", {"errors": _MQM_ERRORS_SCHEMA}),
 }
 
 
@@ -67,38 +94,135 @@ def _get_response_format(method, use_structured_output):
     return None
 
 
+def get_request_settings(method, use_structured_output):
+    """response_format and max_tokens of the requests sent for a GEMBA method."""
+    max_tokens = None if method == "GEMBA-ESA" else 500
+    return _get_response_format(method, use_structured_output), max_tokens
+
+
+def _get_packing(method, use_structured_output):
+    """Template, answer field and response_format used to pack several segments per request."""
+    response_format = None
+    if method == "GEMBA-MQM":
+        if use_structured_output:
+            response_format = RESPONSE_FORMATS["mqm_array"]
+        return TEMPLATE_GEMBA_MQM, "errors", response_format
+    if method.startswith(("GEMBA-DA", "GEMBA-SQM")):
+        if use_structured_output:
+            response_format = RESPONSE_FORMATS["score_array"]
+        return prompts[method]["prompt"], "score", response_format
+    raise Exception(f"Packing is not supported for method {method}.")
+
+
 def get_gemba_scores(source, hypothesis, source_lang, target_lang, method, model,
                      list_mqm_errors=False, api_version=None, use_structured_output=True,
-                     reference=None, base_url=None):
+                     reference=None, base_url=None, concurrency=1, rpm=None, tpm=None,
+                     batch=None, batch_file="batch_requests.jsonl", batch_results=None, pack_size=1,
+                     draft_model=None, draft_base_url=None, escalation=None, use_logprobs=False, retry_policy=None,
+                     usage=None, recorder=None):
+    """Score hypotheses with a GEMBA method and return one answer per segment.
+
+    With `batch="export"` the uncached prompts are only written to `batch_file` in
+    the OpenAI Batch format and None is returned. With `batch="submit"` the job is
+    also submitted and polled, and its results are ingested into the cache before
+    scoring. `batch_results` ingests a result file downloaded after a manual upload.
+
+    With `pack_size` > 1 (GEMBA-MQM, GEMBA-DA and GEMBA-SQM) the uncached segments
+    are first scored `pack_size` at a time in one request; segments missing from a
+    packed answer are requested individually.
+
+    With `draft_model` every segment is first scored by the cheaper draft model
+    (at `draft_base_url` if given) and only uncertain answers are escalated to
+    `model`, see `gemba.cascade` for the `escalation` thresholds.
+
+    With `use_logprobs` (GEMBA-DA, GEMBA-SQM and GEMBA-stars) the score is the
+    expected value of the score token distribution, see `gemba.logprobs`.
+
+    `retry_policy` (a `gemba.retry.RetryPolicy`) limits the API calls and tokens
+    spent on a segment whose answers do not parse or are truncated.
+
+    `usage` (a `gemba.usage.UsageTracker`) collects the tokens, latency and cost
+    of the API calls, and `recorder` (a `gemba.replay.Recorder`) logs them for
+    an offline replay.
+
+    Every call sets up a new client and cache; use `gemba.Scorer` for repeated calls.
+    """
+    from gemba.scorer import Scorer
+
+    with Scorer(model, api_version=api_version, base_url=base_url, rpm=rpm, tpm=tpm,
+                use_structured_output=use_structured_output, concurrency=concurrency,
+                draft_model=draft_model, draft_base_url=draft_base_url, retry_policy=retry_policy, usage=usage,
+                recorder=recorder) as scorer:
+        return scorer.score(
+            source, hypothesis, source_lang, target_lang, method, list_mqm_errors=list_mqm_errors, reference=reference,
+            batch=batch, batch_file=batch_file, batch_results=batch_results, pack_size=pack_size, escalation=escalation,
+            use_logprobs=use_logprobs,
+        )
+
+
+def score_segments(gptapi, cache, source, hypothesis, source_lang, target_lang, method, model,
+                   list_mqm_errors=False, use_structured_output=True, reference=None, concurrency=1,
+                   batch=None, batch_file="batch_requests.jsonl", batch_results=None, pack_size=1, temperature=0,
+                   use_logprobs=False):
+    """Like `get_gemba_scores` with a given GptApi and cache, but returns the full
+    parsed answer (answer, temperature, finish_reason, ...) of every segment.
+    Answers scored with `use_logprobs` also have a "confidence".
+
+    A `temperature` above 0 draws another sample instead of the deterministic answer.
+    """
+    assert batch in (None, "export", "submit"), f"Unknown batch mode {batch}"
+
     df = pd.DataFrame({'source_seg': source, 'target_seg': hypothesis})
     df['source_lang'] = source_lang
     df['target_lang'] = target_lang
     if reference is not None:
         df['reference_seg'] = reference
 
-    cache = dc.Cache(f'cache/{model}_{method}', expire=None, size_limit=int(10e10), cull_limit=0, eviction_policy='none')
-    gptapi = GptApi(api_version=api_version, base_url=base_url)
+    response_format, max_tokens = get_request_settings(method, use_structured_output)
 
-    response_format = _get_response_format(method, use_structured_output)
+    if method == "GEMBA-ESA":
+        # the ranking prompts depend on the error spans, so the two stages cannot be batched together
+        assert batch is None and batch_results is None, "Batch mode is not supported for GEMBA-ESA."
+        assert temperature == 0, "Sampling is not supported for GEMBA-ESA."
+        assert not use_logprobs, "Log-probability scores are not supported for GEMBA-ESA."
+        assert pack_size == 1, "Packing is not supported for GEMBA-ESA."
+        # the ranking request of a segment is linked to its error spans by the segment id
+        stages = [
+            {"render": lambda row, _: apply_template(TEMPLATE_GEMBA_ESA_ERROR_SPANS, row), "parse": lambda x: x},
+            {"render": lambda row, error_spans: apply_template(TEMPLATE_GEMBA_ESA_RANKING, {**row, "error_spans": error_spans["answer"]}),
+             "parse": validate_number},
+        ]
+        answers = gptapi.bulk_request_pipeline(df.to_dict("records"), model, stages, cache=cache, concurrency=concurrency)
+        return [parsed_answers[0] for parsed_answers in answers]
 
     if method == "GEMBA-MQM":
         df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_GEMBA_MQM, x), axis=1)
         parse_answer = lambda x: parse_mqm_answer(x, list_mqm_errors=list_mqm_errors, full_desc=True)
-        answers = gptapi.bulk_request(df, model, parse_answer, cache=cache, max_tokens=500, response_format=response_format)
     elif method in ["GEMBA-DA", "GEMBA-DA_ref", "GEMBA-SQM", "GEMBA-SQM_ref", "GEMBA-stars", "GEMBA-stars_ref", "GEMBA-classes", "GEMBA-classes_ref"]:
         df["prompt"] = df.apply(lambda x: apply_template(prompts[method]['prompt'], x), axis=1)
         parse_answer = prompts[method]["validate_answer"]
-        answers = gptapi.bulk_request(df, model, parse_answer, cache=cache, max_tokens=500, response_format=response_format)
-    elif method == "GEMBA-ESA":
-        df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_GEMBA_ESA_ERROR_SPANS, x), axis=1)
-        parse_answer = lambda x: x
-        error_spans = gptapi.bulk_request(df, model, parse_answer, cache=cache)
-        df['error_spans'] = pd.DataFrame(error_spans)['answer']
-
-        df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_GEMBA_ESA_RANKING, x), axis=1)
-        parse_answer = validate_number
-        answers = gptapi.bulk_request(df, model, parse_answer, cache=cache)
     else:
         raise Exception(f"Method {method} not supported.")
 
-    return list(pd.DataFrame(answers)['answer'])
+    logprobs = None
+    if use_logprobs:
+        assert method in SCORE_RANGES, f"Log-probability scores are not supported for method {method}."
+        assert batch is None and batch_results is None and pack_size == 1, "Log-probability scores cannot be combined with batch mode or packing."
+        parse_answer = logprob_parser(parse_answer, *SCORE_RANGES[method])
+        logprobs = TOP_LOGPROBS
+
+    if batch_results is not None:
+        ingest_batch_results(gptapi, batch_results, df["prompt"], model, cache, max_tokens=max_tokens, response_format=response_format)
+    if batch is not None:
+        run_batch(gptapi, df["prompt"], model, cache, batch_file, submit=batch == "submit", max_tokens=max_tokens, response_format=response_format)
+        if batch == "export":
+            return None
+
+    if pack_size > 1:
+        template, field, packed_response_format = _get_packing(method, use_structured_output)
+        prefill_packed(gptapi, df, template, model, cache, parse_answer, field, pack_size, max_tokens=max_tokens,
+                       response_format=response_format, packed_response_format=packed_response_format, concurrency=concurrency)
+
+    answers = gptapi.bulk_request_grouped(df, model, parse_answer, cache=cache, max_tokens=max_tokens, response_format=response_format,
+                                          concurrency=concurrency, temperature=temperature, logprobs=logprobs)
+    return [parsed_answers[0] for parsed_answers in answers]
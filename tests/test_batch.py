@@ -0,0 +1,106 @@
+"""Tests for gemba.batch against a local stand-in for the Batch API."""
+
+import json
+import os
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+from gemba.batch import ingest_batch_results, run_batch, write_batch_file
+from gemba.cache import GembaCache, request_key
+from gemba.gpt_api import GptApi
+
+
+def run_local_batch(input_path, output_path, answer=lambda body: '{"score": 90}'):
+    """Stand-in for the Batch API: reads the request JSONL and writes a result file."""
+    with open(input_path) as fin, open(output_path, "w") as fout:
+        for i, line in enumerate(fin):
+            request = json.loads(line)
+            body = {
+                "id": f"chatcmpl-{i}",
+                "object": "chat.completion",
+                "created": 0,
+                "model": request["body"]["model"],
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer(request["body"])},
+                    "finish_reason": "stop",
+                }],
+            }
+            result = {
+                "id": f"batch_req_{i}",
+                "custom_id": request["custom_id"],
+                "response": {"status_code": 200, "request_id": str(i), "body": body},
+                "error": None,
+            }
+            fout.write(json.dumps(result) + "\n")
+
+
+@pytest.fixture
+def gpt_api():
+    with patch("openai.OpenAI"):
+        return GptApi()
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return GembaCache(str(tmp_path / "cache"))
+
+
+class TestBatch:
+    def test_export_skips_cached_and_duplicate_prompts(self, gpt_api, cache, tmp_path):
+        cache.set(request_key("gpt-4", 0, "a", max_tokens=500), [{"answer": "1", "finish_reason": "stop"}])
+        path = tmp_path / "requests.jsonl"
+
+        count = write_batch_file(gpt_api, ["a", "b", "b", "c"], "gpt-4", cache, str(path), max_tokens=500)
+
+        lines = [json.loads(line) for line in path.read_text().splitlines()]
+        assert count == 2
+        assert [line["body"]["messages"][0]["content"] for line in lines] == ["b", "c"]
+        assert lines[0]["custom_id"] == request_key("gpt-4", 0, "b", max_tokens=500)
+        assert lines[0]["url"] == "/v1/chat/completions"
+        assert lines[0]["body"]["max_tokens"] == 500
+
+    def test_ingest_fills_the_cache(self, gpt_api, cache, tmp_path):
+        prompts = ["a", "b"]
+        write_batch_file(gpt_api, prompts, "gpt-4", cache, str(tmp_path / "requests.jsonl"))
+        run_local_batch(tmp_path / "requests.jsonl", tmp_path / "results.jsonl")
+
+        assert ingest_batch_results(gpt_api, str(tmp_path / "results.jsonl"), prompts, "gpt-4", cache) == 2
+
+        # a normal run is now answered from the cache
+        gpt_api.call_api = MagicMock(side_effect=AssertionError("API must not be called"))
+        for prompt in prompts:
+            assert gpt_api.request(prompt, "gpt-4", lambda x: x, cache=cache)[0]["answer"] == '{"score": 90}'
+
+    def test_ingest_skips_failed_requests(self, gpt_api, cache, tmp_path):
+        results = tmp_path / "results.jsonl"
+        results.write_text(json.dumps({"custom_id": request_key("gpt-4", 0, "a"), "response": None, "error": {"code": "server_error"}}) + "\n")
+
+        assert ingest_batch_results(gpt_api, str(results), ["a"], "gpt-4", cache) == 0
+        assert len(cache) == 0
+
+    def test_submit_polls_and_ingests(self, gpt_api, cache, tmp_path):
+        path = str(tmp_path / "requests.jsonl")
+        client = MagicMock()
+        client.batches.retrieve.side_effect = [
+            SimpleNamespace(status="in_progress", output_file_id=None),
+            SimpleNamespace(status="completed", output_file_id="file-out"),
+        ]
+
+        def content(file_id):
+            run_local_batch(path, tmp_path / "out.jsonl")
+            return SimpleNamespace(text=(tmp_path / "out.jsonl").read_text())
+
+        client.files.content.side_effect = content
+        gpt_api.client = client
+
+        with patch("time.sleep"):
+            assert run_batch(gpt_api, ["a", "b"], "gpt-4", cache, path, submit=True) == 2
+
+        assert client.batches.create.call_args[1]["endpoint"] == "/v1/chat/completions"
+        assert os.path.isfile(str(tmp_path / "requests.results.jsonl"))
+        assert len(cache) == 2
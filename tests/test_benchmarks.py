@@ -0,0 +1,21 @@
+"""Smoke test of the pipeline benchmark."""
+
+from benchmarks.pipeline import regressions, run_benchmark
+
+
+class TestPipelineBenchmark:
+    def test_reports_every_method(self):
+        results = run_benchmark(methods=["GEMBA-DA", "GEMBA-ESA"], segments=4, systems=2, concurrency=2)
+
+        assert results["GEMBA-DA"]["segments"] == 8
+        assert results["GEMBA-DA"]["api_requests"] == 8
+        # error spans and ranking are two requests per segment
+        assert results["GEMBA-ESA"]["api_requests"] == 16
+        assert results["GEMBA-DA"]["stage_seconds"]["api_call"] > 0
+        assert results["GEMBA-DA"]["peak_rss_mb"] > 0
+
+    def test_regressions_against_baseline(self):
+        baseline = {"GEMBA-DA": {"segments_per_second": 100.0}, "GEMBA-MQM": {"segments_per_second": 100.0}}
+        results = {"GEMBA-DA": {"segments_per_second": 85.0}, "GEMBA-MQM": {"segments_per_second": 75.0},
+                   "GEMBA-SQM": {"segments_per_second": 1.0}}
+        assert regressions(results, baseline, 0.2) == ["GEMBA-MQM: 75.0 segments/s, baseline 100.0"]
@@ -0,0 +1,93 @@
+"""Tests for gemba.cache hashed cache and legacy migration."""
+
+import os
+from unittest.mock import MagicMock, patch
+
+import diskcache as dc
+
+from gemba.cache import GembaCache, main, migrate_cache, request_key
+from gemba.gpt_api import GptApi
+from gemba.prompt import validate_number
+
+
+class TestRequestKey:
+    def test_string_prompt_equals_single_user_message(self):
+        assert request_key("gpt-4", 0, "hi") == request_key("gpt-4", 0, [{"role": "user", "content": "hi"}])
+
+    def test_key_depends_on_request_settings(self):
+        base = request_key("gpt-4", 0, "hi")
+        assert request_key("gpt-4", 1, "hi") != base
+        assert request_key("gpt-4o", 0, "hi") != base
+        assert request_key("gpt-4", 0, "hi", max_tokens=500) != base
+        assert request_key("gpt-4", 0, "hi", response_format={"type": "json_object"}) != base
+
+    def test_key_is_short_and_stable(self):
+        key = request_key("gpt-4", 0, "hi")
+        assert len(key) == 64
+        assert key == request_key("gpt-4", 0, "hi")
+
+
+class TestGembaCache:
+    def test_roundtrip(self, tmp_path):
+        cache = GembaCache(str(tmp_path))
+        answers = [{"answer": "Příliš žluťoučký", "finish_reason": "stop"}]
+        cache.set("k", answers)
+        assert cache.get("k") == answers
+        assert "k" in cache
+        assert isinstance(cache.cache["k"], bytes)
+
+    def test_missing_and_empty_are_misses(self, tmp_path):
+        cache = GembaCache(str(tmp_path))
+        cache.set("empty", [])
+        assert cache.get("missing") is None
+        assert cache.get("empty") is None
+        assert "empty" not in cache
+
+
+class TestMigrateCache:
+    def _legacy(self, directory):
+        legacy = dc.Cache(directory)
+        legacy[{"model": "gpt-4", "temperature": 0, "prompt": "hi"}] = [{"answer": "90", "finish_reason": "stop"}]
+        legacy[{"model": "gpt-4", "temperature": 1, "prompt": "ho"}] = []
+        legacy.close()
+
+    def test_migrate(self, tmp_path):
+        directory = str(tmp_path / "gpt-4_GEMBA-DA")
+        self._legacy(directory)
+
+        assert migrate_cache(directory, max_tokens=500) == 2
+
+        cache = GembaCache(directory)
+        assert cache.get(request_key("gpt-4", 0, "hi", max_tokens=500)) == [{"answer": "90", "finish_reason": "stop"}]
+        assert (tmp_path / "gpt-4_GEMBA-DA.legacy").is_dir()
+
+    def test_migrate_escalated_answer(self, tmp_path):
+        directory = str(tmp_path / "gpt-4_GEMBA-DA")
+        legacy = dc.Cache(directory)
+        legacy[{"model": "gpt-4", "temperature": 0, "prompt": "hi"}] = [{"answer": "no idea", "finish_reason": "stop"}]
+        legacy[{"model": "gpt-4", "temperature": 1, "prompt": "hi"}] = [{"answer": "77", "finish_reason": "stop"}]
+        legacy.close()
+
+        migrate_cache(directory, max_tokens=500)
+
+        # the retry at a higher temperature is looked up without max_tokens
+        cache = GembaCache(directory)
+        assert cache.get(request_key("gpt-4", 1, "hi", max_tokens=None)) == [{"answer": "77", "finish_reason": "stop"}]
+
+        os.environ.setdefault("OPENAI_API_KEY", "test-key")
+        with patch("openai.OpenAI"):
+            gptapi = GptApi()
+        gptapi.call_api = MagicMock(side_effect=AssertionError("the migrated answers are not requested again"))
+        answers = gptapi.request("hi", "gpt-4", validate_number, cache=cache, max_tokens=500)
+        assert answers[0]["answer"] == 77
+        assert answers[0]["temperature"] == 1
+
+    def test_cli_infers_settings_from_method(self, tmp_path):
+        directory = str(tmp_path / "gpt-4_GEMBA-MQM")
+        self._legacy(directory)
+
+        main([directory])
+
+        from gemba.utils import RESPONSE_FORMATS
+        key = request_key("gpt-4", 0, "hi", response_format=RESPONSE_FORMATS["mqm"], max_tokens=500)
+        assert GembaCache(directory).get(key) is not None
@@ -0,0 +1,60 @@
+"""Tests for gemba.cascade."""
+
+import pytest
+
+from gemba.cascade import cascade_segments, escalation_reason, escalation_settings, sample_temperatures
+
+
+def _answer(answer, temperature=0, model="draft"):
+    return {"answer": answer, "temperature": temperature, "finish_reason": "stop", "model": model}
+
+
+class TestEscalationReason:
+    @pytest.fixture
+    def settings(self):
+        return escalation_settings("GEMBA-DA", {"score_range": (30, 70), "max_disagreement": 10})
+
+    def test_confident_answer(self, settings):
+        assert escalation_reason([_answer(95)], settings) is None
+        assert escalation_reason([_answer(95), _answer(90, temperature=10)], settings) is None
+
+    @pytest.mark.parametrize("samples, reason", [
+        ([_answer(None)], "parse_failure"),
+        ([_answer(95, temperature=1)], "temperature"),
+        ([_answer(50)], "score_range"),
+        ([_answer(95), _answer(60, temperature=10)], "disagreement"),
+        ([_answer(95), _answer(None, temperature=10)], "disagreement"),
+    ])
+    def test_uncertain_answers(self, settings, samples, reason):
+        assert escalation_reason(samples, settings) == reason
+
+    def test_overrides_method_defaults(self):
+        assert escalation_settings("GEMBA-DA_ref")["score_range"] == escalation_settings("GEMBA-DA")["score_range"]
+        assert escalation_settings("GEMBA-MQM", {"score_range": None})["score_range"] is None
+
+    def test_sample_temperatures_are_distinct(self):
+        assert sample_temperatures(1) == [0]
+        assert sample_temperatures(3) == [0, 10, 9]
+
+
+class TestCascadeSegments:
+    def test_escalates_only_uncertain_segments(self, capsys):
+        draft_calls, calls = [], []
+
+        def draft_score(source, hypothesis, method, reference=None, temperature=0, **kwargs):
+            draft_calls.append(temperature)
+            return [_answer(int(h)) if h != "?" else _answer(None) for h in hypothesis]
+
+        def score(source, hypothesis, method, reference=None, **kwargs):
+            calls.append((list(source), reference))
+            return [_answer(-1, model="expensive") for _ in hypothesis]
+
+        answers = cascade_segments(draft_score, score, ["s0", "s1", "s2", "s3"], ["95", "50", "?", "10"], "GEMBA-DA",
+                                   "draft", "expensive", escalation={"score_range": (30, 70)}, reference=["r0", "r1", "r2", "r3"],
+                                   source_lang="English", target_lang="German")
+
+        assert draft_calls == [0]
+        assert calls == [(["s1", "s2"], ["r1", "r2"])]
+        assert [a["answer"] for a in answers] == [95, -1, -1, 10]
+        assert [a["escalation"] for a in answers] == [None, "score_range", "parse_failure", None]
+        assert "2 (50.0%) escalated to expensive (parse_failure 1, score_range 1)" in capsys.readouterr().err
@@ -0,0 +1,65 @@
+"""Tests for the streaming mode of gemba.cli."""
+
+import json
+from unittest.mock import patch
+
+import pytest
+
+from gemba import cli
+
+
+class FakeScorer:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def score_segments(self, source, hypothesis, *args, **kwargs):
+        self.calls.append(list(source))
+        return [{"answer": len(h), "temperature": 0, "finish_reason": "stop"} for h in hypothesis]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+@pytest.fixture
+def files(tmp_path):
+    (tmp_path / "src.txt").write_text("".join(f"source {i}\n" for i in range(5)))
+    (tmp_path / "hyp.txt").write_text("".join(f"{'x' * i}\n" for i in range(5)))
+    return str(tmp_path / "src.txt"), str(tmp_path / "hyp.txt"), tmp_path / "out.jsonl"
+
+
+def _stream(files, calls, chunk_size=2):
+    source, hypothesis, output = files
+    with patch.object(cli, "Scorer", lambda *args, **kwargs: FakeScorer(calls)):
+        cli.stream_scores(source, hypothesis, str(output), chunk_size, "English", "German", "GEMBA-DA", "gpt-4")
+    return [json.loads(line) for line in output.read_text().splitlines()]
+
+
+class TestStreamScores:
+    def test_writes_one_line_per_segment_in_chunks(self, files):
+        calls = []
+        records = _stream(files, calls)
+
+        assert [len(c) for c in calls] == [2, 2, 1]
+        assert records[3] == {"index": 3, "score": 3, "temperature": 0, "finish_reason": "stop"}
+        assert [r["index"] for r in records] == [0, 1, 2, 3, 4]
+
+    def test_resume_skips_written_segments_and_partial_line(self, files):
+        output = files[2]
+        output.write_text(
+            json.dumps({"index": 0, "score": 0, "temperature": 0, "finish_reason": "stop"}) + "\n"
+            + json.dumps({"index": 2, "score": 2, "temperature": 0, "finish_reason": "stop"}) + "\n"
+            + '{"index": 3, "sco'
+        )
+        calls = []
+        records = _stream(files, calls, chunk_size=10)
+
+        assert calls == [["source 1", "source 3", "source 4"]]
+        assert sorted(r["index"] for r in records) == [0, 1, 2, 3, 4]
+
+    def test_length_mismatch(self, files, tmp_path):
+        (tmp_path / "hyp.txt").write_text("a\n")
+        with pytest.raises(AssertionError):
+            _stream(files, [])
@@ -9,6 +9,7 @@ import os
 
 os.environ.setdefault("OPENAI_API_KEY", "test-key")
 
+from gemba.cache import GembaCache, request_key
 from gemba.gpt_api import GptApi
 
 
@@ -109,3 +110,342 @@ class TestCallApiParameters:
         gpt_api.call_api("test prompt", "gpt-4o", temperature=0, max_tokens=None)
         call_kwargs = gpt_api.client.chat.completions.create.call_args[1]
         assert "response_format" not in call_kwargs
+
+
+def _completion(content, finish_reason="stop"):
+    choice = MagicMock(finish_reason=finish_reason, logprobs=None)
+    choice.message.content = content
+    return MagicMock(choices=[choice])
+
+
+class TestBulkRequestConcurrent:
+    """Tests for the asyncio execution mode of bulk_request."""
+
+    def test_concurrent_keeps_order_and_uses_cache(self, gpt_api, tmp_path):
+        import asyncio
+
+        import pandas as pd
+
+        async def create(**parameters):
+            content = parameters["messages"][0]["content"]
+            # finish later prompts first to shuffle completion order
+            await asyncio.sleep(0.01 * (5 - int(content)))
+            return _completion(content)
+
+        client = MagicMock()
+        client.chat.completions.create = create
+        client.close = MagicMock(side_effect=lambda: asyncio.sleep(0))
+        gpt_api.async_client_factory = MagicMock(return_value=client)
+
+        cache = GembaCache(str(tmp_path))
+        df = pd.DataFrame({"prompt": [str(i) for i in range(5)]})
+        answers = gpt_api.bulk_request(df, "gpt-4", int, cache=cache, concurrency=3)
+
+        assert [a["answer"] for a in answers] == [0, 1, 2, 3, 4]
+        assert len(cache) == 5
+
+        # a second run is served from the cache without touching the API
+        gpt_api.async_client_factory.return_value.chat.completions.create = MagicMock(side_effect=AssertionError)
+        answers = gpt_api.bulk_request(df, "gpt-4", int, cache=cache, concurrency=3)
+        assert [a["answer"] for a in answers] == [0, 1, 2, 3, 4]
+
+    def test_concurrent_runs_share_one_client(self, gpt_api, tmp_path):
+        import asyncio
+        import threading
+
+        import pandas as pd
+
+        async def create(**parameters):
+            return _completion(parameters["messages"][0]["content"])
+
+        client = MagicMock()
+        client.chat.completions.create = create
+        client.close = MagicMock(side_effect=lambda: asyncio.sleep(0))
+        gpt_api.async_client_factory = MagicMock(return_value=client)
+
+        results = {}
+
+        def run(offset):
+            df = pd.DataFrame({"prompt": [str(offset + i) for i in range(4)]})
+            answers = gpt_api.bulk_request(df, "gpt-4", int, cache=GembaCache(str(tmp_path / str(offset))), concurrency=2)
+            results[offset] = [a["answer"] for a in answers]
+
+        threads = [threading.Thread(target=run, args=(offset,)) for offset in (0, 10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        run(20)
+        assert results == {offset: [offset + i for i in range(4)] for offset in (0, 10, 20)}
+
+        # the client and its connection pool are created once and closed with the GptApi
+        assert gpt_api.async_client_factory.call_count == 1
+        client.close.assert_not_called()
+        gpt_api.close()
+        client.close.assert_called_once()
+
+    def test_failed_worker_cancels_the_others(self, gpt_api, tmp_path):
+        import asyncio
+        import time
+
+        import pandas as pd
+        from openai import NotFoundError
+
+        calls = []
+
+        async def create(**parameters):
+            content = parameters["messages"][0]["content"]
+            calls.append(content)
+            if content == "0":
+                raise NotFoundError(message="model not found", response=MagicMock(status_code=404), body={})
+            await asyncio.sleep(0.02)
+            return _completion(content)
+
+        client = MagicMock()
+        client.chat.completions.create = create
+        client.close = MagicMock(side_effect=lambda: asyncio.sleep(0))
+        gpt_api.async_client_factory = MagicMock(return_value=client)
+
+        df = pd.DataFrame({"prompt": [str(i) for i in range(20)]})
+        with pytest.raises(NotFoundError):
+            gpt_api.bulk_request(df, "gpt-4", int, cache=GembaCache(str(tmp_path)), concurrency=3)
+
+        # the workers of the failed run stop requesting on the shared loop
+        requested = len(calls)
+        time.sleep(0.2)
+        assert len(calls) == requested < 20
+        gpt_api.close()
+
+
+class TestRequestApiRateLimit:
+    """Tests for 429 handling in request_api."""
+
+    def test_rate_limit_error_is_recorded_and_retried(self, gpt_api):
+        from openai import RateLimitError
+
+        err = RateLimitError(
+            message="rate limited",
+            response=MagicMock(status_code=429, headers={"retry-after-ms": "1"}),
+            body={},
+        )
+        gpt_api.call_api = MagicMock(side_effect=[err, _completion("42")])
+        assert gpt_api.request_api("prompt", "gpt-4") == [{"answer": "42", "finish_reason": "stop"}]
+        assert gpt_api.get_rate_limiter("gpt-4").rate_limited == 1
+
+
+class TestRequestCoalescing:
+    """Tests for deduplication of identical prompts."""
+
+    def test_duplicate_prompts_requested_once(self, gpt_api, tmp_path):
+        import pandas as pd
+
+        gpt_api.request_api = MagicMock(side_effect=lambda prompt, *args, **kwargs: [{"answer": prompt, "finish_reason": "stop"}])
+        df = pd.DataFrame({"prompt": ["1", "2", "1", "1", "2"]})
+
+        grouped = gpt_api.bulk_request_grouped(df, "gpt-4", int, cache=GembaCache(str(tmp_path)))
+
+        assert gpt_api.request_api.call_count == 2
+        assert [answers[0]["answer"] for answers in grouped] == [1, 2, 1, 1, 2]
+
+    def test_in_flight_requests_are_coalesced(self, gpt_api, tmp_path):
+        import asyncio
+
+
+        from gemba.gpt_api import AsyncRun
+
+        calls = []
+
+        async def request_api_async(prompt, *args, **kwargs):
+            calls.append(prompt)
+            await asyncio.sleep(0.01)
+            return [{"answer": prompt, "finish_reason": "stop"}]
+
+        gpt_api.request_api_async = request_api_async
+        cache = GembaCache(str(tmp_path))
+
+        async def run_both():
+            run = AsyncRun(MagicMock(), 4)
+            results = await asyncio.gather(*(gpt_api.request_async("7", "gpt-4", int, run, cache=cache) for _ in range(3)))
+            return results, run.coalesced
+
+        results, coalesced = asyncio.run(run_both())
+        assert calls == ["7"]
+        assert coalesced == 2
+        assert [r[0]["answer"] for r in results] == [7, 7, 7]
+
+
+class TestBulkRequestPrefetch:
+    """Tests for the cache prefetch phase of bulk_request."""
+
+    def test_warm_run_does_not_request(self, gpt_api, tmp_path):
+        import pandas as pd
+
+        cache = GembaCache(str(tmp_path))
+        df = pd.DataFrame({"prompt": ["1", "2", "3"]})
+        gpt_api.request_api = MagicMock(side_effect=lambda prompt, *args, **kwargs: [{"answer": prompt, "finish_reason": "stop"}])
+        gpt_api.bulk_request(df, "gpt-4", int, cache=cache)
+        assert gpt_api.request_api.call_count == 3
+
+        gpt_api.request = MagicMock(side_effect=AssertionError("cache hits must not go through request"))
+        assert [a["answer"] for a in gpt_api.bulk_request(df, "gpt-4", int, cache=cache)] == [1, 2, 3]
+
+    def test_unparseable_cached_answer_is_escalated(self, gpt_api, tmp_path):
+        import pandas as pd
+
+        cache = GembaCache(str(tmp_path))
+        cache.set(request_key("gpt-4", 0, "x"), [{"answer": "not a number", "finish_reason": "stop"}])
+        gpt_api.request_api = MagicMock(return_value=[{"answer": "5", "finish_reason": "stop"}])
+
+        answers = gpt_api.bulk_request(pd.DataFrame({"prompt": ["x"]}), "gpt-4", lambda x: int(x) if x.isdigit() else None, cache=cache)
+
+        assert answers[0]["answer"] == 5
+        assert answers[0]["temperature"] == 1
+
+
+class TestBulkRequestPipeline:
+    """Tests for dependent multi-stage requests (GEMBA-ESA)."""
+
+    STAGES = [
+        {"render": lambda row, _: f"spans {row['id']}", "parse": lambda x: x},
+        {"render": lambda row, spans: f"rank {row['id']} given {spans['answer']}", "parse": lambda x: x},
+    ]
+
+    def _answer(self, prompt):
+        if prompt.startswith("spans"):
+            return f"errors of {prompt.split()[1]}"
+        return prompt
+
+    def test_sequential_links_stages_by_row(self, gpt_api, tmp_path):
+        gpt_api.request_api = MagicMock(side_effect=lambda prompt, *args, **kwargs: [{"answer": self._answer(prompt), "finish_reason": "stop"}])
+        rows = [{"id": i} for i in range(3)]
+
+        answers = gpt_api.bulk_request_pipeline(rows, "gpt-4", self.STAGES, cache=GembaCache(str(tmp_path)))
+
+        assert [a[0]["answer"] for a in answers] == [f"rank {i} given errors of {i}" for i in range(3)]
+
+    def test_concurrent_pipelines_stages_per_segment(self, gpt_api, tmp_path):
+        import asyncio
+
+        order = []
+
+        async def create(**parameters):
+            prompt = parameters["messages"][0]["content"]
+            order.append(prompt)
+            await asyncio.sleep(0)
+            return _completion(self._answer(prompt))
+
+        client = MagicMock()
+        client.chat.completions.create = create
+        client.close = MagicMock(side_effect=lambda: asyncio.sleep(0))
+        gpt_api.async_client_factory = MagicMock(return_value=client)
+        rows = [{"id": i} for i in range(8)]
+
+        answers = gpt_api.bulk_request_pipeline(rows, "gpt-4", self.STAGES, cache=GembaCache(str(tmp_path)), concurrency=2)
+
+        assert [a[0]["answer"] for a in answers] == [f"rank {i} given errors of {i}" for i in range(8)]
+        # the ranking of the first segment does not wait for the error spans of the whole corpus
+        assert order.index("rank 0 given errors of 0") < order.index("spans 7")
+
+    def test_esa_rejects_logprobs_and_packing(self, gpt_api, tmp_path):
+        from gemba.utils import score_segments
+
+        gpt_api.request_api = MagicMock(side_effect=AssertionError)
+        for options in ({"use_logprobs": True}, {"pack_size": 4}):
+            with pytest.raises(AssertionError, match="not supported for GEMBA-ESA"):
+                score_segments(gpt_api, GembaCache(str(tmp_path)), ["source"], ["translation"], "English", "German",
+                               "GEMBA-ESA", "gpt-4", **options)
+
+
+class TestRetryPolicy:
+    """Tests for the budgeted temperature escalation and local answer repair."""
+
+    def test_repairs_answer_locally_without_escalation(self, gpt_api, tmp_path):
+        from gemba.prompt import validate_number
+
+        gpt_api.request_api = MagicMock(return_value=[{"answer": '```json\n{"score": 70}\n```\nScored on a 0-100 scale.', "finish_reason": "stop"}])
+
+        answers = gpt_api.request("prompt", "gpt-4", validate_number, cache=GembaCache(str(tmp_path)))
+
+        assert answers[0]["answer"] == 70
+        assert answers[0]["repaired"] is True
+        assert answers[0]["escalations"] == 0
+        assert gpt_api.request_api.call_count == 1
+
+    def test_escalation_stops_at_call_budget(self, gpt_api, tmp_path):
+        from gemba.retry import RetryPolicy
+
+        gpt_api.retry_policy = RetryPolicy(max_calls=3)
+        gpt_api.call_api = MagicMock(return_value=_completion("no score here"))
+
+        answers = gpt_api.request("prompt", "gpt-4", lambda x: None, cache=GembaCache(str(tmp_path)))
+
+        assert gpt_api.call_api.call_count == 3
+        assert answers[0]["answer"] is None
+        assert answers[0]["escalations"] == 3
+
+    def test_escalation_records_count(self, gpt_api, tmp_path):
+        gpt_api.call_api = MagicMock(side_effect=[_completion("bad"), _completion("bad"), _completion("42")])
+
+        answers = gpt_api.request("prompt", "gpt-4", lambda x: int(x) if x.isdigit() else None, cache=GembaCache(str(tmp_path)))
+
+        assert answers[0]["answer"] == 42
+        assert answers[0]["temperature"] == 2
+        assert answers[0]["escalations"] == 2
+
+    def test_truncation_retries_count_against_budget(self, gpt_api, tmp_path):
+        from gemba.retry import RetryPolicy
+
+        gpt_api.retry_policy = RetryPolicy(max_calls=2)
+        gpt_api.call_api = MagicMock(return_value=_completion("4", finish_reason="length"))
+
+        answers = gpt_api.request("prompt", "gpt-4", lambda x: x, cache=GembaCache(str(tmp_path)), max_tokens=10)
+
+        assert gpt_api.call_api.call_count == 2
+        assert answers[0]["answer"] is None
+
+
+class TestTruncation:
+    """Tests for continuing truncated answers."""
+
+    def test_free_text_answer_is_continued(self, gpt_api):
+        gpt_api.call_api = MagicMock(side_effect=[
+            _completion("Critical:\nno-error\nMajor:\naccuracy - wrong te", finish_reason="length"),
+            _completion("rm\nMinor:\nno-error"),
+        ])
+
+        answers = gpt_api.request_api("prompt", "gpt-4", max_tokens=20)
+
+        assert answers == [{"answer": "Critical:\nno-error\nMajor:\naccuracy - wrong term\nMinor:\nno-error", "finish_reason": "stop"}]
+        continuation = gpt_api.call_api.call_args_list[1][0]
+        assert continuation[0][1] == {"role": "assistant", "content": "Critical:\nno-error\nMajor:\naccuracy - wrong te"}
+        assert continuation[0][2]["role"] == "user"
+        # the continuation keeps the max_tokens, only the remainder is generated
+        assert continuation[3] == 20
+        assert gpt_api.truncation_stats.continuations == 1
+
+    def test_content_filter_is_not_continued(self, gpt_api):
+        gpt_api.call_api = MagicMock(return_value=_completion("Critical:\n", finish_reason="content_filter"))
+
+        assert gpt_api.request_api("prompt", "gpt-4", max_tokens=20) == []
+        assert gpt_api.call_api.call_count == 1
+        assert gpt_api.truncation_stats.truncations == 0
+
+        # nor a continuation that is filtered
+        gpt_api.call_api = MagicMock(side_effect=[
+            _completion("Critical:\n", finish_reason="length"),
+            _completion("", finish_reason="content_filter"),
+        ])
+        assert gpt_api.request_api("prompt", "gpt-4", max_tokens=20) == []
+
+    def test_structured_output_grows_max_tokens_geometrically(self, gpt_api):
+        from gemba.retry import RetryPolicy
+
+        gpt_api.retry_policy = RetryPolicy(max_completion_tokens=1000)
+        gpt_api.call_api = MagicMock(return_value=_completion('{"errors": {"critical": [', finish_reason="length"))
+
+        answers = gpt_api.request_api("prompt", "gpt-4", max_tokens=300, response_format={"type": "json_object"})
+
+        assert answers == []
+        assert [call[0][3] for call in gpt_api.call_api.call_args_list] == [300, 600, 1000]
+        stats = gpt_api.truncation_stats
+        assert (stats.truncations, stats.regenerations, stats.discarded_tokens) == (3, 2, 900)
@@ -0,0 +1,77 @@
+"""Tests for the log-probability expected scores."""
+
+import math
+import os
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+from gemba.cache import GembaCache, request_key
+from gemba.gpt_api import GptApi
+from gemba.logprobs import expected_score, logprob_parser, score_distribution
+from gemba.prompt import validate_number
+
+
+def _token(token, logprob, top=()):
+    return SimpleNamespace(token=token, logprob=logprob,
+                           top_logprobs=[SimpleNamespace(token=t, logprob=lp) for t, lp in top])
+
+
+class TestExpectedScore:
+    def test_distribution_of_first_numeric_token(self):
+        content = [_token('{"', 0.0), _token("score", 0.0), _token('":', 0.0),
+                   _token("80", math.log(0.6), [("80", math.log(0.6)), ("90", math.log(0.3)), ("abc", math.log(0.1))]),
+                   _token("}", 0.0)]
+        assert score_distribution(content) == {"80": math.log(0.6), "90": math.log(0.3), "abc": math.log(0.1)}
+        assert score_distribution([_token("great", 0.0)]) is None
+
+    def test_expected_score_over_valid_scores(self):
+        distribution = {"80": math.log(0.6), " 80": math.log(0.1), "90": math.log(0.2), "120": math.log(0.05), "x": math.log(0.05)}
+        score, confidence = expected_score(distribution, 0, 100)
+        assert score == pytest.approx((80 * 0.7 + 90 * 0.2) / 0.9)
+        assert confidence == pytest.approx(0.7 / 0.9)
+        assert expected_score({"120": 0.0}, 0, 100) is None
+
+    def test_parser_falls_back_to_text(self):
+        parse = logprob_parser(validate_number, 0, 100)
+        assert parse("85", {"85": 0.0}) == (85, 1.0)
+        assert parse("Score: 85", None) == (85, None)
+        assert parse("no idea", None) == (None, None)
+
+    def test_split_digit_tokens_fall_back_to_text(self):
+        # a tokenizer that splits "85" into "8" and "5" gives a distribution over the first digit
+        content = [_token("8", math.log(0.9), [("8", math.log(0.9)), ("9", math.log(0.1))]), _token("5", 0.0)]
+        distribution = score_distribution(content)
+        assert distribution == {"8": math.log(0.9), "9": math.log(0.1)}
+        parse = logprob_parser(validate_number, 0, 100)
+        assert parse("85", distribution) == (85, None)
+
+
+def _completion_with_logprobs(content, top):
+    choice = MagicMock(finish_reason="stop")
+    choice.message.content = content
+    choice.logprobs.content = [_token(content, 0.0, top)]
+    return MagicMock(choices=[choice])
+
+
+class TestRequestWithLogprobs:
+    def test_single_call_scores_expected_value(self, tmp_path):
+        with patch("openai.OpenAI"):
+            gpt_api = GptApi()
+        gpt_api.is_openai = True
+        gpt_api.client.chat.completions.create.return_value = _completion_with_logprobs(
+            "90", [("90", math.log(0.5)), ("80", math.log(0.5))])
+        cache = GembaCache(str(tmp_path))
+
+        answers = gpt_api.request("prompt", "gpt-4", logprob_parser(validate_number, 0, 100), cache=cache, logprobs=20)
+
+        assert answers[0]["answer"] == pytest.approx(85)
+        assert answers[0]["confidence"] == pytest.approx(0.5)
+        parameters = gpt_api.client.chat.completions.create.call_args.kwargs
+        assert parameters["logprobs"] is True and parameters["top_logprobs"] == 20
+        # the distribution is cached under its own key, next to the plain answers
+        assert request_key("gpt-4", 0, "prompt", logprobs=20) in cache
+        assert request_key("gpt-4", 0, "prompt") not in cache
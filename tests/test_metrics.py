@@ -0,0 +1,40 @@
+"""Tests for the Prometheus metrics and stage timers."""
+
+import pytest
+
+from gemba.metrics import STAGE_ERRORS, STAGE_SECONDS, MetricsDumper, Registry, stage_timer
+
+
+class TestRegistry:
+    def test_render_counters_and_histograms(self):
+        registry = Registry()
+        registry.counter("jobs_total", "Jobs.").inc(2, result='o"k')
+        histogram = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+        histogram.observe(0.05, stage="api")
+        histogram.observe(0.5, stage="api")
+
+        lines = registry.render().splitlines()
+        assert "# TYPE jobs_total counter" in lines
+        assert 'jobs_total{result="o\\"k"} 2' in lines
+        assert 'latency_seconds_bucket{stage="api",le="0.1"} 1' in lines
+        assert 'latency_seconds_bucket{stage="api",le="1"} 2' in lines
+        assert 'latency_seconds_bucket{stage="api",le="+Inf"} 2' in lines
+        assert 'latency_seconds_count{stage="api"} 2' in lines
+        assert registry.counter("jobs_total", "Jobs.") is registry.counter("jobs_total", "Jobs.")
+
+    def test_stage_timer_counts_errors(self):
+        count, errors = STAGE_SECONDS.count(stage="test"), STAGE_ERRORS.value(stage="test")
+        with stage_timer("test"):
+            pass
+        with pytest.raises(ValueError), stage_timer("test"):
+            raise ValueError()
+        assert STAGE_SECONDS.count(stage="test") == count + 2
+        assert STAGE_ERRORS.value(stage="test") == errors + 1
+
+    def test_dumper_writes_on_close(self, tmp_path):
+        registry = Registry()
+        registry.counter("jobs_total", "Jobs.").inc()
+        path = tmp_path / "metrics.prom"
+        with MetricsDumper(str(path), interval=60, registry=registry):
+            pass
+        assert "jobs_total 1" in path.read_text()
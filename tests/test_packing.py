@@ -0,0 +1,101 @@
+"""Tests for gemba.packing multi-segment prompts."""
+
+import json
+import os
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+from gemba.cache import GembaCache, request_key
+from gemba.gemba_mqm_utils import TEMPLATE_GEMBA_MQM, apply_template, parse_mqm_answer
+from gemba.gpt_api import GptApi
+from gemba.packing import pack_prompt, prefill_packed, unpack_answer
+from gemba.prompt import prompts, validate_number
+
+
+def _rows(count):
+    return [
+        {"source_seg": f"source {i}", "target_seg": f"target {i}", "source_lang": "English", "target_lang": "German"}
+        for i in range(count)
+    ]
+
+
+class TestPackPrompt:
+    def test_conversation_template_shares_few_shot_prefix(self):
+        rows = _rows(3)
+        packed = pack_prompt(TEMPLATE_GEMBA_MQM, rows, "errors")
+        single = apply_template(TEMPLATE_GEMBA_MQM, rows[0])
+
+        assert packed[:-1] == single[:-1]
+        for i in range(3):
+            assert f"Segment {i}:\nEnglish source:\n```source {i}```" in packed[-1]["content"]
+        # the instructions of the last turn are sent once
+        assert packed[-1]["content"].count("identify error types") == 1
+
+    def test_string_template(self):
+        packed = pack_prompt(prompts["GEMBA-DA"]["prompt"], _rows(2), "score")
+        assert isinstance(packed, str)
+        assert 'German translation: "target 1"' in packed
+        assert '"score": <score>' in packed
+        assert packed.count("Score the following translation") == 1
+        assert packed.startswith("Score the following translation from English to German")
+
+    def test_instructions_differing_between_rows_are_repeated(self):
+        rows = _rows(2)
+        rows[1]["target_lang"] = "Czech"
+        packed = pack_prompt(prompts["GEMBA-DA"]["prompt"], rows, "score")
+        assert packed.count("Score the following translation") == 2
+        assert "from English to Czech" in packed
+
+
+class TestUnpackAnswer:
+    def test_keyed_by_segment(self):
+        answer = json.dumps({"segments": [{"segment": 1, "score": 80}, {"segment": 0, "score": 20}]})
+        assert unpack_answer(answer, "score") == {0: '{"score": 20}', 1: '{"score": 80}'}
+
+    def test_malformed(self):
+        assert unpack_answer("not json", "score") == {}
+        assert unpack_answer('{"segments": [{"score": 1}, {"segment": 2}]}', "score") == {}
+
+
+class TestPrefillPacked:
+    @pytest.fixture
+    def gpt_api(self):
+        with patch("openai.OpenAI"):
+            return GptApi()
+
+    def test_partial_answer_leaves_missing_segments_uncached(self, gpt_api, tmp_path):
+        cache = GembaCache(str(tmp_path))
+        template = prompts["GEMBA-DA"]["prompt"]
+        df = pd.DataFrame(_rows(3))
+        df["prompt"] = df.apply(lambda x: apply_template(template, x), axis=1)
+
+        # segment 1 is missing and segment 2 is out of range
+        packed = json.dumps({"segments": [{"segment": 0, "score": 70}, {"segment": 2, "score": 700}]})
+        gpt_api.request_api = MagicMock(return_value=[{"answer": packed, "finish_reason": "stop"}])
+
+        answered = prefill_packed(gpt_api, df, template, "gpt-4", cache, validate_number, "score", pack_size=3, max_tokens=10)
+
+        assert answered == 1
+        assert gpt_api.request_api.call_count == 1
+        assert gpt_api.request_api.call_args[0][3] == 30
+        assert cache.get(request_key("gpt-4", 0, df["prompt"][0], max_tokens=10)) == [{"answer": '{"score": 70}', "finish_reason": "stop"}]
+        for i in (1, 2):
+            assert request_key("gpt-4", 0, df["prompt"][i], max_tokens=10) not in cache
+
+    def test_mqm_segments_parse_like_single_answers(self, gpt_api, tmp_path):
+        cache = GembaCache(str(tmp_path))
+        df = pd.DataFrame(_rows(2))
+        df["prompt"] = df.apply(lambda x: apply_template(TEMPLATE_GEMBA_MQM, x), axis=1)
+        errors = {"critical": [], "major": [{"category": "accuracy/omission", "description": "x"}], "minor": []}
+        packed = json.dumps({"segments": [{"segment": 0, "errors": errors}, {"segment": 1, "errors": errors}]})
+        gpt_api.request_api = MagicMock(return_value=[{"answer": packed, "finish_reason": "stop"}])
+
+        assert prefill_packed(gpt_api, df, TEMPLATE_GEMBA_MQM, "gpt-4", cache, parse_mqm_answer, "errors", pack_size=5) == 2
+
+        gpt_api.request_api = MagicMock(side_effect=AssertionError("API must not be called"))
+        answers = gpt_api.bulk_request(df, "gpt-4", parse_mqm_answer, cache=cache)
+        assert [a["answer"] for a in answers] == [-5, -5]
@@ -0,0 +1,16 @@
+"""The parsers against the answer corpus of the parser benchmark."""
+
+import json
+
+import pytest
+
+from benchmarks.parsers import PARSERS, load_corpus
+
+CORPUS = load_corpus()
+
+
+@pytest.mark.parametrize("entry", CORPUS, ids=[f"{entry['parser']}-{i}" for i, entry in enumerate(CORPUS)])
+def test_parser_gives_expected_result(entry):
+    result = PARSERS[entry["parser"]](entry["answer"])
+    # the expected results went through JSON, e.g. the MQM error levels are a defaultdict
+    assert json.loads(json.dumps(result)) == entry["expected"]
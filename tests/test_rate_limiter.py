@@ -0,0 +1,70 @@
+"""Tests for gemba.rate_limiter."""
+
+from unittest.mock import patch
+
+from gemba.rate_limiter import RateLimiter, estimate_tokens
+
+
+class TestRateLimiter:
+    """Tests for the RPM/TPM token buckets and header adaptation."""
+
+    def test_unbudgeted_never_waits(self):
+        limiter = RateLimiter()
+        for _ in range(100):
+            assert limiter._reserve(1000) == 0
+        assert limiter.throttled == 0
+
+    def test_rpm_budget_throttles(self):
+        limiter = RateLimiter(rpm=2)
+        assert limiter._reserve(0) == 0
+        assert limiter._reserve(0) == 0
+        # the third request in the same minute has to wait for a refill
+        assert limiter._reserve(0) > 0
+        assert limiter.throttled == 1
+
+    def test_tpm_budget_throttles(self):
+        limiter = RateLimiter(tpm=1000)
+        assert limiter._reserve(800) == 0
+        assert limiter._reserve(800) > 0
+
+    def test_remaining_headers_lower_the_buckets(self):
+        limiter = RateLimiter(rpm=100)
+        limiter.update_from_headers({"x-ratelimit-remaining-requests": "0"})
+        assert limiter._reserve(0) > 0
+
+    def test_headers_do_not_budget_an_unbudgeted_quota(self):
+        limiter = RateLimiter(rpm=100)
+        limiter.update_from_headers({"x-ratelimit-limit-tokens": "1000", "x-ratelimit-remaining-tokens": "0"})
+        assert limiter.tpm is None
+        assert limiter._reserve(500) == 0
+
+    def test_delay_does_not_reserve(self):
+        limiter = RateLimiter(rpm=60)
+        assert limiter.delay() == 0
+        assert limiter.requests == 0
+        limiter.update_from_headers({"x-ratelimit-remaining-requests": "0"})
+        assert 0 < limiter.delay() <= 1
+
+    def test_retry_after_pauses_requests(self):
+        limiter = RateLimiter()
+        limiter.record_rate_limit({"retry-after-ms": "1500"})
+        assert limiter.rate_limited == 1
+        assert 1 < limiter._reserve(0) <= 1.5
+
+    def test_backoff_without_retry_after(self):
+        limiter = RateLimiter()
+        limiter.record_rate_limit()
+        limiter.record_rate_limit()
+        assert 1 < limiter._reserve(0) <= 2
+
+    def test_acquire_sleeps(self):
+        limiter = RateLimiter(rpm=1)
+        limiter.acquire()
+        with patch("time.sleep") as sleep:
+            limiter.acquire()
+        assert sleep.call_count == 1
+
+
+def test_estimate_tokens_counts_completion_budget():
+    assert estimate_tokens("x" * 400, max_tokens=500) == 601
+    assert estimate_tokens([{"role": "user", "content": "hi"}]) > 0
@@ -0,0 +1,39 @@
+"""Tests for gemba.repair."""
+
+import pytest
+
+from gemba.gemba_mqm_utils import parse_mqm_answer
+from gemba.prompt import validate_number
+from gemba.repair import close_unterminated_json, repair_candidates
+
+
+class TestCloseUnterminatedJson:
+    @pytest.mark.parametrize("text, expected", [
+        ('{"score": 85', '{"score": 85}'),
+        ('{"errors": {"critical": [], "major": [{"category": "a", "description": "b"}',
+         '{"errors": {"critical": [], "major": [{"category": "a", "description": "b"}]}}'),
+    ])
+    def test_closes_open_containers(self, text, expected):
+        assert close_unterminated_json(text) == expected
+
+    @pytest.mark.parametrize("text", [
+        '{"score": 85}',              # complete
+        '{"errors": {"critical": [',  # stops inside a value
+        '{"score"',                   # key without a value
+        '{"description": "cut',       # inside a string
+        'Score: 85',                  # not JSON
+    ])
+    def test_does_not_guess(self, text):
+        assert close_unterminated_json(text) is None
+
+
+class TestRepairCandidates:
+    def test_markdown_wrapped_answers(self):
+        assert validate_number(repair_candidates('```json\n{"score": 90}\n```')[0]) == 90
+        assert repair_candidates("**Score: 75**") == ["Score: 75"]
+
+    def test_embedded_json(self):
+        answer = 'Here is my evaluation: {"errors": {"critical": [], "major": [], "minor": []}} Hope this helps, 2 notes.'
+        candidates = repair_candidates(answer)
+        assert '{"errors": {"critical": [], "major": [], "minor": []}}' in candidates
+        assert parse_mqm_answer(candidates[-1], full_desc=True) == 0
@@ -0,0 +1,57 @@
+"""Tests for the record and replay of the API traffic."""
+
+import json
+
+from gemba.replay import Recorder, ReplayLog, make_replay_server, replay_key
+from gemba.utils import get_gemba_scores
+from tests.test_server import _start, openai_stub  # noqa: F401 (fixture)
+
+
+def _score(base_url, recorder=None):
+    return get_gemba_scores(["a", "b"], ["xx", "xxxx"], "English", "German", "GEMBA-DA", "gpt-4",
+                            base_url=base_url, use_structured_output=False, recorder=recorder,
+                            concurrency=2)
+
+
+class TestReplayKey:
+    def test_ignores_client_specific_parameters(self):
+        request = {"model": "gpt-4o", "messages": [{"role": "user", "content": "x"}], "temperature": 0, "top_p": 1}
+        openai_request = {**request, "n": 1, "frequency_penalty": 0, "response_format": {"type": "json_object"},
+                          "max_completion_tokens": 100}
+        assert replay_key(openai_request) == replay_key({**request, "max_tokens": 100})
+        assert replay_key(request) != replay_key({**request, "temperature": 0.1})
+
+
+class TestReplayLog:
+    def test_repeated_requests_follow_the_recording(self, tmp_path):
+        request = {"model": "gpt-4", "messages": [{"role": "user", "content": "x"}]}
+        path = tmp_path / "traffic.jsonl"
+        entries = [{"key": replay_key(request), "latency": 0.1, "status": 429, "error": {"message": "slow down"}},
+                   {"key": replay_key(request), "latency": 0.2, "status": 200, "response": {"id": "1"}}]
+        path.write_text("".join(json.dumps(entry) + "\n" for entry in entries))
+
+        log = ReplayLog(str(path))
+        assert [log.next(request)["status"] for _ in range(3)] == [429, 200, 200]
+        assert log.next({**request, "model": "gpt-4o"}) is None
+
+
+class TestRecordAndReplay:
+    def test_replayed_run_matches_the_recording(self, openai_stub, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        path = tmp_path / "traffic.jsonl"
+        with Recorder(str(path)) as recorder:
+            recorded = _score(f"http://127.0.0.1:{openai_stub.server_port}", recorder)
+        assert recorded == [2, 4]
+        assert recorder.calls == 2
+
+        # a fresh cache, so every request goes to the replay server
+        (tmp_path / "cache").rename(tmp_path / "recorded-cache")
+        server = _start(make_replay_server(str(path), port=0, speed=0))
+        try:
+            replayed = _score(f"http://127.0.0.1:{server.server_port}")
+        finally:
+            server.shutdown()
+            server.server_close()
+        assert replayed == recorded
+        assert len(openai_stub.calls) == 2
+        assert server.misses == 0
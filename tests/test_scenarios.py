@@ -0,0 +1,181 @@
+"""Tests for the scenario runner against local fake OpenAI servers."""
+
+import os
+import shutil
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from benchmarks.fake_openai import ANSWERS, start_fake_openai
+from benchmarks.pipeline import make_testset
+from gemba.rate_limiter import RateLimiter
+from gemba.scenarios import ScenarioRunner, parse_scenarios
+
+
+class _StubApi:
+    """Answers every chunk after a short delay and tracks the chunks in flight."""
+
+    def __init__(self):
+        self.rate_limiters = {}
+        self.models = []
+        self.prompts = []
+        self.active = 0
+        self.max_active = 0
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def get_rate_limiter(self, model):
+        return self.rate_limiters.setdefault(model, RateLimiter())
+
+    def bulk_request_grouped(self, df, model, parse_response, cache, report=True):
+        with self._lock:
+            self.models += [model] * len(df)
+            self.prompts += list(df["prompt"])
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.01)
+        with self._lock:
+            self.active -= 1
+        return [[{"answer": 50, "temperature": 0}] for _ in range(len(df))]
+
+    def report_rate_limits(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def servers():
+    started = [start_fake_openai(), start_fake_openai()]
+    yield started
+    for server in started:
+        server.shutdown()
+        server.server_close()
+
+
+def _config(tmp_path, servers):
+    return {
+        "testset_path": str(tmp_path / "data"),
+        "endpoints": {
+            "first": {"base_url": f"http://127.0.0.1:{servers[0].server_port}", "concurrency": 4, "rpm": 6000},
+            "second": {"base_url": f"http://127.0.0.1:{servers[1].server_port}"},
+        },
+        "scenarios": [
+            {"model": "model-a", "method": "GEMBA-DA", "endpoint": "first", "testsets": [["wmt22", "en-de"], ["wmt22", "zh-en"]]},
+            {"model": "model-b", "method": "GEMBA-DA_ref", "endpoint": "first", "testsets": [["wmt22", "en-de"]]},
+            {"model": "model-c", "method": "GEMBA-stars", "endpoint": "second", "testsets": [["wmt22", "en-de"]]},
+        ],
+    }
+
+
+class TestParseScenarios:
+    def test_jobs(self, tmp_path, servers):
+        endpoints, jobs = parse_scenarios(_config(tmp_path, servers))
+        assert endpoints["second"]["concurrency"] == 1
+        assert [repr(job) for job in jobs] == [
+            "GEMBA-DA_model-a on wmt22/en-de", "GEMBA-DA_model-a on wmt22/zh-en",
+            "GEMBA-DA_ref_model-b on wmt22/en-de", "GEMBA-stars_model-c on wmt22/en-de"]
+        assert [job.endpoint for job in jobs] == ["first", "first", "first", "second"]
+
+    def test_invalid(self, tmp_path, servers):
+        config = _config(tmp_path, servers)
+        config["scenarios"][0]["endpoint"] = "third"
+        with pytest.raises(ValueError, match="unknown endpoint"):
+            parse_scenarios(config)
+
+        config = _config(tmp_path, servers)
+        config["scenarios"][0]["method"] = "GEMBA-unknown"
+        with pytest.raises(ValueError, match="not supported"):
+            parse_scenarios(config)
+
+        config = _config(tmp_path, servers)
+        config["endpoints"]["first"]["workers"] = 2
+        with pytest.raises(ValueError, match="Unknown settings"):
+            parse_scenarios(config)
+
+
+class TestScenarioRunner:
+    def test_run(self, tmp_path, servers):
+        make_testset(str(tmp_path / "data"), "wmt22", "en-de", segments=6, systems=2)
+        make_testset(str(tmp_path / "data"), "wmt22", "zh-en", segments=4, systems=2)
+        servers[1].answer = ANSWERS["GEMBA-stars"]
+        endpoints, jobs = parse_scenarios(_config(tmp_path, servers))
+
+        runner = ScenarioRunner(endpoints, jobs, cache_dir=str(tmp_path / "cache"))
+        assert runner.run() == []
+        for job in jobs:
+            assert os.path.isfile(job.scores.get_sys_path())
+            assert os.path.isfile(job.scores.get_usage_path())
+            assert all(job.scores.get_score(system, i) is not None
+                       for system in job.testset.systems for i in range(len(job.testset.sources)))
+        # the budgets are per deployment
+        limiters = runner.gptapis["first"].rate_limiters
+        assert limiters["model-a"] is not limiters["model-b"]
+        assert limiters["model-a"].rpm == 6000
+        assert servers[1].requests == 12
+
+        # a second run only requests what is not scored yet
+        requests = servers[0].requests
+        _, jobs = parse_scenarios(_config(tmp_path, servers))
+        assert ScenarioRunner(endpoints, jobs, cache_dir=str(tmp_path / "cache2")).run() == []
+        assert servers[0].requests == requests
+
+    def test_failed_job_does_not_stop_the_others(self, tmp_path, servers):
+        make_testset(str(tmp_path / "data"), "wmt22", "en-de", segments=3, systems=1)
+        servers[1].answer = ANSWERS["GEMBA-stars"]
+        # zh-en is missing
+        endpoints, jobs = parse_scenarios(_config(tmp_path, servers))
+
+        runner = ScenarioRunner(endpoints, jobs, cache_dir=str(tmp_path / "cache"))
+        failed = runner.run()
+        assert [repr(job) for job in failed] == ["GEMBA-DA_model-a on wmt22/zh-en"]
+        assert os.path.isfile(jobs[2].scores.get_sys_path())
+        assert os.path.isfile(jobs[3].scores.get_sys_path())
+
+    def _stubbed_runner(self, tmp_path, servers):
+        make_testset(str(tmp_path / "data"), "wmt22", "en-de", segments=6, systems=2)
+        make_testset(str(tmp_path / "data"), "wmt22", "zh-en", segments=4, systems=2)
+        endpoints, jobs = parse_scenarios(_config(tmp_path, servers))
+        runner = ScenarioRunner(endpoints, jobs, cache_dir=str(tmp_path / "cache"), chunk_size=2)
+        runner.gptapis = {"first": _StubApi(), "second": _StubApi()}
+        return runner
+
+    def test_shared_pool_respects_endpoint_concurrency(self, tmp_path, servers):
+        runner = self._stubbed_runner(tmp_path, servers)
+        assert runner.workers == 5
+        with patch("gemba.scenarios.GembaCache.close", autospec=True) as close_cache:
+            assert runner.run() == []
+
+        first, second = runner.gptapis["first"], runner.gptapis["second"]
+        assert len(first.models) == 12 + 8 + 12 and len(second.models) == 12
+        assert first.max_active == 4 and second.max_active == 1
+        assert all(job.finished for job in runner.jobs)
+        # the caches of the jobs and the clients of the endpoints are closed
+        assert first.closed and second.closed
+        assert {id(call.args[0]) for call in close_cache.call_args_list} == {id(job.answer_cache) for job in runner.jobs}
+
+    def test_identical_hypotheses_are_requested_once(self, tmp_path, servers):
+        runner = self._stubbed_runner(tmp_path, servers)
+        outputs = tmp_path / "data" / "wmt22" / "system-outputs" / "en-de"
+        shutil.copy(outputs / "system00.txt", outputs / "system01.txt")
+
+        assert runner.run() == []
+        first = runner.gptapis["first"]
+        assert first.models.count("model-a") == 6 + 8
+        assert len(first.prompts) == len(set(first.prompts))
+        job = runner.jobs[0]
+        assert job.coalesced == 6
+        assert all(job.scores.get_score(system, i) == 50 for system in job.testset.systems for i in range(6))
+
+    def test_throttled_deployment_yields_to_other_jobs(self, tmp_path, servers):
+        runner = self._stubbed_runner(tmp_path, servers)
+        first = runner.gptapis["first"]
+        first.get_rate_limiter("model-a").record_rate_limit({"retry-after": "0.5"})
+
+        assert runner.run() == []
+        # model-b on the same endpoint is scored while model-a waits for its quota
+        assert first.models[:12] == ["model-b"] * 12
+        assert first.models.count("model-a") == 20
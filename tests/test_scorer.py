@@ -0,0 +1,53 @@
+"""Tests for the reusable gemba.Scorer."""
+
+import os
+import threading
+from unittest.mock import MagicMock, patch
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+from gemba import Scorer
+
+
+def _answer_by_length(prompt, *args, **kwargs):
+    hypothesis = prompt.split("translation: ")[-1].split("\n")[0].strip('"')
+    return [{"answer": str(len(hypothesis)), "finish_reason": "stop"}]
+
+
+def _scorer(tmp_path):
+    with patch("openai.OpenAI"):
+        scorer = Scorer("gpt-4", cache_dir=str(tmp_path), use_structured_output=False)
+    scorer.gptapi.request_api = MagicMock(side_effect=_answer_by_length)
+    return scorer
+
+
+class TestScorer:
+    def test_reuses_client_and_cache_across_calls(self, tmp_path):
+        scorer = _scorer(tmp_path)
+        client = scorer.gptapi.client
+
+        assert scorer.score(["a"], ["xx"], "English", "German", "GEMBA-DA") == [2]
+        assert scorer.score(["a", "b"], ["xx", "yyy"], "English", "German", "GEMBA-DA") == [2, 3]
+
+        assert scorer.gptapi.client is client
+        assert scorer.cache("GEMBA-DA") is scorer.cache("GEMBA-DA")
+        assert scorer.cache("GEMBA-DA") is not scorer.cache("GEMBA-SQM")
+        # the repeated segment is answered from the cache
+        assert scorer.gptapi.request_api.call_count == 2
+        scorer.close()
+
+    def test_concurrent_calls_from_threads(self, tmp_path):
+        scorer = _scorer(tmp_path)
+        results = {}
+
+        def score(i):
+            results[i] = scorer.score(["a"] * 5, ["x" * (i + j) for j in range(5)], "English", "German", "GEMBA-DA")
+
+        threads = [threading.Thread(target=score, args=(i,)) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert results == {i: [i + j for j in range(5)] for i in range(8)}
+        scorer.close()
@@ -0,0 +1,150 @@
+"""Tests for the array-backed Scores store."""
+
+import os
+
+import pytest
+
+from gemba import testset as testsets
+from gemba.scores import Scores
+
+
+def _write(path, lines):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text("".join(line + "\n" for line in lines))
+
+
+@pytest.fixture
+def testset(tmp_path):
+    root = tmp_path / "wmt22"
+    _write(root / "sources" / "en-de.txt", ["s0", "s1", "s2"])
+    _write(root / "references" / "en-de.refA.txt", ["r0", "r1", "r2"])
+    _write(root / "documents" / "en-de.docs", ["news\td0", "news\td0", "speech\td1"])
+    for system in ("sysB", "sysA"):
+        _write(root / "system-outputs" / "en-de" / f"{system}.txt", [f"{system}-{i}" for i in range(3)])
+    return testsets.Testset(str(tmp_path), "wmt22", "en-de")
+
+
+def _read(path):
+    return path.read_text().splitlines()
+
+
+class TestScores:
+    def test_assign_and_get(self, testset):
+        scores = Scores("GEMBA-DA", testset, None)
+        assert scores.get_score("sysA", 1) is None
+
+        # hypothesis indices run over all systems, as in Testset.iterate_over_all
+        scores.assign_score("sysB", 4, 80, 0)
+        assert scores.get_score("sysB", 1) == 80
+        assert scores.get_score("sysA", 1) is None
+
+    def test_save_writes_tsv_files(self, testset, tmp_path):
+        scores = Scores("GEMBA-DA", testset, "refA")
+        for index, (system, score) in enumerate([("sysA", 90), ("sysA", 85.5), ("sysA", None),
+                                                 ("sysB", 60), ("sysB", 70), ("sysB", 80)]):
+            scores.assign_score(system, index, score, None if score is None else 1)
+        scores.save()
+
+        folder = tmp_path / "wmt22" / "metric-scores" / "en-de"
+        assert _read(folder / "GEMBA-DA-refA.seg.score") == [
+            "sysA\t90.0", "sysA\t85.5", "sysA\tNone", "sysB\t60.0", "sysB\t70.0", "sysB\t80.0"]
+        assert _read(folder / "GEMBA-DA-refA.sys.score") == ["sysA\t87.75", "sysB\t70.0"]
+        assert _read(folder / "GEMBA-DA-refA.domain.score") == [
+            "news\tsysA\t87.75", "news\tsysB\t65.0", "speech\tsysA\tNone", "speech\tsysB\t80.0"]
+        assert _read(folder / "GEMBA-DA-refA.seg.meta") == [
+            "sysA\t1.0", "sysA\t1.0", "sysA\tNone", "sysB\t1.0", "sysB\t1.0", "sysB\t1.0"]
+
+    def test_files_of_earlier_runs_are_written_back_unchanged(self, testset, tmp_path):
+        # as written by the pandas based store
+        folder = tmp_path / "wmt22" / "metric-scores" / "en-de"
+        seg_lines = ["sysB\t92.0", "sysB\tNone", "sysB\t67.5", "sysA\t3.0", "sysA\t0.0", "sysA\tNone"]
+        meta_lines = ["sysB\t0.0", "sysB\tNone", "sysB\t3.0", "sysA\t1.0", "sysA\t0.0", "sysA\tNone"]
+        _write(folder / "GEMBA-DA-src.seg.score", seg_lines)
+        _write(folder / "GEMBA-DA-src.seg.meta", meta_lines)
+
+        Scores("GEMBA-DA", testset, None).save()
+        assert _read(folder / "GEMBA-DA-src.seg.score") == seg_lines
+        assert _read(folder / "GEMBA-DA-src.seg.meta") == meta_lines
+
+    def test_reload_keeps_scores_and_system_order(self, testset, tmp_path):
+        folder = tmp_path / "wmt22" / "metric-scores" / "en-de"
+        _write(folder / "GEMBA-DA-src.seg.score", ["sysB\t1", "sysB\tNone", "sysB\t3"])
+
+        scores = Scores("GEMBA-DA", testset, None)
+        assert scores.systems == ["sysB", "sysA"]
+        assert [scores.get_score("sysB", i) for i in range(3)] == [1, None, 3]
+        assert scores.get_score("sysA", 0) is None
+
+    def test_wrong_number_of_scores(self, testset, tmp_path):
+        folder = tmp_path / "wmt22" / "metric-scores" / "en-de"
+        _write(folder / "GEMBA-DA-src.seg.score", ["sysB\t1", "sysB\t2"])
+        with pytest.raises(AssertionError):
+            Scores("GEMBA-DA", testset, None)
+
+
+class TestCheckpoints:
+    def test_journal_is_replayed_after_a_crash(self, testset, tmp_path):
+        scores = Scores("GEMBA-DA", testset, None, checkpoint_every=100)
+        scores.assign_score("sysA", 1, 85.5, 0)
+        scores.assign_score("sysB", 5, 70, 1)
+        # the process dies here, without save
+        scores.close()
+
+        folder = tmp_path / "wmt22" / "metric-scores" / "en-de"
+        with open(folder / "GEMBA-DA-src.seg.journal", "a") as fh:
+            fh.write("sysA\t0\t9")  # cut off mid-line
+        reloaded = Scores("GEMBA-DA", testset, None)
+        assert reloaded.get_score("sysA", 1) == 85.5
+        assert reloaded.get_score("sysB", 2) == 70
+        assert reloaded.get_score("sysA", 0) is None
+
+    def test_checkpoint_every_n_scores(self, testset, tmp_path):
+        scores = Scores("GEMBA-DA", testset, None, checkpoint_every=2)
+        folder = tmp_path / "wmt22" / "metric-scores" / "en-de"
+        scores.assign_score("sysA", 0, 10, 0)
+        assert not (folder / "GEMBA-DA-src.seg.score").exists()
+        scores.assign_score("sysA", 1, 20, 0)
+
+        assert _read(folder / "GEMBA-DA-src.seg.score")[:3] == ["sysA\t10.0", "sysA\t20.0", "sysA\tNone"]
+        assert not (folder / "GEMBA-DA-src.seg.journal").exists()
+        # the aggregates are only written at the end
+        assert not (folder / "GEMBA-DA-src.sys.score").exists()
+
+        scores.assign_score("sysA", 2, 30, 0)
+        scores.save()
+        assert _read(folder / "GEMBA-DA-src.sys.score") == ["sysA\t20.0", "sysB\tNone"]
+        assert not (folder / "GEMBA-DA-src.seg.journal").exists()
+        assert Scores("GEMBA-DA", testset, None).get_score("sysA", 2) == 30
+
+
+class TestSidecar:
+    def test_sidecar_is_preferred_when_newer(self, testset, tmp_path):
+        scores = Scores("GEMBA-DA", testset, None)
+        scores.assign_score("sysA", 0, 85.5, 0)
+        scores.save()
+
+        folder = tmp_path / "wmt22" / "metric-scores" / "en-de"
+        assert (folder / "GEMBA-DA-src.seg.npz").exists()
+        # an unreadable TSV shows that it is not parsed
+        seg_path = folder / "GEMBA-DA-src.seg.score"
+        stat = seg_path.stat()
+        seg_path.write_text("broken\n")
+        os.utime(seg_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        reloaded = Scores("GEMBA-DA", testset, None)
+        assert reloaded.systems == ["sysA", "sysB"]
+        assert reloaded.get_score("sysA", 0) == 85.5
+        assert reloaded.get_score("sysA", 1) is None
+
+    def test_newer_tsv_wins(self, testset, tmp_path):
+        scores = Scores("GEMBA-DA", testset, None)
+        scores.assign_score("sysA", 0, 85.5, 0)
+        scores.save()
+
+        folder = tmp_path / "wmt22" / "metric-scores" / "en-de"
+        seg_path = folder / "GEMBA-DA-src.seg.score"
+        seg_path.write_text(seg_path.read_text().replace("85.5", "42"))
+        sidecar_mtime = (folder / "GEMBA-DA-src.seg.npz").stat().st_mtime_ns
+        os.utime(seg_path, ns=(sidecar_mtime + 10**9, sidecar_mtime + 10**9))
+
+        assert Scores("GEMBA-DA", testset, None).get_score("sysA", 0) == 42
@@ -0,0 +1,181 @@
+"""End-to-end tests of the scoring service against a local OpenAI-compatible stand-in."""
+
+import http.client
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from gemba.server import ScoringService, make_server
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """Answers chat completions with the length of the translated segment as the score."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.calls.append(body)
+        prompt = body["messages"][-1]["content"]
+        hypothesis = prompt.split("translation: ")[-1].split("\n")[0].strip('"')
+        if hypothesis == "slow":
+            self.server.release.wait(10)
+        payload = json.dumps({
+            "id": "chatcmpl-test",
+            "object": "chat.completion",
+            "created": 0,
+            "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": str(len(hypothesis))}}],
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+def _start(server):
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+@pytest.fixture
+def openai_stub():
+    server = _start(ThreadingHTTPServer(("127.0.0.1", 0), FakeOpenAIHandler))
+    server.calls = []
+    # cleared to hold the answers to "slow" segments back
+    server.release = threading.Event()
+    server.release.set()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _service(openai_stub, tmp_path, **kwargs):
+    base_url = f"http://127.0.0.1:{openai_stub.server_port}"
+    return ScoringService("gpt-4", base_url=base_url, cache_dir=str(tmp_path), use_structured_output=False, **kwargs)
+
+
+@pytest.fixture
+def gemba_server(openai_stub, tmp_path):
+    service = _service(openai_stub, tmp_path, concurrency=4, max_wait=0.2).start()
+    server = _start(make_server(service, port=0))
+    yield server
+    server.shutdown()
+    server.server_close()
+    service.close()
+
+
+def _request(server, method, path, payload=None):
+    connection = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=10)
+    body = None if payload is None else json.dumps(payload)
+    connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+    response = connection.getresponse()
+    data = response.read().decode("utf-8")
+    connection.close()
+    return response, data
+
+
+def _job(hypotheses):
+    return {"method": "GEMBA-DA", "source_lang": "English", "target_lang": "German",
+            "segments": [{"source": "source", "hypothesis": hypothesis} for hypothesis in hypotheses]}
+
+
+class TestScoringService:
+    def test_health(self, gemba_server):
+        response, data = _request(gemba_server, "GET", "/health")
+        assert response.status == 200
+        assert json.loads(data) == {"status": "ok"}
+
+    def test_scores_are_streamed_per_segment(self, gemba_server, openai_stub):
+        response, data = _request(gemba_server, "POST", "/score", _job(["a", "bbb", "cc"]))
+
+        assert response.status == 200
+        records = [json.loads(line) for line in data.splitlines()]
+        assert [(r["index"], r["score"]) for r in records] == [(0, 1), (1, 3), (2, 2)]
+        assert len(openai_stub.calls) == 3
+
+    def test_concurrent_requests_share_batches_and_cache(self, gemba_server, openai_stub):
+        results = {}
+
+        def score(i):
+            results[i] = _request(gemba_server, "POST", "/score", _job(["x" * (i + 1), "same"]))[1]
+
+        threads = [threading.Thread(target=score, args=(i,)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for i, data in results.items():
+            assert [json.loads(line)["score"] for line in data.splitlines()] == [i + 1, 4]
+        # "same" is requested once, and the requests were micro-batched together
+        assert len(openai_stub.calls) == 5
+        metrics = json.loads(_request(gemba_server, "GET", "/metrics")[1])
+        assert metrics["scored_segments"] == 8
+        assert metrics["batches"] < 4
+        assert metrics["pending_segments"] == 0
+
+        prometheus = _request(gemba_server, "GET", "/metrics/prometheus")[1]
+        assert 'gemba_stage_seconds_count{stage="api_call"}' in prometheus
+        assert 'gemba_cache_lookups_total{result="hit"}' in prometheus
+
+    def test_slow_batch_does_not_block_the_next(self, openai_stub, tmp_path):
+        service = _service(openai_stub, tmp_path, concurrency=2, max_wait=0.01).start()
+        server = _start(make_server(service, port=0))
+        try:
+            openai_stub.release.clear()
+            slow = {}
+            thread = threading.Thread(target=lambda: slow.update(data=_request(server, "POST", "/score", _job(["slow"]))[1]))
+            thread.start()
+            while not openai_stub.calls:
+                time.sleep(0.01)
+
+            # scored while the batch of the slow segment is still waiting for the API
+            response, data = _request(server, "POST", "/score", _job(["fast"]))
+            assert [json.loads(line)["score"] for line in data.splitlines()] == [4]
+            assert thread.is_alive()
+
+            openai_stub.release.set()
+            thread.join()
+            assert [json.loads(line)["score"] for line in slow["data"].splitlines()] == [4]
+        finally:
+            openai_stub.release.set()
+            server.shutdown()
+            server.server_close()
+            service.close()
+
+    def test_invalid_content_length(self, gemba_server):
+        connection = http.client.HTTPConnection("127.0.0.1", gemba_server.server_port, timeout=10)
+        connection.putrequest("POST", "/score")
+        connection.putheader("Content-Length", "many")
+        connection.endheaders()
+        response = connection.getresponse()
+        assert response.status == 400
+        assert "Content-Length" in json.loads(response.read())["error"]
+        connection.close()
+
+    def test_invalid_request(self, gemba_server):
+        response, data = _request(gemba_server, "POST", "/score", {"method": "GEMBA-XYZ", "segments": []})
+        assert response.status == 400
+        assert "not supported" in json.loads(data)["error"]
+
+    def test_backpressure(self, openai_stub, tmp_path):
+        # the dispatcher is not started, so queued segments stay pending
+        service = _service(openai_stub, tmp_path, max_pending=3)
+        server = _start(make_server(service, port=0))
+        try:
+            service.submit(_job(["a", "b"]))
+            response, _ = _request(server, "POST", "/score", _job(["c", "d"]))
+            assert response.status == 503
+            assert response.getheader("Retry-After") == "1"
+            assert service.metrics()["rejected_requests"] == 1
+        finally:
+            server.shutdown()
+            server.server_close()
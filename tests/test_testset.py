@@ -0,0 +1,80 @@
+"""Tests for the lazy, memory-mapped Testset."""
+
+import pytest
+
+from gemba import testset as testsets
+from gemba.testset import SegmentFile
+
+
+def _write(path, text):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(text)
+
+
+@pytest.fixture
+def testset_path(tmp_path):
+    root = tmp_path / "wmt22"
+    _write(root / "sources" / "en-de.txt", "s0\ns1 \ns2\n")
+    _write(root / "references" / "en-de.refA.txt", "r0\nr1\nr2\n")
+    _write(root / "documents" / "en-de.docs", "news\td0\nnews\td0\nspeech\td1\n")
+    _write(root / "system-outputs" / "en-de" / "sysB.txt", "same\nb1\nb2\n")
+    _write(root / "system-outputs" / "en-de" / "sysA.txt", "same\na1\na2\n")
+    return tmp_path
+
+
+class TestSegmentFile:
+    def test_segments_match_reading_the_lines(self, tmp_path):
+        path = tmp_path / "segments.txt"
+        # trailing whitespace is stripped, a last line without a newline is kept
+        path.write_text("first\nsecond \t\n\nÜnïcode 字\nlast")
+        segments = SegmentFile(str(path))
+        with open(path, "r") as fh:
+            assert list(segments) == [line.rstrip() for line in fh]
+        assert segments[-1] == "last"
+        assert segments[1:3] == ["second", ""]
+        with pytest.raises(IndexError):
+            segments[5]
+
+    def test_empty_file(self, tmp_path):
+        path = tmp_path / "empty.txt"
+        path.write_text("")
+        assert len(SegmentFile(str(path))) == 0
+
+    def test_index_is_cached_and_rebuilt_when_the_file_changes(self, tmp_path):
+        path = tmp_path / "segments.txt"
+        path.write_text("a\nb\n")
+        assert len(SegmentFile(str(path))) == 2
+        assert (tmp_path / ".segments.txt.offsets.npy").exists()
+
+        path.write_text("a\nb\nc\n")
+        assert list(SegmentFile(str(path))) == ["a", "b", "c"]
+
+
+class TestTestset:
+    def test_load(self, testset_path):
+        testset = testsets.Testset(str(testset_path), "wmt22", "en-de")
+        # the hidden line indices are not systems
+        assert list(testset.systems.keys()) == ["sysA", "sysB"]
+        assert testset.main_ref == "refA"
+        assert list(testset.sources) == ["s0", "s1", "s2"]
+        assert testset.segments_count() == 6
+
+        # reloading uses the cached indices
+        assert list(testsets.Testset(str(testset_path), "wmt22", "en-de").systems.keys()) == ["sysA", "sysB"]
+
+    def test_iterate_over_all(self, testset_path):
+        testset = testsets.Testset(str(testset_path), "wmt22", "en-de")
+        rows = list(testset.iterate_over_all("refA"))
+        assert rows[0] == ("s0", "same", "r0", "sysA")
+        assert rows[4] == ("s1", "b1", "r1", "sysB")
+        assert len(rows) == 6
+        # identical segments of different systems share one string
+        assert rows[0][1] is rows[3][1]
+
+    def test_system_filter_and_start(self, testset_path):
+        testset = testsets.Testset(str(testset_path), "wmt22", "en-de")
+        assert [row[1] for row in testset.iterate_over_all(systems=["sysB"])] == ["same", "b1", "b2"]
+        assert [row[1] for row in testset.iterate_over_all(start=2)] == ["a2", "same", "b1", "b2"]
+        assert [row[1] for row in testset.iterate_over_all(systems=["sysB"], start=1)] == ["b1", "b2"]
+        with pytest.raises(ValueError):
+            list(testset.iterate_over_all(systems=["sysC"]))
@@ -0,0 +1,76 @@
+"""Tests for the usage, latency and cost accounting."""
+
+import json
+import os
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+os.environ.setdefault("OPENAI_API_KEY", "test-key")
+
+from gemba.gpt_api import GptApi
+from gemba.usage import UsageTracker, usage_labels
+
+
+def _response(prompt_tokens, completion_tokens, cached_tokens=0, finish_reason="stop"):
+    usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens))
+    return SimpleNamespace(usage=usage, choices=[SimpleNamespace(finish_reason=finish_reason)])
+
+
+class TestUsageTracker:
+    def test_groups_by_labels(self):
+        tracker = UsageTracker(prices={"gpt-4o": {"input": 2.0, "cached_input": 1.0, "output": 10.0}})
+        # the second call runs after the first one
+        with usage_labels(method="GEMBA-DA", lang_pair="en-de"), patch("time.monotonic", side_effect=[100.5, 102.0]):
+            tracker.record("gpt-4o", _response(1000, 10, cached_tokens=400), 0.5)
+            tracker.record("gpt-4o", _response(1000, 10, finish_reason="length"), 1.5, retries=2)
+        with usage_labels(method="GEMBA-DA", lang_pair="en-cs"):
+            tracker.record("gpt-4o", _response(100, 5), 0.1)
+
+        rows = tracker.summary(lang_pair="en-de")
+        assert len(rows) == 1
+        row = rows[0]
+        assert (row["model"], row["method"], row["lang_pair"]) == ("gpt-4o", "GEMBA-DA", "en-de")
+        assert (row["calls"], row["retries"], row["prompt_tokens"], row["cached_tokens"]) == (2, 2, 2000, 400)
+        assert row["finish_reasons"] == {"stop": 1, "length": 1}
+        assert (row["latency_p50"], row["latency_p99"]) == (0.5, 1.5)
+        assert row["completion_tokens_per_second"] == pytest.approx(10)
+        assert row["cost"] == pytest.approx((1600 * 2.0 + 400 * 1.0 + 20 * 10.0) / 1e6)
+        assert len(tracker.summary()) == 2
+
+    def test_throughput_of_concurrent_calls(self):
+        tracker = UsageTracker()
+        # four overlapping one-second calls take 1.2 seconds of wall time, not four
+        with patch("time.monotonic", side_effect=[101.0, 101.0, 101.1, 101.2]):
+            for _ in range(4):
+                tracker.record("gpt-4o", _response(100, 10), 1.0)
+        row, = tracker.summary()
+        assert row["completion_tokens_per_second"] == pytest.approx(40 / 1.2)
+
+    def test_unknown_model_has_no_cost(self, tmp_path):
+        tracker = UsageTracker(prices={})
+        tracker.record("local-model", SimpleNamespace(usage=None, choices=[]), 0.2)
+
+        summary = tracker.write(str(tmp_path / "usage.json"))
+        assert summary["calls"] == 1 and summary["prompt_tokens"] == 0
+        assert summary["cost"] is None
+        assert json.loads((tmp_path / "usage.json").read_text()) == summary
+
+
+class TestRequestUsage:
+    def test_records_retries_of_a_call(self):
+        with patch("openai.OpenAI"):
+            gpt_api = GptApi()
+        gpt_api.is_openai = True
+        choice = MagicMock(finish_reason="stop", logprobs=None)
+        choice.message.content = "85"
+        response = MagicMock(choices=[choice], usage=_response(50, 2).usage)
+        gpt_api.client.chat.completions.create.side_effect = [Exception("boom"), response]
+
+        with patch("time.sleep"), usage_labels(method="GEMBA-DA"):
+            gpt_api.request_api("prompt", "gpt-4")
+
+        row, = gpt_api.usage.summary()
+        assert (row["method"], row["calls"], row["retries"], row["prompt_tokens"]) == ("GEMBA-DA", 1, 1, 50)